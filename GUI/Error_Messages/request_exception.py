@@ -5,7 +5,8 @@ from PySide6.QtCore import Qt
 from scripts.tags import OrthancRequestError
 class RequestExceptionDialog(QDialog):
     
-    def __init__(self, error : OrthancRequestError, parent=None):
+    def __init__(self, error : OrthancRequestError, parent=None, failed : list[tuple[str, str, str]] = None):
+        # failed : (level, id, error) of the resources a rollback could not delete, only listed
         super().__init__(parent)
         self.v_layout = QVBoxLayout()
         
@@ -17,12 +18,18 @@ class RequestExceptionDialog(QDialog):
         detail_text = QLabel(f"{self.error}")
         self.v_layout.addWidget(detail_text)
 
-        self.explication = QLabel("Do you want to proceed with the dicomization process of other studies ?", self)
-        self.v_layout.addWidget(self.explication)
-        
         self.buttonBox = QDialogButtonBox(Qt.Orientation.Horizontal)
-        self.buttonBox.addButton(QPushButton("Continue"), QDialogButtonBox.ButtonRole.AcceptRole)
-        self.buttonBox.addButton(QPushButton("Cancel All"), QDialogButtonBox.ButtonRole.RejectRole)
+        if failed is not None:
+            failed_text = QLabel("\n".join(f"{level} {id} : {message}" for level, id, message in failed))
+            self.v_layout.addWidget(failed_text)
+            self.explication = QLabel("They have to be deleted from Orthanc by hand.", self)
+            self.v_layout.addWidget(self.explication)
+            self.buttonBox.addButton(QPushButton("Ok"), QDialogButtonBox.ButtonRole.AcceptRole)
+        else:
+            self.explication = QLabel("Do you want to proceed with the dicomization process of other studies ?", self)
+            self.v_layout.addWidget(self.explication)
+            self.buttonBox.addButton(QPushButton("Continue"), QDialogButtonBox.ButtonRole.AcceptRole)
+            self.buttonBox.addButton(QPushButton("Cancel All"), QDialogButtonBox.ButtonRole.RejectRole)
         self.buttonBox.accepted.connect(self.accept)
         self.buttonBox.rejected.connect(self.reject)
         
@@ -35,7 +35,7 @@ sys.path.append('.')
 
 from PySide6.QtWidgets import (
     QMainWindow, QHBoxLayout, QVBoxLayout, QWidget, QFileDialog, QLabel, QPushButton, QAbstractItemView, QTreeView,
-    QSizePolicy, QMenu
+    QSizePolicy, QMenu, QProgressBar, QCheckBox
 )
 
 from PySide6.QtCore import (
@@ -129,12 +129,46 @@ class CentralWidget(QWidget):
         self.update_button = QPushButton("Update Tags")
         self.update_button.clicked.connect(self.update_tags)
         self.v_layout.addWidget(self.update_button)
+        
+        self.dedup_box = QCheckBox("Reuse the instances already uploaded from identical files")
+        self.dedup_box.setChecked(self.model.dedup_cache)
+        self.dedup_box.toggled.connect(self.model.set_dedup_cache)
+        self.v_layout.addWidget(self.dedup_box)
+        
+        self.raw_dicom_box = QCheckBox("Send the DICOM files as they are, with the tags added to their header")
+        self.raw_dicom_box.setChecked(tags.RAW_DICOM)
+        self.raw_dicom_box.toggled.connect(self.model.set_raw_dicom)
+        self.v_layout.addWidget(self.raw_dicom_box)
+        
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setFormat("%v/%m")
+        self.progress_bar.hide()
+        self.v_layout.addWidget(self.progress_bar)
+        self.model.upload_progress.connect(self.update_progress)
+        self.model.upload_finished.connect(self.upload_finished)
 
         self.setLayout(self.v_layout)
 
     def update_tags(self):
         if self.model.directory:
             self.model.send_requests()
+    
+    def update_progress(self, done : int, total : int):
+        # the upload runs in the background, don't change the model meanwhile
+        self.update_button.setEnabled(False)
+        self.dicom_widget.setEnabled(False)
+        self.dedup_box.setEnabled(False)
+        self.raw_dicom_box.setEnabled(False)
+        self.progress_bar.setMaximum(total)
+        self.progress_bar.setValue(done)
+        self.progress_bar.show()
+    
+    def upload_finished(self):
+        self.update_button.setEnabled(True)
+        self.dicom_widget.setEnabled(True)
+        self.dedup_box.setEnabled(True)
+        self.raw_dicom_box.setEnabled(True)
+        self.progress_bar.hide()
 
 
 class MainWindow(QMainWindow):
@@ -0,0 +1,406 @@
+# Canathist Automizer Tags 2023
+
+# Copyright (C) 2023 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU General Public License as
+
+# published by the Free Software Foundation, either version 3 of the
+
+# License, or (at your option) any later version.
+
+# 
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU General Public License
+
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import io
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from pydicom import dcmread
+from pydicom.datadict import tag_for_keyword
+from pydicom.errors import InvalidDicomError
+from pydicom.uid import generate_uid
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from scripts.tags import TAG_PATIENT, TAG_STUDY, TAG_SERIES
+from scripts.types import OrthancErrorCode
+
+LEVELS = {"patients": "Patient", "studies": "Study", "series": "Series", "instances": "Instance"}
+CHILDREN = {"patients": "studies", "studies": "series", "series": "instances", "instances": None}
+PARENTS = {"studies": "patients", "series": "studies", "instances": "series"}
+PARENT_KEYS = {"patients": "ParentPatient", "studies": "ParentStudy", "series": "ParentSeries"}
+CHILDREN_KEYS = {"patients": "Studies", "studies": "Series", "series": "Instances"}
+MODULES = {"patients": TAG_PATIENT, "studies": TAG_STUDY, "series": TAG_SERIES}
+# tag identifying the resource of a level in the files sent to /instances
+UIDS = {"patients": "PatientID", "studies": "StudyInstanceUID", "series": "SeriesInstanceUID"}
+
+
+def error_code(code : OrthancErrorCode) -> int:
+    return code.value[0] if isinstance(code.value, tuple) else code.value
+
+
+class OrthancError(Exception):
+
+    def __init__(self, http_status : int, code : OrthancErrorCode, message : str) -> None:
+        super().__init__(message)
+        self.http_status = http_status
+        self.code = code
+        self.message = message
+
+    def to_dict(self) -> dict:
+        return {"HttpStatus": self.http_status, "OrthancStatus": error_code(self.code), "OrthancError": self.code.name,
+                "Message": self.message, "Details": self.message}
+
+
+class Store:
+    """In-memory patients, studies, series and instances, with the tags they have been created with"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.resources : dict[str, dict[str, dict]] = {level:{} for level in LEVELS}
+        # (level, value of its UID tag) -> id
+        self.uids : dict[tuple[str, str], str] = {}
+
+    def _new(self, level : str, parent : str | None, tags : dict) -> str:
+        id = f"{LEVELS[level].lower()}-{next(self.ids):08d}"
+        module = MODULES.get(level)
+        resource = {"ID": id, "Type": LEVELS[level], "Tags": {tag:val for tag, val in tags.items() if module is None or tag in module}}
+        if level in UIDS:
+            if level != "patients" and UIDS[level] not in resource["Tags"]:
+                # generated by Orthanc
+                resource["Tags"][UIDS[level]] = generate_uid()
+            self.uids[(level, resource["Tags"].get(UIDS[level], ""))] = id
+        if parent:
+            resource[PARENT_KEYS[PARENTS[level]]] = parent
+            self.resources[PARENTS[level]][parent].setdefault(CHILDREN_KEYS[PARENTS[level]], []).append(id)
+        self.resources[level][id] = resource
+        return id
+
+    def find(self, id : str) -> str | None:
+        for level, resources in self.resources.items():
+            if id in resources:
+                return level
+        return None
+
+    def get(self, level : str, id : str) -> dict:
+        resource = self.resources[level].get(id)
+        if resource is None:
+            raise OrthancError(404, OrthancErrorCode.ErrorCode_UnknownResource, "Unknown resource")
+        return resource
+
+    def parents(self, level : str, id : str) -> dict:
+        """ParentPatient, ParentStudy, ParentSeries of a resource"""
+        parents = {}
+        while level in PARENTS:
+            parent_level = PARENTS[level]
+            id = self.resources[level][id][PARENT_KEYS[parent_level]]
+            level = parent_level
+            parents[PARENT_KEYS[level]] = id
+        return parents
+
+    def create(self, tags : dict, parent : str, count : int) -> tuple[str, list[str]]:
+        """Create count instances below parent, returns (series id, instance ids)"""
+        with self.lock:
+            level = self.find(parent) if parent else None
+            if parent and level is None:
+                raise OrthancError(404, OrthancErrorCode.ErrorCode_UnknownResource, f"Unknown parent {parent}")
+            if level is None:
+                patient = self.uids.get(("patients", tags.get("PatientID", "")))
+                if patient is None:
+                    patient = self._new("patients", None, tags)
+                parent, level = patient, "patients"
+            if level == "patients":
+                parent, level = self._new("studies", parent, tags), "studies"
+            if level == "studies":
+                parent, level = self._new("series", parent, tags), "series"
+            if level != "series":
+                raise OrthancError(400, OrthancErrorCode.ErrorCode_BadRequest, "An instance can't be the parent of an instance")
+            return parent, [self._new("instances", parent, tags) for _ in range(count)]
+
+    def store(self, tags : dict) -> str:
+        """Instance sent to /instances, added to the patient, study and series of its UIDs, returns its id"""
+        with self.lock:
+            parent = None
+            for level in ("patients", "studies", "series"):
+                id = self.uids.get((level, tags.get(UIDS[level], "")))
+                parent = id if id is not None else self._new(level, parent, tags)
+            return self._new("instances", parent, tags)
+
+    def delete(self, level : str, id : str):
+        with self.lock:
+            self._remove(level, self.get(level, id))
+
+    def _remove(self, level : str, resource : dict):
+        self._delete(level, resource)
+        if level in PARENTS:
+            parent_level = PARENTS[level]
+            parent = self.resources[parent_level].get(resource[PARENT_KEYS[parent_level]])
+            if parent:
+                parent[CHILDREN_KEYS[parent_level]].remove(resource["ID"])
+                if len(parent[CHILDREN_KEYS[parent_level]]) == 0:
+                    # like Orthanc, a resource without children is removed as well
+                    self._remove(parent_level, parent)
+
+    def _delete(self, level : str, resource : dict):
+        children = CHILDREN[level]
+        for child in resource.get(CHILDREN_KEYS.get(level), []):
+            self._delete(children, self.resources[children][child])
+        del self.resources[level][resource["ID"]]
+        if level in UIDS:
+            self.uids.pop((level, resource["Tags"].get(UIDS[level], "")), None)
+
+    def module(self, level : str, id : str) -> dict:
+        with self.lock:
+            tags = self.get(level, id)["Tags"]
+        module = {}
+        for name, val in tags.items():
+            tag = tag_for_keyword(name)
+            key = f"{tag >> 16:04x},{tag & 0xffff:04x}" if tag is not None else name
+            module[key] = {"Name": name, "Type": "String", "Value": val}
+        return module
+
+    def counts(self) -> dict:
+        with self.lock:
+            return {LEVELS[level]:len(resources) for level, resources in self.resources.items()}
+
+
+class Settings:
+    """Latency and failures injected in the answers
+
+    Attributes:
+        latency : seconds added to every request
+        jitter : up to jitter more seconds, drawn for every request
+        failure_rate : probability that an upload fails with failure_code
+        failure_code : OrthancErrorCode of the injected failures
+    """
+
+    def __init__(self, latency : float = 0, jitter : float = 0, failure_rate : float = 0,
+                 failure_code : OrthancErrorCode = OrthancErrorCode.ErrorCode_DatabaseCannotSerialize) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.failure_code = failure_code
+
+
+class Stats:
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.bytes_received = 0
+        # after the Content-Encoding has been decoded
+        self.bytes_decoded = 0
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {"requests": self.requests, "failures": self.failures, "bytes_received": self.bytes_received, "bytes_decoded": self.bytes_decoded}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server : "FakeOrthanc"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    # trailers
+                    while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b"".join(chunks)
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def decode_body(self, body : bytes) -> bytes:
+        # like Orthanc for gzip and deflate, zstd for a proxy that would decompress it
+        encoding = self.headers.get("Content-Encoding", "identity").strip().lower()
+        try:
+            if encoding == "identity":
+                return body
+            if encoding == "gzip":
+                return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            if encoding == "deflate":
+                return zlib.decompress(body)
+            if encoding == "zstd" and zstandard is not None:
+                # streamed frames don't say their size
+                return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+        except (zlib.error, ValueError) as e:
+            raise OrthancError(400, OrthancErrorCode.ErrorCode_BadRequest, f"Body not in {encoding} : {e}")
+        raise OrthancError(415, OrthancErrorCode.ErrorCode_UnsupportedMediaType, f"Unsupported HTTP encoding {encoding}")
+
+    def reply(self, body, status : int = 200):
+        out = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def handle_request(self, method : str):
+        settings = self.server.settings
+        body = self.read_body() if method in ("POST", "PUT") else b""
+        with self.server.stats.lock:
+            self.server.stats.requests += 1
+            self.server.stats.bytes_received += len(body)
+        if settings.latency or settings.jitter:
+            time.sleep(settings.latency + random.uniform(0, settings.jitter))
+        try:
+            body = self.decode_body(body)
+            with self.server.stats.lock:
+                self.server.stats.bytes_decoded += len(body)
+            self.reply(self.route(method, self.path.split("?")[0].rstrip("/"), body))
+        except OrthancError as e:
+            self.reply(e.to_dict(), e.http_status)
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def inject_failure(self):
+        settings = self.server.settings
+        if settings.failure_rate and random.random() < settings.failure_rate:
+            with self.server.stats.lock:
+                self.server.stats.failures += 1
+            raise OrthancError(500, settings.failure_code, "Injected failure")
+
+    def route(self, method : str, path : str, body : bytes):
+        store = self.server.store
+        if method == "POST" and path in ("/tools/create-dicom", "/stl/create-nexus"):
+            self.inject_failure()
+            params = json.loads(body)
+            content = params.get("Content")
+            if content is None:
+                raise OrthancError(400, OrthancErrorCode.ErrorCode_BadRequest, "No Content")
+            series, instances = store.create(params.get("Tags", {}), params.get("Parent", ""), len(content) if isinstance(content, list) else 1)
+            if isinstance(content, list):
+                # one instance per item, the answer is the series
+                return {"ID": series, "Path": f"/series/{series}"}
+            return {"ID": instances[0], "Path": f"/instances/{instances[0]}", **store.parents("instances", instances[0])}
+        if method == "POST" and path == "/instances":
+            self.inject_failure()
+            try:
+                ds = dcmread(io.BytesIO(body), stop_before_pixels=True)
+            except (InvalidDicomError, EOFError) as e:
+                raise OrthancError(400, OrthancErrorCode.ErrorCode_BadFileFormat, f"Not a DICOM file : {e}")
+            id = store.store({element.keyword:str(element.value) for element in ds if element.keyword and element.VR != "SQ"})
+            return {"ID": id, "Path": f"/instances/{id}", "Status": "Success", **store.parents("instances", id)}
+        if method == "POST" and path == "/tools/bulk-delete":
+            for id in json.loads(body).get("Resources", []):
+                level = store.find(id)
+                if level:
+                    store.delete(level, id)
+            return {}
+        if method == "GET" and path == "/benchmark/stats":
+            return {**self.server.stats.to_dict(), **store.counts()}
+        match = re.fullmatch(r"/(patients|studies|series|instances)/([^/]+)(?:/(module|study))?", path)
+        if match is None:
+            raise OrthancError(404, OrthancErrorCode.ErrorCode_UnknownResource, f"Unknown URI {path}")
+        level, id, sub = match.groups()
+        if method == "DELETE" and sub is None:
+            store.delete(level, id)
+            return {}
+        if method != "GET":
+            raise OrthancError(405, OrthancErrorCode.ErrorCode_BadRequest, f"{method} not allowed on {path}")
+        if sub == "module":
+            return store.module(level, id)
+        if sub == "study":
+            if level != "series":
+                raise OrthancError(404, OrthancErrorCode.ErrorCode_UnknownResource, f"Unknown URI {path}")
+            with store.lock:
+                study_id = store.get(level, id)["ParentStudy"]
+                return dict(store.get("studies", study_id))
+        with store.lock:
+            return dict(store.get(level, id))
+
+
+class FakeOrthanc(ThreadingHTTPServer):
+    """Stand-in for the parts of the Orthanc REST API used by the upload, to benchmark it without a server
+
+    tools/create-dicom, stl/create-nexus, /instances, GET of the resources, of their modules and of /series/{id}/study,
+    DELETE of the resources and tools/bulk-delete. The base64 content isn't decoded, only the header of the
+    files sent to /instances is read.
+    Bodies can be sent with a gzip, deflate or zstd (if zstandard is installed) Content-Encoding.
+    GET /benchmark/stats gives the number of requests, failures, bytes received and resources.
+    """
+    daemon_threads = True
+
+    def __init__(self, host : str = "127.0.0.1", port : int = 0, settings : Settings = None) -> None:
+        super().__init__((host, port), Handler)
+        self.store = Store()
+        self.stats = Stats()
+        self.settings = settings or Settings()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeOrthanc":
+        """Serve from a daemon thread, shutdown() to stop"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def parse_args(argv : list[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.fake_orthanc", description="Fake Orthanc server for the benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8042)
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to every request")
+    parser.add_argument("--jitter", type=float, default=0, help="up to this many seconds more, random")
+    parser.add_argument("--failure-rate", type=float, default=0, help="probability that an upload fails")
+    parser.add_argument("--failure-code", default="ErrorCode_DatabaseCannotSerialize", choices=[code.name for code in OrthancErrorCode],
+                        metavar="ERROR_CODE", help="OrthancErrorCode of the injected failures")
+    return parser.parse_args(argv)
+
+def main(argv : list[str] = None):
+    args = parse_args(argv)
+    server = FakeOrthanc(args.host, args.port, Settings(args.latency, args.jitter, args.failure_rate, OrthancErrorCode[args.failure_code]))
+    print(f"Fake Orthanc on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+# Canathist Automizer Tags 2023
+
+# Copyright (C) 2023 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU General Public License as
+
+# published by the Free Software Foundation, either version 3 of the
+
+# License, or (at your option) any later version.
+
+# 
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU General Public License
+
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import argparse
+import json
+import os
+import random
+
+# start of a JPEG file, the rest is random : enough for the upload, not for a real Orthanc
+JPEG_HEADER = b"\xff\xd8\xff\xe0\x00\x10JFIF\x00"
+MANIFEST_NAME = "dataset.json"
+
+
+def _write(path : str, size : int, header : bytes = b"", rng : random.Random = None):
+    with open(path, "wb") as f:
+        f.write(header)
+        f.write(rng.randbytes(max(0, size - len(header))))
+
+def _write_dicom(path : str, size : int, rng : random.Random):
+    # secondary capture with about size bytes of random pixel data, already DICOM like the files of update_tags_dicom
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, SecondaryCaptureImageStorage, generate_uid
+
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = SecondaryCaptureImageStorage
+    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.SOPClassUID = SecondaryCaptureImageStorage
+    ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+    ds.Columns = 256
+    ds.Rows = max(1, size // ds.Columns)
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = ds.BitsStored = 8
+    ds.HighBit = 7
+    ds.PixelRepresentation = 0
+    ds.PixelData = rng.randbytes(ds.Rows * ds.Columns)
+    ds.save_as(path, enforce_file_format=True)
+
+def generate(directory : str, studies : int = 4, tile_series : int = 1, tiles : int = 50, tile_size : int = 64 * 1024,
+             folder_series : int = 1, folder_files : int = 20, mesh_series : int = 1, mesh_size : int = 1024 * 1024,
+             nexus : bool = False, dicom : bool = False, seed : int = 0) -> str:
+    """Write a dataset shaped like data/to_dicomize and its manifest, returns the path of the manifest
+
+    Every study has tile_series series of tiles (one instance per image, .dcm files if dicom else JPEG),
+    folder_series series made of one folder of images (one request for the whole folder) and mesh_series
+    series of one mesh file, .nxz sent to stl/create-nexus if nexus else .stl.
+    """
+    rng = random.Random(seed)
+    manifest = {}
+    for study in range(studies):
+        study_name = f"Study_{study}"
+        study_manifest = manifest[study_name] = {
+            "_tags": {"PatientID": f"P{study:06d}", "PatientName": f"PATIENT^{study}", "StudyID": f"{study}"},
+        }
+        series_number = 0
+        for _ in range(tile_series):
+            series_number += 1
+            series_name = f"Serie_{series_number}"
+            os.makedirs(os.path.join(directory, study_name, series_name), exist_ok=True)
+            labels = [f"_x_00000_y_{i * 160:05d}_.{'dcm' if dicom else 'jpg'}" for i in range(tiles)]
+            for label in labels:
+                if dicom:
+                    _write_dicom(os.path.join(directory, study_name, series_name, label), tile_size, rng)
+                else:
+                    _write(os.path.join(directory, study_name, series_name, label), tile_size, JPEG_HEADER, rng)
+            study_manifest[series_name] = {
+                "tags": {"SeriesNumber": f"{series_number}", "Modality": "XC"},
+                "columns": {"Label": labels, "AcquisitionNumber": [f"{i + 1}" for i in range(tiles)]},
+            }
+        for _ in range(folder_series):
+            series_number += 1
+            series_name = f"Serie_{series_number}"
+            folder = os.path.join(directory, study_name, series_name, "images")
+            os.makedirs(folder, exist_ok=True)
+            for i in range(folder_files):
+                _write(os.path.join(folder, f"image_{i:04d}.jpg"), tile_size, JPEG_HEADER, rng)
+            study_manifest[series_name] = {
+                "tags": {"SeriesNumber": f"{series_number}", "Modality": "XC"},
+                "files": {"images": {"tags": {}}},
+            }
+        for _ in range(mesh_series):
+            series_number += 1
+            series_name = f"Serie_{series_number}"
+            mesh_name = "mesh.nxz" if nexus else "mesh.stl"
+            os.makedirs(os.path.join(directory, study_name, series_name), exist_ok=True)
+            _write(os.path.join(directory, study_name, series_name, mesh_name), mesh_size, b"solid mesh\n", rng)
+            study_manifest[series_name] = {
+                "tags": {"SeriesNumber": f"{series_number}", "Modality": "M3D"},
+                "files": {mesh_name: {"tags": {}}},
+            }
+    path = os.path.join(directory, MANIFEST_NAME)
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=4)
+    return path
+
+def parse_args(argv : list[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.generate", description="Write a synthetic dataset and its manifest")
+    parser.add_argument("directory")
+    parser.add_argument("--studies", type=int, default=4)
+    parser.add_argument("--tile-series", type=int, default=1, help="series of one instance per image, per study")
+    parser.add_argument("--tiles", type=int, default=50, help="images per tile series")
+    parser.add_argument("--tile-size", type=int, default=64 * 1024, help="bytes per image")
+    parser.add_argument("--folder-series", type=int, default=1, help="series sent as one folder, per study")
+    parser.add_argument("--folder-files", type=int, default=20, help="images per folder")
+    parser.add_argument("--mesh-series", type=int, default=1, help="series of one mesh file, per study")
+    parser.add_argument("--mesh-size", type=int, default=1024 * 1024, help="bytes per mesh")
+    parser.add_argument("--nexus", action="store_true", help="meshes in .nxz, sent to stl/create-nexus")
+    parser.add_argument("--dicom", action="store_true", help="tiles already in DICOM, sent to /instances")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+def main(argv : list[str] = None):
+    args = parse_args(argv)
+    path = generate(args.directory, args.studies, args.tile_series, args.tiles, args.tile_size, args.folder_series,
+                    args.folder_files, args.mesh_series, args.mesh_size, args.nexus, args.dicom, args.seed)
+    print(path)
+
+if __name__ == '__main__':
+    main()
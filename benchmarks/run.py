@@ -0,0 +1,218 @@
+# Canathist Automizer Tags 2023
+
+# Copyright (C) 2023 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU General Public License as
+
+# published by the Free Software Foundation, either version 3 of the
+
+# License, or (at your option) any later version.
+
+# 
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU General Public License
+
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import resource
+import sys
+import tempfile
+from queue import Empty
+
+import requests
+
+from benchmarks.fake_orthanc import FakeOrthanc, Settings
+from benchmarks.generate import generate
+from scripts.compression import ENCODINGS, available
+
+# streamed and buffered through threads, streamed through asyncio, streamed with the DICOM files in base64
+MODES = ("streamed", "buffered", "async", "base64")
+# relative loss of throughput, or gain of memory, reported as a regression
+TOLERANCE = 0.2
+
+
+class _UploadLatencies:
+    """Metrics sink keeping only the time of every uploaded instance"""
+
+    def __init__(self) -> None:
+        self.seconds = []
+
+    def write(self, line : str):
+        record = json.loads(line)
+        if record.get("stage") == "upload":
+            self.seconds.append(record["seconds"])
+
+def _percentile(values : list[float], q : float) -> float:
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def _serve(settings : Settings, queue):
+    server = FakeOrthanc(settings=settings)
+    queue.put(server.url)
+    server.serve_forever()
+
+def _upload(directory : str, url : str, workers : int, studies : int, mode : str, compress : str, queue):
+    # in its own process : the peak memory is the one of this upload only
+    from scripts import cli, tags
+    from scripts.metrics import metrics
+
+    tags.STREAM_UPLOAD = mode != "buffered"
+    latencies = _UploadLatencies()
+    metrics.sink = latencies
+    args = cli.parse_args([directory, "--url", url, "--workers", str(workers), "--studies", str(studies),
+                           "--no-journal", "--no-cache", "--on-conflict", "module", "--on-error", "keep"] + (["--async"] if mode == "async" else [])
+                          + (["--raw-dicom"] if mode != "base64" else [])
+                          + (["--compress", compress, "--compress-api", "dicom", "nexus", "instances"] if compress != "none" else []))
+    with contextlib.redirect_stdout(io.StringIO()):
+        summary, code = cli.run(args)
+    totals = metrics.to_dict()
+    counters = totals["counters"]
+    elapsed = summary["elapsed"]
+    instances = counters.get("instances_uploaded", 0)
+    queue.put({
+        "config": f"{mode},workers={workers},studies={studies}" + (f",compress={compress}" if compress != "none" else ""),
+        "elapsed": elapsed,
+        "instances": instances,
+        "failed_studies": sum(1 for study in summary["studies"] if study["status"] != "uploaded"),
+        "instances_per_s": instances / elapsed if elapsed else 0,
+        "mb_per_s": counters.get("bytes_read", 0) / elapsed / 1e6 if elapsed else 0,
+        "bytes_sent": counters.get("bytes_sent", 0),
+        "compression_ratio": counters["bytes_compressed"] / counters["bytes_uncompressed"] if counters.get("bytes_uncompressed") else 1.0,
+        "retries": counters.get("retries", 0),
+        # kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "latency": {
+            "p50": _percentile(latencies.seconds, 0.5),
+            "p95": _percentile(latencies.seconds, 0.95),
+            "max": max(latencies.seconds, default=0.0),
+        },
+        "stages": {name:stage["seconds"] for name, stage in totals["stages"].items()},
+    })
+
+def _bytes_received(url : str) -> int:
+    return requests.get(f"{url}/benchmark/stats").json()["bytes_received"]
+
+def run_config(context, directory : str, url : str, workers : int, studies : int, mode : str, compress : str = "none") -> dict:
+    received = _bytes_received(url)
+    queue = context.Queue()
+    process = context.Process(target=_upload, args=(directory, url, workers, studies, mode, compress, queue))
+    process.start()
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Empty:
+            if not process.is_alive():
+                raise RuntimeError(f"upload {mode},workers={workers},studies={studies} exited with {process.exitcode} without a result")
+    process.join()
+    # what the server got on the wire, the bytes_sent of the client must match it
+    result["bytes_received"] = _bytes_received(url) - received
+    return result
+
+def compare(results : list[dict], baseline : list[dict], tolerance : float = TOLERANCE) -> list[str]:
+    """Regressions of the results against a baseline, for the configurations they have in common"""
+    baseline = {result["config"]:result for result in baseline}
+    regressions = []
+    for result in results:
+        base = baseline.get(result["config"])
+        if base is None:
+            continue
+        if result["instances_per_s"] < base["instances_per_s"] * (1 - tolerance):
+            regressions.append(f"{result['config']} : {result['instances_per_s']:.1f} instances/s, was {base['instances_per_s']:.1f}")
+        if result["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"{result['config']} : {result['peak_rss_mb']:.0f} MB peak, was {base['peak_rss_mb']:.0f}")
+    return regressions
+
+def parse_args(argv : list[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description="Benchmark the upload against a fake Orthanc server")
+    parser.add_argument("--dataset", help="existing dataset directory, a synthetic one is generated otherwise")
+    parser.add_argument("--n-studies", type=int, default=4, help="studies of the generated dataset")
+    parser.add_argument("--tiles", type=int, default=50, help="images per tile series of the generated dataset")
+    parser.add_argument("--tile-size", type=int, default=64 * 1024)
+    parser.add_argument("--folder-files", type=int, default=20)
+    parser.add_argument("--mesh-size", type=int, default=1024 * 1024)
+    parser.add_argument("--nexus", action="store_true")
+    parser.add_argument("--dicom", action="store_true", help="tiles already in DICOM")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 8], help="configurations to compare")
+    parser.add_argument("--studies", type=int, nargs="+", default=[2], help="configurations to compare")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES), help="configurations to compare")
+    parser.add_argument("--compress", nargs="+", choices=("none",) + ENCODINGS, default=["none"],
+                        help="configurations to compare, every upload is compressed except with none")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per configuration, the fastest is kept")
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds added by the server to every request")
+    parser.add_argument("--jitter", type=float, default=0.005)
+    parser.add_argument("--failure-rate", type=float, default=0)
+    parser.add_argument("--output", help="file where the results are written as JSON")
+    parser.add_argument("--baseline", help="results of a previous run, exits with 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+    for encoding in args.compress:
+        if encoding != "none" and not available(encoding):
+            parser.error(f"{encoding} compression needs the zstandard package")
+    return args
+
+def main(argv : list[str] = None) -> int:
+    args = parse_args(argv)
+    # fresh interpreters, nothing inherited from this one
+    context = multiprocessing.get_context("spawn")
+
+    queue = context.Queue()
+    server = context.Process(target=_serve, args=(Settings(args.latency, args.jitter, args.failure_rate), queue), daemon=True)
+    server.start()
+    url = queue.get()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        directory = args.dataset
+        if directory is None:
+            directory = temp_dir
+            generate(directory, args.n_studies, tiles=args.tiles, tile_size=args.tile_size, folder_files=args.folder_files,
+                     mesh_size=args.mesh_size, nexus=args.nexus, dicom=args.dicom)
+        results = []
+        for mode in args.modes:
+            for compress in args.compress:
+                for studies in args.studies:
+                    for workers in args.workers:
+                        runs = [run_config(context, directory, url, workers, studies, mode, compress) for _ in range(args.repeat)]
+                        result = min(runs, key=lambda run: run["elapsed"])
+                        results.append(result)
+                        print(f"{result['config']:<45} {result['instances_per_s']:8.1f} instances/s {result['mb_per_s']:8.1f} MB/s "
+                              f"{result['bytes_sent'] / 1e6:8.1f} MB sent {result['bytes_received'] / 1e6:8.1f} MB received p95 {result['latency']['p95'] * 1000:7.1f} ms "
+                              f"{result['peak_rss_mb']:7.0f} MB peak {result['failed_studies']} failed")
+    server.terminate()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression {regression}")
+        if len(regressions) > 0:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
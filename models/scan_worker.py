@@ -0,0 +1,48 @@
+import os
+
+from PySide6.QtCore import QObject, QRunnable, Signal
+
+from scripts import dataset, manifest, validation
+from scripts.metrics import metrics
+
+
+class ScanSignals(QObject):
+    # (generation, {study: [series names]}, casted manifest, ValidationReport)
+    loaded = Signal(int, dict, dict, object)
+    # (generation, study name, series name, file names)
+    scanned = Signal(int, str, str, list)
+
+
+class ScanWorker(QRunnable):
+    """Reads the manifest then lists the files of the series in the background
+
+    generation identifies the model the series belong to, results of an outdated model are ignored by the receiver.
+    """
+
+    def __init__(self, generation : int, directory : str, manifest_path : str):
+        super().__init__()
+        self.generation = generation
+        self.directory = directory
+        self.manifest_path = manifest_path
+        self.signals = ScanSignals()
+        self.canceled = False
+
+    def run(self):
+        studies = {study:dataset.list_entries(os.path.join(self.directory, study)) for study in dataset.list_entries(self.directory, dirs_only=True)}
+        # tags are casted series by series while the manifest is read
+        report = validation.ValidationReport()
+        try:
+            tags_json = manifest.load(self.manifest_path, report)
+        except (OSError, ValueError) as e:
+            metrics.event("manifest_error", path=self.manifest_path, error=str(e))
+            return
+        if self.canceled:
+            return
+        self.signals.loaded.emit(self.generation, studies, tags_json, report)
+        for study, series_list in studies.items():
+            for series in series_list:
+                if self.canceled:
+                    return
+                path = os.path.join(self.directory, study, series)
+                files = dataset.list_entries(path) if os.path.isdir(path) else []
+                self.signals.scanned.emit(self.generation, study, series, files)
@@ -2,8 +2,9 @@
 # SPDX-License-Identifier: LicenseRef-Qt-Commercial OR BSD-3-Clause
 
 from enum import Enum
+from collections import ChainMap
 
-from scripts import tags
+from scripts import dataset
 
 from PySide6.QtGui import (
     QIcon,
@@ -19,15 +20,23 @@ class RequestType(Enum):
     WSI = 3
     
 class TreeItem:
+    # A tree can hold hundreds of thousands of files, no __dict__ per item
+    __slots__ = ("item_data", "is_in_tags", "parent_item", "child_items", "tags_dict", "potential_bad_tags", "type", "options", "fetched", "row")
+    
     def __init__(self, data: list, parent: 'TreeItem' = None, in_tags : Correspondence = Correspondence.NOT_CORRECT, tags_dict = None, potential_bad_tags = None, type : RequestType = RequestType.DEFAULT, options : dict = {}):
         self.item_data = data
         self.is_in_tags = in_tags
         self.parent_item : 'TreeItem' = parent
         self.child_items : list['TreeItem'] = []
         self.tags_dict : dict = tags_dict or dict()
-        self.potential_bad_tags : list = potential_bad_tags or []
+        # shared empty tuple, most of the items don't have any
+        self.potential_bad_tags : tuple = tuple(potential_bad_tags or ())
         self.type : RequestType = type
         self.options : dict = options
+        # False until the children have been listed
+        self.fetched : bool = True
+        # index in parent_item.child_items, kept up to date by the parent
+        self.row : int = 0
 
     def child(self, number: int) -> 'TreeItem':
         if number < 0 or number >= len(self.child_items):
@@ -42,8 +51,12 @@ class TreeItem:
 
     def child_number(self) -> int:
         if self.parent_item:
-            return self.parent_item.child_items.index(self)
+            return self.row
         return 0
+    
+    def _update_rows(self, position : int):
+        for row in range(position, len(self.child_items)):
+            self.child_items[row].row = row
 
     def column_count(self) -> int:
         return len(self.item_data)
@@ -54,13 +67,22 @@ class TreeItem:
         return self.item_data[column]
     
     def set_tags(self, tags_dict : dict):
-        casted_tags = dict()
-        for tag_name, tag_val in tags_dict.items():
-            is_correct, tag_val = tags.check_tag(tag_name, tag_val)
-            if not is_correct:
-                self.potential_bad_tags.append(tag_name)
-            casted_tags[tag_name] = tag_val
-        self.tags_dict = casted_tags
+        self.set_casted_tags(*dataset.cast_tags(tags_dict))
+    
+    def set_casted_tags(self, tags_dict : dict, potential_bad_tags : list = None):
+        # tags already casted by validation.cast_series
+        self.tags_dict = tags_dict
+        if potential_bad_tags:
+            self.potential_bad_tags = (*self.potential_bad_tags, *potential_bad_tags)
+
+    def effective_tags(self) -> ChainMap:
+        # own tags first, then the ones inherited from the series and the study
+        maps = []
+        item = self
+        while item:
+            maps.append(item.tags_dict)
+            item = item.parent_item
+        return ChainMap(*maps)
 
     def set_request_type(self, type : RequestType, options : dict = {}):
         self.type = type
@@ -70,10 +92,8 @@ class TreeItem:
         if position < 0 or position > len(self.child_items):
             return False
 
-        for row in range(count):
-            data = [None] * columns
-            item = TreeItem(data.copy(), self, type=self.type, options=self.options)
-            self.child_items.insert(position, item)
+        self.child_items[position:position] = [TreeItem([None] * columns, self, type=self.type, options=self.options) for row in range(count)]
+        self._update_rows(position)
         return True
 
     def insert_columns(self, position: int, columns: int) -> bool:
@@ -95,8 +115,8 @@ class TreeItem:
         if position < 0 or position + count > len(self.child_items):
             return False
 
-        for row in range(count):
-            self.child_items.pop(position)
+        del self.child_items[position:position + count]
+        self._update_rows(position)
 
         return True
 
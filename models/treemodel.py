@@ -2,17 +2,23 @@
 # SPDX-License-Identifier: LicenseRef-Qt-Commercial OR BSD-3-Clause
 
 
-from PySide6.QtCore import QModelIndex, Qt, QAbstractItemModel, QDir, QFileInfo
+from PySide6.QtCore import QModelIndex, Qt, QAbstractItemModel, QDir, QFileInfo, QThreadPool, QTimer, Signal
 
-from scripts import tags
-import json
+from scripts import tags, scheduler, dataset, manifest, validation
 import os
+import sqlite3
+from collections import deque
 
 from PySide6.QtGui import (
     QIcon,
 )
 
 from models.treeitem import TreeItem, Correspondence, RequestType
+from models.upload_worker import UploadWorker, RollbackWorker
+from models.scan_worker import ScanWorker
+from scripts.journal import open_journal
+from scripts.metrics import metrics
+from scripts.cache import DedupCache
 from GUI.Error_Messages.change_module_value import WrongValue, WrongValueDialog
 from GUI.Error_Messages.not_all_correct import NotAllCorrectDialog
 from GUI.Error_Messages.request_exception import RequestExceptionDialog
@@ -20,20 +26,50 @@ from GUI.Error_Messages.request_exception import RequestExceptionDialog
 
 
 
+# ms between two refreshes of the view during an upload
+REFRESH_RATE = 100
+# identical instances already uploaded from other files are reused, see DedupCache
+DEDUP_CACHE = True
+
 class TreeModel(QAbstractItemModel):
+    # (uploaded instances, total instances)
+    upload_progress = Signal(int, int)
+    upload_finished = Signal()
 
-    def __init__(self, headers: list, directory : QDir=None, parent=None):
+    def __init__(self, headers: list, directory : QDir=None, parent=None, max_workers : int = scheduler.MAX_WORKERS, max_studies : int = scheduler.MAX_STUDIES, dedup_cache : bool = DEDUP_CACHE):
         super().__init__(parent)
+        self.scheduler = scheduler.UploadScheduler(max_workers, max_studies)
+        # the cache is opened by the first upload
+        self.dedup_cache = dedup_cache
+        # directory of the journal of the scheduler, opened by the first upload
+        self.journal_directory = None
 
         self.root_data = headers
         self.root_item = TreeItem(self.root_data.copy())
         
-        print(os.getcwd())
         self.ok = QIcon(f"{os.getcwd()}/images/status.png")
         self.warning = QIcon(f"{os.getcwd()}/images/status-busy.png")
         self.nope = QIcon(f"{os.getcwd()}/images/status-away.png")
         
         self.finished = False
+        self.uploading = False
+        self.thread_pool = QThreadPool(self)
+        self.thread_pool.setMaxThreadCount(1)
+        # filled by the upload threads, emptied by the GUI thread
+        self.uploaded = deque()
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setInterval(REFRESH_RATE)
+        self.refresh_timer.timeout.connect(self.refresh_uploaded)
+        
+        # files of the series are listed lazily, in the background or when the series is expanded
+        self.generation = 0
+        self.scan_worker : ScanWorker = None
+        self.scan_pool = QThreadPool(self)
+        self.scan_pool.setMaxThreadCount(1)
+        self.tags_json = dict()
+        self.report = validation.ValidationReport()
+        # (study, series) -> series item, to find the series scanned in the background
+        self.series_items : dict[tuple[str, str], TreeItem] = dict()
         self.setModel(directory)        
 
     def columnCount(self, parent: QModelIndex = None) -> int:
@@ -147,6 +183,26 @@ class TreeModel(QAbstractItemModel):
         if not rows or len(rows) == 0:
             return
             
+    def hasChildren(self, parent: QModelIndex = QModelIndex()) -> bool:
+        if parent.isValid() and parent.column() > 0:
+            return False
+        parent_item: TreeItem = self.get_item(parent)
+        return not parent_item.fetched or parent_item.child_count() > 0
+    
+    def canFetchMore(self, parent: QModelIndex) -> bool:
+        if not parent.isValid():
+            return False
+        return not self.get_item(parent).fetched
+    
+    def fetchMore(self, parent: QModelIndex):
+        if not parent.isValid():
+            return
+        series_item = self.get_item(parent)
+        if series_item.fetched:
+            return
+        path = self.series_path(series_item)
+        self.insert_files(series_item, dataset.list_entries(path) if os.path.isdir(path) else [])
+    
     def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
         if parent.isValid() and parent.column() > 0:
             return 0
@@ -162,68 +218,128 @@ class TreeModel(QAbstractItemModel):
     def setModel(self, directory : QDir | None):
         # Reset model
         self.reinit()
+        if not self.uploading:
+            # the journal of the previous directory, opened again by the next upload
+            self.close_journal()
         
         self.directory = directory
         if not directory:
             # directory is None so don't update non-existent data
             return
-        json_dir = QDir(directory)
-        json_dir.setFilter(QDir.Filter.Files)
-        json_dir.setNameFilters(["*.json"])
-        
-        list_json = json_dir.entryInfoList()
+        manifest_path = dataset.find_manifest(directory.absolutePath())
         
-        if len(list_json) != 1:
+        if not manifest_path:
             # TODO: send error
             return
         
         self.directory = directory
-        studies = self.directory.entryInfoList(filters=QDir.Filter.Dirs| QDir.Filter.NoDotAndDotDot)
-        
-        series_files = {study.fileName():{series.fileName():[sub for sub in QDir(series.absoluteFilePath()).entryList(filters=QDir.Filter.Dirs | QDir.Filter.Files |QDir.Filter.NoDotAndDotDot)] for series in QDir(study.absoluteFilePath()).entryInfoList(filters=QDir.Filter.Dirs | QDir.Filter.Files |QDir.Filter.NoDotAndDotDot)} for study in studies}
-        
-        tags_file = list_json[0]
-        with open(tags_file.absoluteFilePath(), "+r") as f:
-            tags_json : dict = json.load(f)
-        self.setupModelData(series_files, tags_json, self.root_item)
+        # the manifest is read and the series are listed in the background, see on_loaded and on_scanned
+        self.start_scan(manifest_path)
         
+    def on_loaded(self, generation : int, studies : dict[str, list[str]], tags_json : dict, report : validation.ValidationReport):
+        if generation != self.generation:
+            return
+        self.tags_json = tags_json
+        self.report = report
+        self.setupModelData(studies, self.tags_json, self.root_item)
         
 
-    def setupModelData(self, studies: dict[str, dict[str, set[str]]], tags_dict : dict, root: TreeItem):
+    def setupModelData(self, studies: dict[str, list[str]], tags_dict : dict, root: TreeItem):
+        # Only the studies and the series, their files are inserted by insert_files
         for study in studies.keys() :
             root.insert_children(root.child_count(),1, self.root_item.column_count())
             study_item = root.last_child()
             study_item.set_data(0, study)
             study_present = study in tags_dict
-            study_all_correct = study_present
-            for series in studies[study].keys():
+            if study_present:
+                study_item.set_casted_tags(tags_dict[study][manifest.STUDY_TAGS], self.report.names(study, manifest.STUDY_TAGS, ""))
+            for series in studies[study]:
                 study_item.insert_children(study_item.child_count(),1, self.root_item.column_count())
                 series_item = study_item.last_child()
                 series_item.set_data(0, series)
+                self.series_items[(study, series)] = series_item
+                series_item.fetched = False
                 series_present = False if not study_present else series in tags_dict[study]
                 if series_present:
+                    series_item.set_casted_tags(tags_dict[study][series]["tags"], self.report.names(study, series, ""))
                     type_request = RequestType[tags_dict[study][series]["type"]] if "type" in tags_dict[study][series] else RequestType.DEFAULT
                     options = tags_dict[study][series]["options"] if "options" in tags_dict[study][series] else {}
                     series_item.set_request_type(type_request, options)
-                series_all_correct = series_present
-                for file in studies[study][series]:
-                    series_item.insert_children(series_item.child_count(),1, self.root_item.column_count())
-                    file_item = series_item.last_child()
-                    file_item.set_data(0, file)
-                    file_item.set_in_tags(Correspondence.CORRECT if series_present and file in tags_dict[study][series]["files"] else Correspondence.NOT_PRESENT)
-                    if file_item.is_correct():
-                        file_item.set_tags(tags_dict[study][series]["files"][file]["tags"])
-                    else:
-                        series_all_correct = False
-                
-                series_item.set_in_tags(Correspondence.CORRECT if series_all_correct else Correspondence.NOT_CORRECT if series_present else Correspondence.NOT_PRESENT)
-                if not series_item.is_correct():
-                    study_all_correct = False
-            
-            study_item.set_in_tags(Correspondence.CORRECT if study_all_correct else Correspondence.NOT_CORRECT if study_present else Correspondence.NOT_PRESENT)
+                # not scanned yet
+                series_item.set_in_tags(Correspondence.NOT_PRESENT)
+            self.update_study(study_item)
         self.layoutChanged.emit()
     
+    def series_path(self, series_item : TreeItem) -> str:
+        return os.path.join(self.directory.absolutePath(), series_item.parent().data(0), series_item.data(0))
+    
+    def series_tags(self, series_item : TreeItem) -> dict | None:
+        study_tags = self.tags_json.get(series_item.parent().data(0))
+        if study_tags is None or series_item.data(0) not in study_tags:
+            return None
+        return study_tags[series_item.data(0)]
+    
+    def start_scan(self, manifest_path : str):
+        self.scan_worker = ScanWorker(self.generation, self.directory.absolutePath(), manifest_path)
+        self.scan_worker.signals.loaded.connect(self.on_loaded)
+        self.scan_worker.signals.scanned.connect(self.on_scanned)
+        self.scan_pool.start(self.scan_worker)
+    
+    def on_scanned(self, generation : int, study : str, series : str, files : list[str]):
+        if generation != self.generation:
+            return
+        series_item = self.series_items.get((study, series))
+        if series_item is None or series_item.fetched:
+            return
+        self.insert_files(series_item, files)
+    
+    def insert_files(self, series_item : TreeItem, files : list[str]):
+        # Insert the files of a series and match them with the manifest
+        series_tags = self.series_tags(series_item)
+        series_all_correct = series_tags is not None
+        parent = self.createIndex(series_item.child_number(), 0, series_item)
+        if len(files) > 0:
+            self.beginInsertRows(parent, 0, len(files) - 1)
+            series_item.insert_children(0, len(files), self.root_item.column_count())
+            casted_files = series_tags["files"] if series_tags is not None else {}
+            for file_item, file in zip(series_item.child_items, files):
+                file_item.set_data(0, file)
+                file_item.set_in_tags(Correspondence.CORRECT if file in casted_files else Correspondence.NOT_PRESENT)
+                if file_item.is_correct():
+                    file_item.set_casted_tags(casted_files[file], series_tags["bad_tags"].get(file))
+                else:
+                    series_all_correct = False
+            self.endInsertRows()
+        series_item.fetched = True
+        
+        series_item.set_in_tags(Correspondence.CORRECT if series_all_correct else Correspondence.NOT_CORRECT if series_tags is not None else Correspondence.NOT_PRESENT)
+        self.update_study(series_item.parent())
+        study_item = series_item.parent()
+        self.dataChanged.emit(parent, parent, [Qt.ItemDataRole.DecorationRole])
+        study_index = self.createIndex(study_item.child_number(), 0, study_item)
+        self.dataChanged.emit(study_index, study_index, [Qt.ItemDataRole.DecorationRole])
+    
+    def update_study(self, study_item : TreeItem):
+        if study_item.data(0) not in self.tags_json:
+            study_item.set_in_tags(Correspondence.NOT_PRESENT)
+        elif all(series_item.is_correct() for series_item in study_item.child_items):
+            study_item.set_in_tags(Correspondence.CORRECT)
+        elif any(not series_item.fetched for series_item in study_item.child_items):
+            # still scanning
+            study_item.set_in_tags(Correspondence.NOT_PRESENT)
+        else:
+            study_item.set_in_tags(Correspondence.NOT_CORRECT)
+    
+    def fetch_all(self):
+        for study_item in self.root_item.child_items:
+            for series_item in study_item.child_items:
+                if not series_item.fetched:
+                    self.fetchMore(self.createIndex(series_item.child_number(), 0, series_item))
+    
     def send_requests(self):
+        if self.uploading:
+            return
+        self.fetch_all()
         failed_studies = [study.data(0) for study in self.root_item.child_items if not study.is_correct()]
         if(len(failed_studies) > 0):
             msg_box = NotAllCorrectDialog(failed_studies)
@@ -231,85 +347,156 @@ class TreeModel(QAbstractItemModel):
             if not ret:
                 return
         
-        set_studies = set()
+        studies = []
         for study_item in self.root_item.child_items:
-            try:
-                parent = ""
-                parent_study = ""
-                
-                patient_module = dict()
-                study_module = dict()
-                if not study_item.is_correct():
-                    
-                    continue
-                for series_item in study_item.child_items:
-                    series_module = dict()
-                    print(f"Update Series {study_item.data(0)}/{series_item.data(0)}")
-                    instance_number = 0
-                    for file_item in series_item.child_items:
-                        
-                        wrong_value_tag = [WrongValue(tag, val_module, file_item.tags_dict[tag]) for tag, val_module in patient_module.items() if (tag in file_item.tags_dict and val_module != file_item.tags_dict[tag])]
-                        wrong_value_tag.extend([WrongValue(tag, val_module, file_item.tags_dict[tag]) for tag, val_module in study_module.items() if (tag in file_item.tags_dict and val_module != file_item.tags_dict[tag])])
-                        wrong_value_tag.extend([WrongValue(tag, val_module, file_item.tags_dict[tag]) for tag, val_module in series_module.items() if (tag in file_item.tags_dict and val_module != file_item.tags_dict[tag])])
-                        print(f"------------ File : {file_item.data(0)} : {wrong_value_tag}")
-                        if len(wrong_value_tag) > 0 :
-                            msg_box = WrongValueDialog(wrong_value_tag)
-                            ret = msg_box.exec()
-                            if not ret:
-                                self.delete_all_studies(set_studies)
-                                self.reinit()
-                                return
-                        
-                        
-                        tags_dict = {tag:val for tag, val in file_item.tags_dict.items() if tag not in patient_module and tag not in study_module and tag not in series_module}
-                        
-                        response = tags.send_request(QFileInfo(f"{self.directory.absoluteFilePath(study_item.data(0))}/{series_item.data(0)}/{file_item.data(0)}"), tags_dict, parent, instance_number)
-                        print(response)
-                        parent = response["ParentSeries"]
-                        parent_study = response["ParentStudy"]
-                        instance_id = response["ID"]
-                        set_studies.add(parent_study)
-                        file_item.set_data(1, instance_id)
-                        series_item.set_data(1, parent)
-                        study_item.set_data(1, parent_study)
-                        
-                        patient_module.update({tag:val for tag, val in tags_dict.items() if tag in tags.TAG_PATIENT})
-                        study_module.update({tag:val for tag, val in tags_dict.items() if tag in tags.TAG_STUDY})
-                        series_module.update({tag:val for tag, val in tags_dict.items() if tag in tags.TAG_SERIES})
-                        
-                        instance_number += 1
-                        self.layoutChanged.emit()
-                    parent = parent_study
-                
-                
-            except Exception as e:
-                # TODO error handling if error !
-                msg_box = RequestExceptionDialog(e)
+            if not study_item.is_correct():
+                continue
+            series = [(series_item.data(0), [(QFileInfo(f"{self.directory.absoluteFilePath(study_item.data(0))}/{series_item.data(0)}/{file_item.data(0)}"), file_item.effective_tags(), file_item) for file_item in series_item.child_items], series_item) for series_item in study_item.child_items]
+            study = scheduler.plan_study(study_item.data(0), series, study_item)
+            
+            # Check consistency with the parent modules before anything is uploaded
+            for instance in study.conflicts():
+                wrong_value_tag = [WrongValue(*conflict) for conflict in instance.conflicts]
+                metrics.event("conflict", file=instance.item.data(0), conflicts=[[str(val) for val in conflict] for conflict in instance.conflicts])
+                msg_box = WrongValueDialog(wrong_value_tag)
                 ret = msg_box.exec()
                 if not ret:
-                    self.delete_all_studies(set_studies)
                     self.reinit()
                     return
-                else:
-                    # only delete the study
-                    if parent_study:
-                        tags.delete_studies(parent_study)
-                
+            studies.append(study)
         
-        #self.reinit()
+        if len(studies) == 0:
+            return
         
-            
+        # resume what a previous run has already uploaded, the journal is only created once something is uploaded
+        self.open_journal()
+        self.open_cache()
+        self.uploading = True
+        self.upload_total = sum(len(series.instances) for study in studies for series in study.series)
+        self.upload_done = 0
+        self.upload_progress.emit(self.upload_done, self.upload_total)
+        
+        worker = UploadWorker(self.scheduler, studies, lambda study, series, instance: self.uploaded.append((study, series, instance)))
+        worker.signals.finished.connect(self.end_requests)
+        self.refresh_timer.start()
+        self.thread_pool.start(worker)
+    
+    def refresh_uploaded(self):
+        # Coalesce the instances uploaded since the last refresh : one dataChanged per parent
+        touched = dict()
+        while self.uploaded:
+            study, series, instance = self.uploaded.popleft()
+            self.upload_done += 1
+            if study.item.parent() is not self.root_item:
+                # the model has been reset during the upload
+                continue
+            for job in (study, series, instance):
+                job.item.set_data(1, job.id)
+                row = job.item.child_number()
+                rows = touched.setdefault(id(job.item.parent()), [job.item.parent(), row, row])
+                rows[1] = min(rows[1], row)
+                rows[2] = max(rows[2], row)
+        
+        for parent_item, first, last in touched.values():
+            parent = QModelIndex() if parent_item is self.root_item else self.createIndex(parent_item.child_number(), 0, parent_item)
+            self.dataChanged.emit(self.index(first, 1, parent), self.index(last, 1, parent), [Qt.ItemDataRole.DisplayRole])
+        self.upload_progress.emit(self.upload_done, self.upload_total)
+    
+    def end_requests(self, studies : list[scheduler.StudyJob]):
+        self.refresh_timer.stop()
+        self.refresh_uploaded()
+        
+        failed = []
+        for study in studies:
+            if not study.error:
+                continue
+            # TODO error handling if error !
+            msg_box = RequestExceptionDialog(study.error)
+            ret = msg_box.exec()
+            if not ret:
+                # delete everything
+                self.start_rollback(studies, True)
+                return
+            else:
+                # only delete the study
+                failed.append(study)
+        if len(failed) > 0:
+            self.start_rollback(failed, False)
+            return
+        self.uploading = False
+        self.upload_finished.emit()
+        
+        #self.reinit()
+    
+    def start_rollback(self, studies : list[scheduler.StudyJob], reset : bool):
+        # still uploading for the view until the deletes end
+        self.reset_after_rollback = reset
+        worker = RollbackWorker(self.scheduler, studies)
+        worker.signals.finished.connect(self.end_rollback)
+        self.thread_pool.start(worker)
+    
+    def end_rollback(self, report):
+        reset = self.reset_after_rollback
+        self.uploading = False
+        self.upload_finished.emit()
+        if not report.is_complete():
+            msg_box = RequestExceptionDialog(f"{len(report.failed)} resources could not be deleted from Orthanc", failed=report.failed)
+            msg_box.exec()
+        if reset:
+            self.reinit()
+    
+    def open_journal(self):
+        directory = self.directory.absolutePath()
+        journal = self.scheduler.journal
+        if journal is not None and self.journal_directory == directory:
+            return
+        self.close_journal()
+        self.scheduler.journal = open_journal(directory, tags.client.url)
+        self.journal_directory = directory
+    
+    def close_journal(self):
+        if self.scheduler.journal is not None:
+            self.scheduler.journal.close()
+        self.scheduler.journal = None
+        self.journal_directory = None
+    
+    def set_raw_dicom(self, enabled : bool):
+        # read by the handlers when a file is sent, the next upload uses it
+        tags.RAW_DICOM = enabled
+    
+    def set_dedup_cache(self, enabled : bool):
+        self.dedup_cache = enabled
+        if not enabled and not self.uploading:
+            self.close_cache()
+    
+    def open_cache(self):
+        if not self.dedup_cache:
+            self.close_cache()
+        elif self.scheduler.cache is None:
+            try:
+                self.scheduler.cache = DedupCache(server=tags.client.url)
+            except (OSError, sqlite3.OperationalError):
+                # uploaded without it
+                self.scheduler.cache = None
+    
+    def close_cache(self):
+        if self.scheduler.cache is not None:
+            self.scheduler.cache.close()
+        self.scheduler.cache = None
     
     def reinit(self):
         # REINIT MODEL
         self.directory = None
+        self.generation += 1
+        if self.scan_worker:
+            self.scan_worker.canceled = True
+            self.scan_worker = None
+        self.tags_json = dict()
+        self.report = validation.ValidationReport()
+        self.series_items = dict()
         self.root_item = TreeItem(self.root_data.copy())
         self.layoutChanged.emit()
     
-    def delete_all_studies(self, list_studies : list[str]):
-        for study in list_studies:
-            tags.delete_studies(study)
-                
     def _repr_recursion(self, item: TreeItem, indent: int = 0) -> str:
         result = " " * indent + repr(item) + "\n"
         for child in item.child_items:
@@ -0,0 +1,55 @@
+from PySide6.QtCore import QObject, QRunnable, Signal
+
+from scripts import scheduler
+from scripts.rollback import RollbackReport
+
+
+class UploadSignals(QObject):
+    # list of the uploaded StudyJob
+    finished = Signal(list)
+
+
+class RollbackSignals(QObject):
+    # RollbackReport
+    finished = Signal(object)
+
+
+class UploadWorker(QRunnable):
+    """Runs an UploadScheduler outside of the GUI thread
+
+    callback is called from the upload threads for every uploaded instance, it must be thread safe.
+    """
+
+    def __init__(self, upload_scheduler : scheduler.UploadScheduler, studies : list[scheduler.StudyJob], callback = None):
+        super().__init__()
+        self.scheduler = upload_scheduler
+        self.studies = studies
+        self.callback = callback
+        self.signals = UploadSignals()
+
+    def run(self):
+        try:
+            self.scheduler.run(self.studies, self.callback)
+        finally:
+            self.signals.finished.emit(self.studies)
+
+
+
+class RollbackWorker(QRunnable):
+    """Deletes from Orthanc what the upload of studies has created, outside of the GUI thread"""
+
+    def __init__(self, upload_scheduler : scheduler.UploadScheduler, studies : list[scheduler.StudyJob]):
+        super().__init__()
+        self.scheduler = upload_scheduler
+        self.studies = studies
+        self.signals = RollbackSignals()
+
+    def run(self):
+        report = RollbackReport()
+        try:
+            report = self.scheduler.rollback(self.studies)
+        except Exception as e:
+            # nothing could be deleted
+            report.failed = [(level, id, str(e)) for study in self.studies for level, id in study.created_resources()]
+        finally:
+            self.signals.finished.emit(report)
@@ -0,0 +1,211 @@
+# Canathist Automizer Tags 2023
+
+# Copyright (C) 2023 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU General Public License as
+
+# published by the Free Software Foundation, either version 3 of the
+
+# License, or (at your option) any later version.
+
+# 
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU General Public License
+
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import requests
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from .client import OrthancClient, observe_request, _SentBody
+from .retry import is_transient
+from .metrics import metrics
+
+# Number of requests in flight at the same time
+MAX_IN_FLIGHT = 64
+# bytes of the body written at once
+BUFFER_SIZE = 256 * 1024
+
+
+async def _aiter(chunks, buffer_size : int = BUFFER_SIZE):
+    # httpx.AsyncClient only streams async iterables. The small pieces of the JSON are sent along with the
+    # base64 chunks, each write to the connection costs a turn of the event loop
+    if isinstance(chunks, (bytearray, memoryview)):
+        # a buffered body is written by slices of itself, without a copy
+        view = memoryview(chunks)
+        for offset in range(0, len(view), buffer_size):
+            yield view[offset:offset + buffer_size]
+        return
+    buffer = []
+    size = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= buffer_size:
+            yield b"".join(buffer)
+            buffer.clear()
+            size = 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def _build(data):
+    body = data()
+    # a function giving a generator, which can only be sent once
+    return body() if callable(body) else body
+
+def _next_body(bodies : list, data):
+    return bodies.pop() if bodies else _build(data)
+
+def _transport_error(error : Exception) -> requests.exceptions.RequestException:
+    """The requests exception the sync client raises for an httpx.TransportError, for is_transient and the callers"""
+    # the most specific first, PoolTimeout means the request has never been sent
+    for httpx_type, requests_type in ((httpx.ConnectTimeout, requests.exceptions.ConnectTimeout),
+                                      (httpx.PoolTimeout, requests.exceptions.ConnectTimeout),
+                                      (httpx.ReadTimeout, requests.exceptions.ReadTimeout),
+                                      (httpx.TimeoutException, requests.exceptions.Timeout),
+                                      (httpx.ProxyError, requests.exceptions.ProxyError),
+                                      (httpx.UnsupportedProtocol, requests.exceptions.InvalidSchema)):
+        if isinstance(error, httpx_type):
+            break
+    else:
+        # ConnectError, ReadError, WriteError, CloseError and the protocol errors
+        requests_type = requests.exceptions.ConnectionError
+    mapped = requests_type(str(error) or type(error).__name__)
+    mapped.__cause__ = error
+    return mapped
+
+
+class AsyncOrthancClient:
+    """asyncio client for the Orthanc REST API, with the settings of an OrthancClient
+
+    Uses httpx when it is installed : one connection pool of max_in_flight connections and no thread per
+    request. Without it, the requests of the OrthancClient are run in threads with at most max_in_flight
+    of them at a time. Either way the retries, rate limit, adaptive concurrency, compression and metrics
+    of the OrthancClient apply.
+    Error statuses raise requests.exceptions.HTTPError in both cases, with a response having
+    status_code and json(), and the connection errors and timeouts the requests exceptions of the sync client.
+    Must be created and closed inside the running event loop.
+    """
+
+    def __init__(self, client : OrthancClient, max_in_flight : int = MAX_IN_FLIGHT) -> None:
+        self.client = client
+        self.url = client.url
+        self.max_in_flight = max_in_flight
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.session = None
+        self.executor = None
+        if httpx is not None:
+            auth = client.session.auth
+            connect, read = client.timeout if isinstance(client.timeout, tuple) else (client.timeout, client.timeout)
+            self.session = httpx.AsyncClient(
+                base_url=client.url,
+                auth=(auth.username, auth.password) if auth else None,
+                timeout=httpx.Timeout(read, connect=connect),
+                limits=httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight),
+            )
+        else:
+            client.set_pool_size(max_in_flight)
+            self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+    async def request(self, method : str, path : str, data = None, **kwargs):
+        """Send a request, raise requests.exceptions.HTTPError on an error status
+
+        Args:
+            data: body of the request, or a function building it. The function is called in a thread once
+                the request has its slot, so at most max_in_flight bodies are in memory, and again for every
+                attempt. It may return a function giving a generator (see tags.dicom_body), or None to send
+                nothing : the request then returns None.
+        """
+        async with self.semaphore:
+            if callable(data):
+                body = await asyncio.to_thread(_build, data)
+                if body is None:
+                    return None
+                # the body of the first attempt, built again for the next ones
+                bodies = [body]
+                data = partial(_next_body, bodies, data)
+            if self.session is None:
+                return await asyncio.get_running_loop().run_in_executor(self.executor, partial(self.client.request, method, path, data=data, **kwargs))
+            return await self._request(method, path, data, **kwargs)
+
+    async def _request(self, method : str, path : str, data, **kwargs):
+        # same retries, rate limit, adaptive concurrency and metrics as OrthancClient.request
+        client = self.client
+        retry = client.retry
+        attempt = 0
+        while True:
+            if client.bucket:
+                await client.bucket.acquire_async()
+            async with client.limiter:
+                body = (await asyncio.to_thread(data)) if callable(data) else data
+                body, headers = client.compress(path, body, kwargs.get("headers"))
+                if isinstance(body, (bytearray, memoryview)):
+                    headers = {**(headers or {}), "Content-Length": str(len(body))}
+                if body is not None and not isinstance(body, (str, bytes, bytearray, memoryview)):
+                    body = _SentBody(body)
+                content = body if body is None or isinstance(body, (str, bytes)) else _aiter(body)
+                start = time.perf_counter()
+                try:
+                    r = await self.session.request(method, f"/{path.lstrip('/')}", content=content, **{**kwargs, "headers": headers})
+                except httpx.TransportError as e:
+                    metrics.add("request_errors")
+                    error = _transport_error(e)
+                    transient = is_transient(error, method)
+                else:
+                    observe_request(method, path, body, r.status_code, start, time.perf_counter(), attempt, len(r.content), r.elapsed.total_seconds())
+                    if r.status_code < 400:
+                        client.limiter.increase()
+                        return r
+                    metrics.add("request_errors")
+                    error = requests.exceptions.HTTPError(f"{r.status_code} Error for url: {r.url}", response=r)
+                    transient = is_transient(error, method)
+                if not transient:
+                    raise error
+                client.limiter.decrease()
+            attempt += 1
+            if retry is None or attempt >= retry.max_attempts:
+                raise error
+            metrics.add("retries")
+            delay = retry.delay(attempt - 1)
+            metrics.event("retry", method=method, path=path, error=str(error), attempt=attempt + 1, delay=delay)
+            await asyncio.sleep(delay)
+
+    async def get(self, path : str, **kwargs):
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path : str, **kwargs):
+        return await self.request("POST", path, **kwargs)
+
+    async def delete(self, path : str, **kwargs):
+        return await self.request("DELETE", path, **kwargs)
+
+    async def aclose(self):
+        if self.session is not None:
+            await self.session.aclose()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
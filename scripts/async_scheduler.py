@@ -0,0 +1,126 @@
+# Canathist Automizer Tags 2023
+
+# Copyright (C) 2023 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU General Public License as
+
+# published by the Free Software Foundation, either version 3 of the
+
+# License, or (at your option) any later version.
+
+# 
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU General Public License
+
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+
+from . import tags
+from . import async_tags
+from .async_client import AsyncOrthancClient, MAX_IN_FLIGHT
+from .scheduler import UploadScheduler, StudyJob, SeriesJob, InstanceJob, MAX_STUDIES
+from .metrics import metrics
+
+
+class AsyncUploadScheduler(UploadScheduler):
+    """UploadScheduler keeping up to max_in_flight uploads in flight from one thread
+
+    Same order as UploadScheduler : the first instance of a study creates it, then the first instance of
+    every other series, then every other instance once its series exists. Each of them is a task
+    waiting on a semaphore instead of a thread, and at most max_in_flight of them exist per study at a time.
+    The journal and the cache are still read and written from threads, they are local.
+    """
+
+    def __init__(self, max_in_flight : int = MAX_IN_FLIGHT, max_studies : int = MAX_STUDIES, journal = None, cache = None) -> None:
+        super().__init__(max_in_flight, max_studies, journal, cache)
+        self.max_in_flight = max_in_flight
+
+    def run(self, studies : list[StudyJob], callback = None) -> list[StudyJob]:
+        """Upload the studies in a new event loop, see run_async"""
+        return asyncio.run(self.run_async(studies, callback))
+
+    async def run_async(self, studies : list[StudyJob], callback = None) -> list[StudyJob]:
+        """Upload the studies and return them with their ids and errors filled in
+
+        Args:
+            studies (list[StudyJob]): planned studies
+            callback: called with (study, series, instance) from the event loop once an instance is uploaded
+        """
+        self.callback = callback
+        async_tags.set_client(AsyncOrthancClient(tags.client, self.max_in_flight))
+        try:
+            await asyncio.to_thread(self._prefetch, studies)
+            study_semaphore = asyncio.Semaphore(self.max_studies)
+            await asyncio.gather(*(self._run_study_async(study, study_semaphore) for study in studies))
+        finally:
+            await async_tags.client.aclose()
+            async_tags.set_client(None)
+        return studies
+
+    async def _send_async(self, study : StudyJob, series : SeriesJob, instance : InstanceJob, parent : str) -> dict:
+        response, state = (await asyncio.to_thread(self._prepare, study, series, instance, parent)) if self.journal or self.cache else self._prepare(study, series, instance, parent)
+        if response is None:
+            with metrics.timer("upload", study=study.name, series=series.name):
+                response = await async_tags.send_request(instance.file, self._request_tags(series, instance, parent), parent, instance.instance_number,
+                                                         in_series=parent == series.id)
+        self._finish(study, series, instance, parent, response, state)
+        return response
+
+    async def _wait_async(self, coroutines):
+        # at most max_in_flight tasks at a time, the next coroutines are only started as they end
+        pending = set()
+        error = None
+        for coroutine in coroutines:
+            if len(pending) >= self.max_in_flight:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                error = next((task.exception() for task in done if not task.cancelled() and task.exception()), None)
+                if error:
+                    coroutine.close()
+                    break
+            pending.add(asyncio.ensure_future(coroutine))
+        if error is None and len(pending) > 0:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_EXCEPTION)
+            error = next((task.exception() for task in done if not task.cancelled() and task.exception()), None)
+        for task in pending:
+            task.cancel()
+        if len(pending) > 0:
+            await asyncio.wait(pending)
+        if error:
+            # the first error
+            raise error
+
+    async def _run_study_async(self, study : StudyJob, study_semaphore : asyncio.Semaphore):
+        series_list = [series for series in study.series if len(series.instances) > 0]
+        if len(series_list) == 0:
+            return
+        async with study_semaphore:
+            metrics.event("study", study=study.name)
+            try:
+                await asyncio.to_thread(self._resume_study, study)
+
+                # creates the patient and the study, unless they are resumed
+                first = series_list[0]
+                await self._send_async(study, first, first.instances[0], first.id or study.id or "")
+
+                # creates the other series inside the study
+                await self._wait_async(self._send_async(study, series, series.instances[0], series.id or study.id) for series in series_list[1:])
+
+                await self._wait_async(self._send_async(study, series, instance, series.id) for series in series_list for instance in series.instances[1:])
+            except Exception as e:
+                study.error = e
@@ -0,0 +1,186 @@
+# Canathist Automizer Tags 2023
+
+# Copyright (C) 2023 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU General Public License as
+
+# published by the Free Software Foundation, either version 3 of the
+
+# License, or (at your option) any later version.
+
+# 
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU General Public License
+
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import contextlib
+
+import requests
+
+from . import tags
+from . import types
+from .async_client import AsyncOrthancClient
+from .tags import OrthancRequestError, to_path, lookups
+from .metrics import metrics
+
+# set by the caller inside its event loop, see AsyncOrthancClient
+client : AsyncOrthancClient = None
+
+# handler name -> semaphore of its concurrency hint, for the event loop of the client
+slots : dict[str, asyncio.Semaphore] = {}
+
+def set_client(async_client : AsyncOrthancClient):
+    """Replace the client used by every request of this module"""
+    global client
+    client = async_client
+    slots.clear()
+
+def limit(handler : types.FileHandler):
+    """Async context manager holding one of the concurrency slots of the handler"""
+    if not handler.concurrency:
+        return contextlib.nullcontext()
+    if handler.name not in slots:
+        slots[handler.name] = asyncio.Semaphore(handler.concurrency)
+    return slots[handler.name]
+
+async def get_json(path : str):
+    """Answer of a GET request, from the lookup cache of tags if it has been fetched recently. Don't modify it"""
+    value = lookups.cached(path)
+    if value is not None:
+        return value
+    r = await client.get(path)
+    value = r.json()
+    lookups.put(path, value)
+    return value
+
+async def send_request(file, tags_dict : dict, parent : str, instance_number : int = 1, streamed : bool = None, in_series : bool = None) -> dict:
+    """Same as tags.send_request"""
+    file = to_path(file)
+    streamed = tags.STREAM_UPLOAD if streamed is None else streamed
+    if(not file.exists()):
+        raise OrthancRequestError("File doesn't exists", "Bad Request", {'HttpStatus': 400, 'Details': "File doesn't exists"}, file.name)
+    try:
+        tags_dict["InstanceNumber"] = f"{instance_number}"
+        for handler in types.get_handlers(str(file)):
+            async with limit(handler):
+                if handler.send_async:
+                    response_json = await handler.send_async(file, tags_dict, parent, streamed, in_series)
+                else:
+                    response_json = await asyncio.to_thread(handler.send, file, tags_dict, parent, streamed, in_series)
+            if response_json is not None:
+                return response_json
+        return None
+    except requests.exceptions.HTTPError as e:
+        raise tags.request_error(e, file.name)
+
+async def create_nexus(file, tags_dict : dict, parent : str, streamed : bool = tags.STREAM_UPLOAD, in_series : bool = None) -> dict:
+    # built in a thread once the request has its slot
+    r = await client.post(types.FileAPI.NEXUS.value, data=lambda: tags.nexus_body(file, tags_dict, parent, streamed))
+    response_json = r.json()
+    tags.invalidate_added(lookups, parent, response_json)
+    return response_json
+
+async def parent_modules(parent : str, in_series : bool = None) -> tuple[list[dict], bool]:
+    """Same as tags.parent_modules"""
+    if not parent:
+        return [], False
+    value = tags.inherited.cached(parent)
+    if value is None:
+        if in_series is None:
+            in_series = await resource_exists("series", parent)
+        study = (await get_json(f'series/{parent}'))["ParentStudy"] if in_series else parent
+        patient = (await get_json(f'studies/{study}'))["ParentPatient"]
+        modules = [await get_patient_module(patient), await get_study_module(study)]
+        if in_series:
+            modules.append(await get_series_module(parent))
+        value = {"ID": parent, "ParentStudy": study, "ParentPatient": patient, "Modules": modules, "InSeries": in_series}
+        tags.inherited.put(parent, value)
+    return value["Modules"], value["InSeries"]
+
+async def store_instance(file, tags_dict : dict, parent : str, streamed : bool = tags.STREAM_UPLOAD, in_series : bool = None) -> dict | None:
+    modules, in_series = await parent_modules(parent, in_series)
+    tags_dict = tags.instance_tags(tags_dict, parent, modules, in_series)
+    r = await client.post(types.FileAPI.INSTANCES.value, data=lambda: tags.instance_body(file, tags_dict, streamed),
+                          headers={"Content-Type": "application/dicom"})
+    if r is None:
+        # the tags can't be added to the header only
+        return None
+    response_json = r.json()
+    tags.invalidate_added(lookups, parent, response_json)
+    error = tags.wrong_parent(response_json, parent, in_series, file)
+    if error:
+        await delete_instance(response_json["ID"])
+        raise error
+    tags.inherit(response_json, parent, tags_dict)
+    return response_json
+
+async def create_dicom(file, tags_dict : dict, parent : str, streamed : bool = tags.STREAM_UPLOAD, in_series : bool = None) -> dict:
+    r = await client.post(types.FileAPI.DICOM.value, data=lambda: tags.dicom_body(file, tags_dict, parent, streamed))
+    if r is None:
+        # an empty folder
+        return None
+    response_json = r.json()
+    tags.invalidate_added(lookups, parent, response_json)
+    if to_path(file).is_dir():
+        tags.set_parents(response_json, await get_parent_study(response_json["ID"]))
+    return response_json
+
+# the asyncio versions of the handlers of tags
+for name, send_async in (("nexus", create_nexus), ("dicom", store_instance), ("create-dicom", create_dicom)):
+    types.handlers[name].send_async = send_async
+
+async def get_parent_study(id : str):
+    return await get_json(f'series/{id}/study')
+
+async def get_patient_module(id : str):
+    return {info['Name']:info["Value"] for tag, info in (await get_json(f'patients/{id}/module')).items()}
+
+async def get_study_module(id : str):
+    return {info['Name']:info["Value"] for tag, info in (await get_json(f'studies/{id}/module')).items()}
+
+async def get_series_module(id : str):
+    return {info['Name']:info["Value"] for tag, info in (await get_json(f'series/{id}/module')).items()}
+
+async def resource_exists(level : str, id : str) -> bool:
+    try:
+        await get_json(f'{level}/{id}')
+    except requests.exceptions.HTTPError as e:
+        if e.response.status_code == 404:
+            return False
+        raise
+    return True
+
+async def delete_instance(id : str):
+    metrics.event("delete", level="instances", id=id)
+    r = await client.delete(f'instances/{id}')
+    tags.forget(id)
+    return r.json()
+
+async def delete_series(id : str):
+    metrics.event("delete", level="series", id=id)
+    r = await client.delete(f'series/{id}')
+    tags.forget(id)
+    return r.json()
+
+async def delete_studies(id : str):
+    metrics.event("delete", level="studies", id=id)
+    r = await client.delete(f'studies/{id}')
+    tags.forget(id)
+    return r.json()
@@ -0,0 +1,222 @@
+# Canathist Automizer Tags 2023
+
+# Copyright (C) 2023 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU General Public License as
+
+# published by the Free Software Foundation, either version 3 of the
+
+# License, or (at your option) any later version.
+
+# 
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU General Public License
+
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from .journal import forget_resources, hash_file
+
+MAX_ENTRIES = 1_000_000
+# total size of the files the cached instances have been created from
+MAX_BYTES = 1 << 40
+# evict once every EVICT_EVERY records
+EVICT_EVERY = 1000
+# lookups of Orthanc resources, in seconds and entries
+LOOKUP_TTL = 60
+LOOKUP_ENTRIES = 4096
+
+
+def default_path() -> str:
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_dir, "dicomizer", "cache.sqlite")
+
+
+class DedupCache:
+    """Content-addressed cache of the uploaded instances
+
+    Maps (content of the file, tags, parent) to the Orthanc instance created from them, whatever the name
+    or the location of the file, so identical data isn't encoded and sent again.
+    The hash of a file is only computed again when its size or modification time changed.
+    The least recently used instances are evicted past max_entries instances or max_bytes of files.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, path : str = None, max_entries : int = MAX_ENTRIES, max_bytes : int = MAX_BYTES, server : str = "") -> None:
+        self.path = path or default_path()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.server = server
+        self.lock = threading.Lock()
+        self.records = 0
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT)""")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS instances (
+                key TEXT PRIMARY KEY, server TEXT, instance_id TEXT, series_id TEXT, study_id TEXT, size INTEGER, used REAL)""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS instances_used ON instances (used)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS instances_study_id ON instances (study_id)")
+
+    def _file_hash(self, path : str) -> tuple[str, int]:
+        stat = os.stat(path)
+        with self.lock:
+            row = self.connection.execute("SELECT size, mtime_ns, hash FROM files WHERE path=?", (path,)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            # fast path, unchanged since it has been hashed
+            return row[2], stat.st_size
+        file_hash = hash_file(path)
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (path, stat.st_size, stat.st_mtime_ns, file_hash))
+        return file_hash, stat.st_size
+
+    def content_hash(self, path : str) -> tuple[str, int]:
+        """(hash, size) of a file, or of every file of a directory"""
+        path = os.path.abspath(path)
+        if not os.path.isdir(path):
+            return self._file_hash(path)
+        h = hashlib.blake2b(digest_size=20)
+        size = 0
+        for name in sorted(os.listdir(path)):
+            file_hash, file_size = self._file_hash(os.path.join(path, name))
+            h.update(name.encode('utf-8'))
+            h.update(file_hash.encode('utf-8'))
+            size += file_size
+        return h.hexdigest(), size
+
+    def key(self, content : str, tags : dict, parent : str) -> str:
+        h = hashlib.blake2b(digest_size=20)
+        h.update(content.encode('utf-8'))
+        h.update(json.dumps({tag:str(val) for tag, val in tags.items()}, sort_keys=True).encode('utf-8'))
+        h.update(parent.encode('utf-8'))
+        return h.hexdigest()
+
+    def lookup(self, key : str) -> tuple[str, str, str] | None:
+        """(instance id, series id, study id) created from the same content, tags and parent"""
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT instance_id, series_id, study_id FROM instances WHERE key=? AND server=?", (key, self.server)).fetchone()
+            if row:
+                self.connection.execute("UPDATE instances SET used=? WHERE key=?", (time.time(), key))
+        return row
+
+    def record(self, key : str, size : int, instance_id : str, series_id : str, study_id : str):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (key, self.server, instance_id, series_id, study_id, size, time.time()))
+            self.records += 1
+            evict = self.records % EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def forget(self, key : str):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM instances WHERE key=?", (key,))
+
+    def forget_resources(self, ids : list[str]):
+        """The studies, series or instances have been deleted from Orthanc"""
+        with self.lock, self.connection:
+            forget_resources(self.connection, self.server, ids)
+
+    def evict(self):
+        """Remove the least recently used instances until the cache fits in its limits"""
+        with self.lock, self.connection:
+            count, total = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM instances").fetchone()
+            if count <= self.max_entries and total <= self.max_bytes:
+                return
+            to_remove = 0
+            for (size,) in self.connection.execute("SELECT size FROM instances ORDER BY used"):
+                if count - to_remove <= self.max_entries and total <= self.max_bytes:
+                    break
+                to_remove += 1
+                total -= size
+            self.connection.execute("DELETE FROM instances WHERE key IN (SELECT key FROM instances ORDER BY used LIMIT ?)", (to_remove,))
+            # forget the hashes of the files that haven't been seen for the longest time as well
+            self.connection.execute("DELETE FROM files WHERE rowid IN (SELECT rowid FROM files ORDER BY rowid LIMIT MAX(0, (SELECT COUNT(*) FROM files) - ?))", (self.max_entries,))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class LookupCache:
+    """In-memory cache of the answers of the Orthanc API, by path
+
+    Entries expire after ttl seconds, the least recently used ones are dropped past max_entries.
+    Our own writes and deletes call invalidate so what this program changed is never served stale.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, ttl : float = LOOKUP_TTL, max_entries : int = LOOKUP_ENTRIES) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # path -> (expiry, value)
+        self.entries : OrderedDict[str, tuple[float, object]] = OrderedDict()
+
+    def cached(self, path : str):
+        """Cached value of path, None when missing or expired"""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry[0] > now:
+                self.entries.move_to_end(path)
+                return entry[1]
+        return None
+
+    def get(self, path : str, load):
+        """Cached value of path, load(path) when missing or expired"""
+        value = self.cached(path)
+        if value is None:
+            value = load(path)
+            self.put(path, value)
+        return value
+
+    def put(self, path : str, value):
+        with self.lock:
+            self.entries[path] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, *ids : str):
+        """Drop every entry of the resources and every entry referring to them"""
+        ids = set(id for id in ids if id)
+        if len(ids) == 0:
+            return
+        with self.lock:
+            for path in [path for path, (_, value) in self.entries.items() if self._refers(path, value, ids)]:
+                del self.entries[path]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    @staticmethod
+    def _refers(path : str, value, ids : set) -> bool:
+        if any(part in ids for part in path.split("/")):
+            return True
+        return isinstance(value, dict) and any(value.get(key) in ids for key in ("ID", "ParentPatient", "ParentStudy", "ParentSeries"))
@@ -0,0 +1,202 @@
+# Canathist Automizer Tags 2023
+
+# Copyright (C) 2023 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU General Public License as
+
+# published by the Free Software Foundation, either version 3 of the
+
+# License, or (at your option) any later version.
+
+# 
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU General Public License
+
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Headless dicomization of a dataset directory
+
+    python -m scripts.cli DIRECTORY [MANIFEST] [options]
+
+Does the same study/series/instance upload as the GUI, the questions of the dialogs are answered by
+the --incomplete, --on-conflict and --on-error policies. A JSON summary is written on stdout (or --summary),
+the logs go to stderr.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+
+from . import dataset, manifest, plan, scheduler, tags, types, validation
+from .client import OrthancClient, URL
+from .compression import ENCODINGS, available
+from .journal import Journal, JOURNAL_NAME
+from .cache import DedupCache, default_path
+from .retry import RetryPolicy, MAX_ATTEMPTS
+from .metrics import metrics
+
+
+def parse_args(argv : list[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m scripts.cli", description="Dicomize a dataset directory described by a JSON manifest")
+    parser.add_argument("directory", help="directory containing Study/Series/files")
+    parser.add_argument("manifest", nargs="?", help="JSON manifest, defaults to the only .json file of the directory")
+    parser.add_argument("--url", default=URL, help="Orthanc URL")
+    parser.add_argument("--user", default="orthanc")
+    parser.add_argument("--password", default="orthanc")
+    parser.add_argument("--workers", type=int, default=scheduler.MAX_WORKERS, help="instances uploaded at the same time")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="upload from one thread with asyncio (httpx if installed), --workers is then the number of requests in flight")
+    parser.add_argument("--studies", type=int, default=scheduler.MAX_STUDIES, help="studies uploaded at the same time")
+    parser.add_argument("--attempts", type=int, default=MAX_ATTEMPTS, help="times a request failing with a transient Orthanc error is sent")
+    parser.add_argument("--rate", type=float, help="max requests per second sent to Orthanc")
+    parser.add_argument("--compress", choices=ENCODINGS, help="compress the bodies of the uploads, gzip and deflate are decompressed by Orthanc")
+    parser.add_argument("--compress-api", nargs="+", choices=[api.name.lower() for api in types.FileAPI],
+                        default=sorted(set(handler.api.name.lower() for handler in types.handlers.values() if handler.encoding == "base64")),
+                        help="uploads compressed with --compress : base64 JSON to tools/create-dicom, stl/create-nexus or DICOM files to /instances")
+    parser.add_argument("--raw-dicom", action="store_true",
+                        help="send the files that are already DICOM as they are to /instances, with the tags added to their header, instead of in base64 to tools/create-dicom")
+    parser.add_argument("--incomplete", choices=["skip", "abort"], default="skip",
+                        help="studies not fully described by the manifest : skip them or upload nothing")
+    parser.add_argument("--on-conflict", choices=["module", "skip", "abort"], default="abort",
+                        help="tag different from its parent module : keep the module value, skip the study or upload nothing")
+    parser.add_argument("--on-error", choices=["keep", "continue", "rollback"], default="keep",
+                        help="failed study : keep what has been uploaded to resume it later, delete what this run created for it, or for every study")
+    parser.add_argument("--journal", help=f"journal of the uploaded instances used to resume, defaults to {JOURNAL_NAME} in the directory")
+    parser.add_argument("--no-journal", action="store_true", help="upload everything again, don't record anything")
+    parser.add_argument("--cache", help=f"cache of the instances created from the same content and tags, defaults to {default_path()}")
+    parser.add_argument("--no-cache", action="store_true", help="don't reuse identical instances uploaded from other files")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="upload nothing, write the plan of every study and all the conflicts instead")
+    parser.add_argument("--headers", action="store_true", help="with --dry-run, compare the tags with the header of the files that are already DICOM")
+    parser.add_argument("--summary", default="-", help="file where the JSON summary is written, - for stdout")
+    parser.add_argument("--metrics", help="file where the timing of every stage is written as JSON lines")
+    parser.add_argument("--prometheus", type=int, metavar="PORT", help="serve the metrics on http://127.0.0.1:PORT/metrics during the run")
+    args = parser.parse_args(argv)
+    if args.compress and not available(args.compress):
+        parser.error(f"{args.compress} compression needs the zstandard package")
+    return args
+
+def study_summary(study : scheduler.StudyJob, status : str, deleted : bool = False) -> dict:
+    return {
+        "name": study.name,
+        "id": study.id,
+        "status": status,
+        "deleted": deleted,
+        "instances": sum(1 for instance in study.instances() if instance.id),
+        "resumed": sum(1 for instance in study.instances() if instance.resumed),
+        "conflicts": [{"file": str(instance.file), "tag": tag, "module": str(module_val), "value": str(val)} for instance in study.conflicts() for tag, module_val, val in instance.conflicts],
+        "error": str(study.error) if study.error else None,
+    }
+
+def run(args : argparse.Namespace) -> tuple[dict, int]:
+    start = time.perf_counter()
+    summary = {"directory": args.directory, "studies": [], "aborted": None}
+
+    manifest_path = args.manifest or dataset.find_manifest(args.directory)
+    if not manifest_path:
+        summary["aborted"] = "no manifest"
+        return summary, 2
+    summary["manifest"] = manifest_path
+
+    report = validation.ValidationReport()
+    complete, incomplete = dataset.match(args.directory, dataset.scan(args.directory), manifest.load(manifest_path, report))
+    if not report.is_valid():
+        # tags sent as they are, they can be refused by Orthanc
+        summary["validation"] = report.to_dict()
+    summary["studies"].extend({"name": name, "status": "incomplete"} for name in incomplete)
+    if len(incomplete) > 0 and args.incomplete == "abort":
+        summary["aborted"] = "incomplete studies"
+        return summary, 2
+
+    if args.dry_run:
+        summary["plan"] = plan.describe([scheduler.plan_study(name, series) for name, series in complete], args.headers)
+        return summary, 1 if len(incomplete) > 0 or summary["plan"]["conflicts"] > 0 else 0
+
+    studies = []
+    for name, series in complete:
+        study = scheduler.plan_study(name, series)
+        if len(study.conflicts()) > 0:
+            if args.on_conflict == "abort":
+                summary["studies"].append(study_summary(study, "conflict"))
+                summary["aborted"] = "conflicts"
+                return summary, 2
+            if args.on_conflict == "skip":
+                summary["studies"].append(study_summary(study, "conflict"))
+                continue
+        studies.append(study)
+
+    tags.set_client(OrthancClient(args.url, args.user, args.password, pool_size=args.workers + args.studies,
+                                  retry=RetryPolicy(args.attempts), rate=args.rate,
+                                  compression={types.FileAPI[api.upper()]:args.compress for api in args.compress_api} if args.compress else None))
+    tags.RAW_DICOM = args.raw_dicom
+    journal = None if args.no_journal else Journal(args.journal or os.path.join(args.directory, JOURNAL_NAME), args.url)
+    cache = None if args.no_cache else DedupCache(args.cache, server=args.url)
+    if args.use_async:
+        # only imported when used, like httpx
+        from .async_scheduler import AsyncUploadScheduler
+        upload_scheduler = AsyncUploadScheduler(args.workers, args.studies, journal, cache)
+    else:
+        upload_scheduler = scheduler.UploadScheduler(args.workers, args.studies, journal, cache)
+    upload_scheduler.run(studies)
+
+    failed = [study for study in studies if study.error]
+    to_delete = studies if (len(failed) > 0 and args.on_error == "rollback") else failed if args.on_error == "continue" else []
+    if len(to_delete) > 0:
+        summary["rollback"] = upload_scheduler.rollback(to_delete).to_dict()
+    deleted = set(study.name for study in to_delete if study.deleted)
+
+    if journal:
+        journal.close()
+    if cache:
+        cache.close()
+
+    for study in studies:
+        summary["studies"].append(study_summary(study, "failed" if study.error else "uploaded", study.name in deleted))
+
+    summary["uploaded_instances"] = sum(s["instances"] for s in summary["studies"] if s["status"] == "uploaded" and not s["deleted"])
+    summary["elapsed"] = time.perf_counter() - start
+    return summary, 1 if len(failed) > 0 else 0
+
+def main(argv : list[str] = None) -> int:
+    args = parse_args(argv)
+    metrics_file = open(args.metrics, "w") if args.metrics else None
+    metrics.sink = metrics_file
+    server = metrics.serve(args.prometheus) if args.prometheus else None
+    # keep stdout for the summary
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            summary, code = run(args)
+    finally:
+        if server:
+            server.shutdown()
+        if metrics_file:
+            metrics.sink = None
+            metrics_file.close()
+    summary["metrics"] = metrics.to_dict()
+    if args.summary == "-":
+        json.dump(summary, sys.stdout, indent=4)
+        sys.stdout.write("\n")
+    else:
+        with open(args.summary, "w") as f:
+            json.dump(summary, f, indent=4)
+    return code
+
+if __name__ == '__main__':
+    sys.exit(main())
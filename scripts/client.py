@@ -0,0 +1,190 @@
+# Canathist Automizer Tags 2023
+
+# Copyright (C) 2023 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU General Public License as
+
+# published by the Free Software Foundation, either version 3 of the
+
+# License, or (at your option) any later version.
+
+# 
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU General Public License
+
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+
+from . import compression as compressions
+from .retry import RetryPolicy, TokenBucket, AdaptiveLimiter, is_transient
+from .metrics import metrics
+
+URL = "http://localhost:8042"
+# (connect, read) in seconds, uploads of big series can take a while to be processed
+TIMEOUT = (5, 600)
+POOL_SIZE = 10
+
+
+class _SentBody:
+    """Generator body counting the bytes sent and noting when the last one was handed to the connection"""
+
+    def __init__(self, chunks) -> None:
+        self.chunks = chunks
+        self.size = 0
+        self.end = None
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.size += len(chunk)
+            yield chunk
+        self.end = time.perf_counter()
+
+
+def observe_request(method : str, path : str, body, status : int, start : float, end : float, attempt : int, received : int, elapsed : float = None):
+    """Metrics of one request of the sync or the async client
+
+    Args:
+        body: body as it was sent, a _SentBody for a generator
+        received (int): bytes of the answer
+        elapsed (float): seconds until the answer, only used without a body
+    """
+    sent = body.size if isinstance(body, _SentBody) else len(body) if isinstance(body, (str, bytes, bytearray, memoryview)) else 0
+    metrics.observe("http", end - start, method=method, path=path, status=status, attempt=attempt, bytes=sent)
+    metrics.add("requests")
+    metrics.add("bytes_sent", sent)
+    metrics.add("bytes_received", received)
+    if isinstance(body, _SentBody) and body.end is not None:
+        # from the end of the upload to the answer : processing by Orthanc, plus the latency
+        metrics.observe("server", end - body.end, method=method, path=path)
+    elif body is None and elapsed is not None:
+        metrics.observe("server", elapsed, method=method, path=path)
+
+
+class OrthancClient:
+    """HTTP client for the Orthanc REST API
+
+    Every request goes through one Session so the TCP connections are kept alive and reused.
+    The pool must be at least as large as the number of concurrent requests or connections are
+    opened and thrown away again.
+    Requests failing with a transient error (see retry.is_transient) are sent again following the retry
+    policy, and the number of requests in flight shrinks while the server is overloaded.
+
+    Attributes:
+        url : base URL of the Orthanc server
+        timeout : timeout given to every request
+        pool_size : max number of connections kept open
+        retry : RetryPolicy, None to never send a request again
+        bucket : TokenBucket limiting the number of requests per second, None for no limit
+        limiter : AdaptiveLimiter of the requests in flight
+        compression : path of an API (types.FileAPI value) -> Content-Encoding its request bodies are sent with
+    """
+
+    def __init__(self, url : str = URL, username : str = "orthanc", password : str = "orthanc", timeout = TIMEOUT, pool_size : int = POOL_SIZE,
+                 retry : RetryPolicy = RetryPolicy(), rate : float = None, compression : dict = None) -> None:
+        self.url = url.rstrip("/")
+        self.compression = {}
+        for api, encoding in (compression or {}).items():
+            if not compressions.available(encoding):
+                raise ValueError(f"{encoding} compression isn't available, expected one of {compressions.ENCODINGS} (zstd needs zstandard)")
+            # a FileAPI or its path
+            self.compression[getattr(api, "value", api)] = encoding
+        self.timeout = timeout
+        self.session = requests.Session()
+        if username:
+            self.session.auth = HTTPBasicAuth(username, password)
+        self.retry = retry
+        self.bucket = TokenBucket(rate) if rate else None
+        self.limiter = AdaptiveLimiter(pool_size)
+        self.pool_size = 0
+        self.set_pool_size(pool_size)
+
+    def set_pool_size(self, pool_size : int):
+        if pool_size <= self.pool_size:
+            return
+        self.pool_size = pool_size
+        self.limiter.set_max_limit(pool_size)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method : str, path : str, data = None, **kwargs) -> requests.Response:
+        """Send a request, raise requests.exceptions.HTTPError on an error status
+
+        Args:
+            data: body of the request, or a function returning a new one for every attempt
+                (a generator body can only be sent once)
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            if self.bucket:
+                self.bucket.acquire()
+            with self.limiter:
+                try:
+                    body, headers = self.compress(path, data() if callable(data) else data, kwargs.get("headers"))
+                    if body is not None and not isinstance(body, (str, bytes, bytearray, memoryview, dict, list, tuple)):
+                        body = _SentBody(body)
+                    start = time.perf_counter()
+                    r = self.session.request(method, f"{self.url}/{path.lstrip('/')}", data=body, **{**kwargs, "headers": headers})
+                    observe_request(method, path, body, r.status_code, start, time.perf_counter(), attempt, len(r.content), r.elapsed.total_seconds())
+                    r.raise_for_status()
+                    self.limiter.increase()
+                    return r
+                except requests.exceptions.RequestException as e:
+                    metrics.add("request_errors")
+                    if not is_transient(e, method):
+                        raise
+                    self.limiter.decrease()
+                    attempt += 1
+                    if self.retry is None or attempt >= self.retry.max_attempts:
+                        raise
+                    error = e
+            metrics.add("retries")
+            delay = self.retry.delay(attempt - 1)
+            metrics.event("retry", method=method, path=path, error=str(error), attempt=attempt + 1, delay=delay)
+            time.sleep(delay)
+
+    def compress(self, path : str, body, headers : dict = None) -> tuple[object, dict | None]:
+        """(body compressed as set for path, headers with its Content-Encoding), as they are otherwise
+
+        A generator body stays a generator, compressed while it is sent.
+        """
+        encoding = self.compression.get(path.strip("/"))
+        if encoding is None or body is None or isinstance(body, (dict, list, tuple)):
+            return body, headers
+        if isinstance(body, (str, bytes, bytearray, memoryview)):
+            body = compressions.compress(body, encoding, path=path)
+        else:
+            body = compressions.iter_compressed(body, encoding, path=path)
+        return body, {**(headers or {}), "Content-Encoding": encoding}
+
+    def get(self, path : str, **kwargs) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path : str, **kwargs) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+    def delete(self, path : str, **kwargs) -> requests.Response:
+        return self.request("DELETE", path, **kwargs)
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,107 @@
+# Canathist Automizer Tags 2023
+
+# Copyright (C) 2023 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU General Public License as
+
+# published by the Free Software Foundation, either version 3 of the
+
+# License, or (at your option) any later version.
+
+# 
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU General Public License
+
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .metrics import metrics
+
+# Content-Encoding of the request bodies, Orthanc itself decompresses gzip and deflate
+ENCODINGS = ("gzip", "deflate", "zstd")
+# fast levels : the base64 JSON compresses well even at the lowest ones, the upload mustn't wait on the CPU
+LEVELS = {"gzip": 1, "deflate": 1, "zstd": 3}
+# bytes compressed at once from a buffered body
+CHUNK_SIZE = 1 << 20
+
+
+def available(encoding : str) -> bool:
+    return encoding in ("gzip", "deflate") or (encoding == "zstd" and zstandard is not None)
+
+def compressor(encoding : str, level : int = None):
+    """Object with compress(data) and flush() for one body"""
+    level = LEVELS[encoding] if level is None else level
+    if encoding == "gzip":
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        return zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS)
+    if encoding == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    raise ValueError(f"Unknown encoding {encoding}, expected one of {ENCODINGS}")
+
+def iter_compressed(chunks, encoding : str, level : int = None, path : str = None):
+    """Yield the compression of a body given chunk by chunk, for a chunked request"""
+    compress = compressor(encoding, level)
+    seconds = 0.0
+    size = compressed = 0
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        size += len(chunk)
+        start = time.perf_counter()
+        out = compress.compress(chunk)
+        seconds += time.perf_counter() - start
+        if out:
+            compressed += len(out)
+            yield out
+    start = time.perf_counter()
+    out = compress.flush()
+    seconds += time.perf_counter() - start
+    compressed += len(out)
+    _observe(seconds, encoding, path, size, compressed)
+    if out:
+        yield out
+
+def compress(body, encoding : str, level : int = None, path : str = None) -> bytes:
+    """Compression of a whole body, str, bytes or any buffer"""
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    start = time.perf_counter()
+    compress = compressor(encoding, level)
+    parts = []
+    with memoryview(body) as view:
+        for offset in range(0, len(view), CHUNK_SIZE):
+            parts.append(compress.compress(view[offset:offset + CHUNK_SIZE]))
+    parts.append(compress.flush())
+    out = b"".join(parts)
+    _observe(time.perf_counter() - start, encoding, path, len(body), len(out))
+    return out
+
+def _observe(seconds : float, encoding : str, path : str, size : int, compressed : int):
+    metrics.observe("compress", seconds, encoding=encoding, path=path, bytes=size, compressed=compressed)
+    metrics.add("bytes_uncompressed", size)
+    metrics.add("bytes_compressed", compressed)
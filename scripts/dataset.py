@@ -0,0 +1,87 @@
+# Canathist Automizer Tags 2023
+
+# Copyright (C) 2023 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU General Public License as
+
+# published by the Free Software Foundation, either version 3 of the
+
+# License, or (at your option) any later version.
+
+# 
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU General Public License
+
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+from . import validation
+from .metrics import metrics
+from .manifest import STUDY_TAGS, effective_tags
+
+
+@metrics.timed("scan")
+def list_entries(path : str, dirs_only : bool = False) -> list[str]:
+    """Names of the entries of a directory, sorted like QDir does by default"""
+    with os.scandir(path) as it:
+        entries = [entry.name for entry in it if not dirs_only or entry.is_dir()]
+    return sorted(entries, key=str.lower)
+
+def scan(directory : str) -> dict[str, dict[str, list[str]]]:
+    """study -> series -> files of a dataset directory"""
+    return {study:{series:list_entries(os.path.join(directory, study, series)) if os.path.isdir(os.path.join(directory, study, series)) else [] for series in list_entries(os.path.join(directory, study))} for study in list_entries(directory, dirs_only=True)}
+
+def find_manifest(directory : str) -> str | None:
+    list_json = [name for name in list_entries(directory) if name.endswith(".json") and os.path.isfile(os.path.join(directory, name))]
+    if len(list_json) != 1:
+        return None
+    return os.path.join(directory, list_json[0])
+
+def cast_tags(tags_dict : dict) -> tuple[dict, list]:
+    """Cast the values of the tags to their VR, returns the casted tags and the names that aren't DICOM tags"""
+    casted_files, bad_tags = validation.cast_series({"":tags_dict})
+    return casted_files[""], bad_tags.get("", [])
+
+def match(directory : str, studies : dict[str, dict[str, list[str]]], manifest : dict) -> tuple[list, list[str]]:
+    """Match the files of a dataset with its manifest, as loaded by manifest.load
+
+    Returns:
+        list: (study name, [(series name, [(path, tags, None)], None)]) for every study fully described by the manifest,
+            ready for scheduler.plan_study
+        list[str]: names of the studies that aren't
+    """
+    complete = []
+    incomplete = []
+    for study, study_series in studies.items():
+        if study not in manifest:
+            incomplete.append(study)
+            continue
+        all_correct = True
+        series_list = []
+        for series, files in study_series.items():
+            series_tags = manifest[study].get(series, {}).get("files", {})
+            if series not in manifest[study] or any(file not in series_tags for file in files):
+                all_correct = False
+                break
+            series_entry = manifest[study][series]
+            series_list.append((series, [(os.path.join(directory, study, series, file), effective_tags(series_tags[file], series_entry["tags"], manifest[study][STUDY_TAGS]), None) for file in files], None))
+        if all_correct:
+            complete.append((study, series_list))
+        else:
+            incomplete.append(study)
+    return complete, incomplete
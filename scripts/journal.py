@@ -0,0 +1,167 @@
+# Canathist Automizer Tags 2023
+
+# Copyright (C) 2023 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU General Public License as
+
+# published by the Free Software Foundation, either version 3 of the
+
+# License, or (at your option) any later version.
+
+# 
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU General Public License
+
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from .metrics import metrics
+
+# Name of the journal kept in a dataset directory
+JOURNAL_NAME = ".orthanc_journal.sqlite"
+READ_SIZE = 1 << 20
+
+
+def local_path(directory : str) -> str:
+    """Journal of a dataset directory kept in the cache of the user, for a directory that can't hold one"""
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    name = hashlib.blake2b(os.path.abspath(directory).encode('utf-8'), digest_size=20).hexdigest()
+    return os.path.join(cache_dir, "dicomizer", "journals", f"{name}.sqlite")
+
+def open_journal(directory : str, server : str = ""):
+    """Journal of a dataset directory, in the directory or in the cache of the user when the directory is
+    read only or on a share SQLite can't lock. None if neither can be opened, nothing is resumed then.
+    """
+    for path in (os.path.join(directory, JOURNAL_NAME), local_path(directory)):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            return Journal(path, server)
+        except (OSError, sqlite3.OperationalError) as e:
+            metrics.event("journal_unavailable", path=path, error=str(e))
+    return None
+
+def forget_resources(connection : sqlite3.Connection, server : str, ids : list[str]):
+    """Delete the rows of the instances table referring to the deleted studies, series or instances"""
+    # below the limit of parameters of SQLite
+    for i in range(0, len(ids), 300):
+        chunk = ids[i:i + 300]
+        marks = ", ".join("?" * len(chunk))
+        connection.execute(f"DELETE FROM instances WHERE server=? AND (instance_id IN ({marks}) OR series_id IN ({marks}) OR study_id IN ({marks}))",
+                           (server, *chunk, *chunk, *chunk))
+
+def hash_file(path : str) -> str:
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+def content_hash(path : str) -> str:
+    """Hash of the content of a file, or of the names and contents of every file of a directory"""
+    if not os.path.isdir(path):
+        return hash_file(path)
+    h = hashlib.blake2b(digest_size=20)
+    for name in sorted(os.listdir(path)):
+        h.update(name.encode('utf-8'))
+        h.update(hash_file(os.path.join(path, name)).encode('utf-8'))
+    return h.hexdigest()
+
+def fingerprint(path : str, tags : dict, content : str = None) -> str:
+    """Hash of the content of a file and of the tags it is sent with
+
+    Args:
+        content (str): hash of the content if already known (see cache.DedupCache.content_hash)
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update((content or content_hash(path)).encode('utf-8'))
+    h.update(json.dumps({tag:str(val) for tag, val in tags.items()}, sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+
+class Journal:
+    """On-disk record of the uploaded instances, to resume an interrupted upload
+
+    An instance is identified by the server, its study, series and file names and the fingerprint of its
+    content and tags. A changed file or tag doesn't match anymore and is uploaded again.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, path : str, server : str = "") -> None:
+        self.path = path
+        self.server = server
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        try:
+            with self.lock, self.connection:
+                self.connection.execute("PRAGMA journal_mode=WAL")
+                self.connection.execute("PRAGMA synchronous=NORMAL")
+                self.connection.execute("""CREATE TABLE IF NOT EXISTS instances (
+                    server TEXT, study TEXT, series TEXT, file TEXT, hash TEXT,
+                    instance_id TEXT, series_id TEXT, study_id TEXT, created REAL,
+                    PRIMARY KEY (server, study, series, file))""")
+                self.connection.execute("CREATE INDEX IF NOT EXISTS instances_study_id ON instances (study_id)")
+        except sqlite3.Error:
+            # read only, or a file system SQLite can't lock
+            self.connection.close()
+            raise
+
+    def lookup(self, study : str, series : str, file : str, hash : str) -> tuple[str, str, str] | None:
+        """(instance id, series id, study id) of an uploaded instance, None if it has to be uploaded"""
+        with self.lock:
+            row = self.connection.execute("SELECT instance_id, series_id, study_id FROM instances WHERE server=? AND study=? AND series=? AND file=? AND hash=?",
+                                          (self.server, study, series, file, hash)).fetchone()
+        return row
+
+    def study_id(self, study : str) -> str | None:
+        with self.lock:
+            row = self.connection.execute("SELECT study_id FROM instances WHERE server=? AND study=? LIMIT 1", (self.server, study)).fetchone()
+        return row[0] if row else None
+
+    def series_ids(self, study : str, study_id : str) -> dict[str, str]:
+        """Series name -> id of the series recorded in the study"""
+        with self.lock:
+            rows = self.connection.execute("SELECT series, series_id FROM instances WHERE server=? AND study=? AND study_id=? GROUP BY series",
+                                           (self.server, study, study_id)).fetchall()
+        return dict(rows)
+
+    def record(self, study : str, series : str, file : str, hash : str, instance_id : str, series_id : str, study_id : str):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (self.server, study, series, file, hash, instance_id, series_id, study_id, time.time()))
+
+    def forget_study(self, study_id : str):
+        """The study has been deleted from Orthanc"""
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM instances WHERE server=? AND study_id=?", (self.server, study_id))
+
+    def forget_resources(self, ids : list[str]):
+        """The studies, series or instances have been deleted from Orthanc"""
+        with self.lock, self.connection:
+            forget_resources(self.connection, self.server, ids)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,227 @@
+# Canathist Automizer Tags 2023
+
+# Copyright (C) 2023 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU General Public License as
+
+# published by the Free Software Foundation, either version 3 of the
+
+# License, or (at your option) any later version.
+
+# 
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU General Public License
+
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import csv
+import json
+import os
+from collections import ChainMap
+
+from . import validation
+from .metrics import metrics
+
+# column of the file names in the columnar formats
+FILE_NAME = "Label"
+# key of the tags shared by all the series of a study
+STUDY_TAGS = "_tags"
+
+# characters read from the manifest at once
+READ_SIZE = 1 << 20
+
+_WHITESPACE = " \t\n\r"
+# characters that can continue a number
+_NUMBER = "0123456789.eE+-"
+
+
+class _Reader:
+    """Incremental reader of a JSON document
+
+    Walks the objects by hand and only decodes the values asked for, so only the current
+    value is held in memory and never the whole document.
+    """
+
+    def __init__(self, f, read_size : int = READ_SIZE) -> None:
+        self.f = f
+        self.read_size = read_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.f.read(self.read_size)
+        if not chunk:
+            self.eof = True
+            return False
+        if self.pos > 0:
+            # drop what has already been parsed
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        self.buffer += chunk
+        return True
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise json.JSONDecodeError("Unexpected end of manifest", self.buffer, self.pos)
+
+    def expect(self, char : str):
+        if self.peek() != char:
+            raise json.JSONDecodeError(f"Expecting '{char}'", self.buffer, self.pos)
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                val, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number cut by the end of the buffer would still be decoded, "-2.5e10" read as -2 from "-2."
+                if self.eof or (end < len(self.buffer) and self.buffer[end] not in _NUMBER):
+                    self.pos = end
+                    return val
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def keys(self):
+        """Yield the keys of an object, the caller must consume each value before the next key"""
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise json.JSONDecodeError("Expecting property name", self.buffer, self.pos)
+            self.expect(":")
+            yield key
+            char = self.peek()
+            self.pos += 1
+            if char == "}":
+                return
+            if char != ",":
+                raise json.JSONDecodeError("Expecting ',' delimiter", self.buffer, self.pos - 1)
+
+
+def _columns_to_files(columns : dict[str, list]) -> dict[str, dict]:
+    # empty cells aren't set, the file inherits the value of its series or study
+    labels = columns[FILE_NAME]
+    files = {label:dict() for label in labels}
+    for tag_name, values in columns.items():
+        if tag_name == FILE_NAME:
+            continue
+        for label, val in zip(labels, values):
+            if val is not None and val != "":
+                files[label][tag_name] = val
+    return files
+
+def _read_csv(path : str) -> dict[str, dict]:
+    with open(path, "r", newline="") as f:
+        return {row[FILE_NAME]:{tag_name:val for tag_name, val in row.items() if tag_name != FILE_NAME and val} for row in csv.DictReader(f, delimiter=";")}
+
+def iter_series(path : str, read_size : int = READ_SIZE):
+    """Yield the series of a manifest one by one while it is read
+
+    The tags of the files can be given by
+        "files": {file name: {"tags": {tag name: value}}}
+        "columns": {"Label": [file names], tag name: [values]}
+        "csv": path of a ';' separated file with a Label column, relative to the manifest
+    The "tags" of a series and the "_tags" of a study are set on all their files, unless a file sets its own value.
+
+    Yields:
+        (study name, series name, series fields except the files, {file name: tags})
+        (study name, None, {"tags": study tags}, {}) for the "_tags" of a study
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    with open(path, "r") as f:
+        reader = _Reader(f, read_size)
+        for study_name in reader.keys():
+            for series_name in reader.keys():
+                if series_name == STUDY_TAGS:
+                    yield study_name, None, {"tags": reader.value()}, {}
+                    continue
+                fields = dict()
+                files = dict()
+                for field in reader.keys():
+                    if field == "files":
+                        for file_name in reader.keys():
+                            files[file_name] = reader.value().get("tags", {})
+                    elif field == "columns":
+                        files.update(_columns_to_files(reader.value()))
+                    elif field == "csv":
+                        files.update(_read_csv(os.path.join(directory, reader.value())))
+                    else:
+                        fields[field] = reader.value()
+                yield study_name, series_name, fields, files
+
+@metrics.timed("manifest")
+def load(path : str, report : validation.ValidationReport = None) -> dict:
+    """Read a manifest and cast its tags series by series
+
+    Only one series is held uncasted in memory at a time. The tags of a series and of a study are
+    stored once, use effective_tags to get all the tags of a file.
+
+    Args:
+        report (ValidationReport): records the tags that couldn't be casted, the tags of a series and of a study
+            under an empty file name as in validate
+
+    Returns:
+        dict: study -> {"_tags": casted study tags} + series -> series fields
+            + {"tags": casted series tags, "files": {file name: casted tags}, "bad_tags": {file name: [names]}}
+    """
+    manifest = dict()
+    for study_name, series_name, fields, files in iter_series(path):
+        study = manifest.setdefault(study_name, {STUDY_TAGS:dict()})
+        if series_name is None:
+            study[STUDY_TAGS] = _cast_tags(report, study_name, STUDY_TAGS, fields["tags"])
+            continue
+        casted_files, bad_tags = validation.cast_series(files)
+        if report is not None:
+            validation.record_errors(report, study_name, series_name, files, bad_tags)
+        fields["tags"] = _cast_tags(report, study_name, series_name, fields.get("tags", {}))
+        fields["files"] = casted_files
+        fields["bad_tags"] = bad_tags
+        study[series_name] = fields
+    return manifest
+
+def _cast_tags(report : validation.ValidationReport | None, study_name : str, series_name : str, tags : dict) -> dict:
+    casted, bad = validation.cast_series({"":tags})
+    if report is not None:
+        validation.record_errors(report, study_name, series_name, {"":tags}, bad)
+    return casted[""]
+
+def effective_tags(file_tags : dict, series_tags : dict, study_tags : dict) -> ChainMap:
+    """Tags of a file with the ones inherited from its series and study, without copying them"""
+    return ChainMap(file_tags, series_tags, study_tags)
+
+def validate(path : str) -> validation.ValidationReport:
+    """Validate a manifest while it is read, the tags of a series or of a study are reported under an empty file name"""
+    report = validation.ValidationReport()
+    for study_name, series_name, fields, files in iter_series(path):
+        if "tags" in fields:
+            files = {**files, "":fields["tags"]}
+        validation.validate_series(report, study_name, series_name if series_name is not None else STUDY_TAGS, files)
+    return report
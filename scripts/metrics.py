@@ -0,0 +1,169 @@
+# Canathist Automizer Tags 2023
+
+# Copyright (C) 2023 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU General Public License as
+
+# published by the Free Software Foundation, either version 3 of the
+
+# License, or (at your option) any later version.
+
+# 
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU General Public License
+
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# prefix of the Prometheus metric names
+NAMESPACE = "dicomizer"
+
+
+class Stage:
+    """Time spent in one stage of the pipeline"""
+
+    __slots__ = ("count", "seconds", "max")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.seconds = 0.0
+        self.max = 0.0
+
+
+class Metrics:
+    """Timings of the stages of the pipeline and counters, shared by every thread
+
+    Stages can be nested, the HTTP round trip of a streamed upload contains the reading and encoding of
+    its files for example. Every observation is also written as a JSON line to the sink if there is one.
+
+    Attributes:
+        stages : stage name -> Stage
+        counters : counter name -> value
+        sink : text file the JSON lines are written to, None to keep only the totals
+    """
+
+    def __init__(self, sink = None) -> None:
+        self.lock = threading.Lock()
+        self.stages : dict[str, Stage] = {}
+        self.counters : dict[str, float] = {}
+        self.sink = sink
+
+    def observe(self, stage : str, seconds : float, **labels):
+        with self.lock:
+            total = self.stages.get(stage)
+            if total is None:
+                total = self.stages[stage] = Stage()
+            total.count += 1
+            total.seconds += seconds
+            total.max = max(total.max, seconds)
+            if self.sink:
+                self._write({"stage": stage, "seconds": seconds, **labels})
+
+    @contextmanager
+    def timer(self, stage : str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, **labels)
+
+    def timed(self, stage : str):
+        """Decorator timing every call of a function"""
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def add(self, counter : str, value : float = 1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def event(self, name : str, **fields):
+        """Write a JSON line that isn't a timing, an uploaded instance for example"""
+        if self.sink:
+            with self.lock:
+                self._write({"event": name, **fields})
+
+    def _write(self, record : dict):
+        self.sink.write(json.dumps({"time": time.time(), **record}) + "\n")
+
+    def reset(self):
+        with self.lock:
+            self.stages.clear()
+            self.counters.clear()
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "stages": {name:{"count": stage.count, "seconds": stage.seconds, "max": stage.max} for name, stage in self.stages.items()},
+                "counters": dict(self.counters),
+            }
+
+    def to_prometheus(self) -> str:
+        """Totals in the Prometheus text exposition format"""
+        lines = [
+            f"# TYPE {NAMESPACE}_stage_seconds_total counter",
+            f"# TYPE {NAMESPACE}_stage_count_total counter",
+            f"# TYPE {NAMESPACE}_stage_seconds_max gauge",
+        ]
+        with self.lock:
+            for name, stage in sorted(self.stages.items()):
+                lines.append(f'{NAMESPACE}_stage_seconds_total{{stage="{name}"}} {stage.seconds}')
+                lines.append(f'{NAMESPACE}_stage_count_total{{stage="{name}"}} {stage.count}')
+                lines.append(f'{NAMESPACE}_stage_seconds_max{{stage="{name}"}} {stage.max}')
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE {NAMESPACE}_{name}_total counter")
+                lines.append(f"{NAMESPACE}_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port : int, host : str = "127.0.0.1") -> ThreadingHTTPServer:
+        """Serve to_prometheus on http://host:port/metrics from a daemon thread, shutdown() the server to stop it"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+# metrics of the whole program
+metrics = Metrics()
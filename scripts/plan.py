@@ -0,0 +1,82 @@
+# Canathist Automizer Tags 2023
+
+# Copyright (C) 2023 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU General Public License as
+
+# published by the Free Software Foundation, either version 3 of the
+
+# License, or (at your option) any later version.
+
+# 
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU General Public License
+
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from . import rewrite
+from .scheduler import StudyJob
+
+CREATE_STUDY = "create_study"
+CREATE_SERIES = "create_series"
+ADD_INSTANCE = "add_instance"
+
+
+def describe_study(study : StudyJob, headers : bool = False) -> dict:
+    """What the upload of a planned study would do, without sending anything
+
+    The actions follow UploadScheduler : the first instance creates the patient and the study, the first
+    instance of each other series creates its series and every other instance is added to its series.
+
+    Args:
+        study (StudyJob): study planned by scheduler.plan_study
+        headers (bool): compare the tags with the current header of the files that are already DICOM
+    """
+    series_list = []
+    first_series = True
+    for series in study.series:
+        instances = []
+        for instance in series.instances:
+            # send_request adds the instance number to the tags
+            instance_tags = {**instance.tags, "InstanceNumber":f"{instance.instance_number}"}
+            entry = {
+                "file": str(instance.file),
+                "instance_number": instance.instance_number,
+                "action": ADD_INSTANCE if len(instances) > 0 else CREATE_STUDY if first_series else CREATE_SERIES,
+                "tags": {tag:str(val) for tag, val in instance_tags.items()},
+                "conflicts": [{"tag": tag, "module": str(module_val), "value": str(val)} for tag, module_val, val in instance.conflicts],
+            }
+            if headers:
+                changes = rewrite.header_changes(str(instance.file), instance_tags)
+                entry["header_changes"] = None if changes is None else {tag:[old, new] for tag, (old, new) in changes.items()}
+            instances.append(entry)
+        if len(instances) > 0:
+            first_series = False
+        series_list.append({"name": series.name, "instances": instances})
+    return {
+        "name": study.name,
+        "series": series_list,
+        "conflicts": sum(len(instance.conflicts) for instance in study.instances()),
+    }
+
+def describe(studies : list[StudyJob], headers : bool = False) -> dict:
+    plans = [describe_study(study, headers) for study in studies]
+    return {
+        "studies": plans,
+        "instances": sum(len(series["instances"]) for plan in plans for series in plan["series"]),
+        "conflicts": sum(plan["conflicts"] for plan in plans),
+    }
@@ -0,0 +1,216 @@
+# Canathist Automizer Tags 2023
+
+# Copyright (C) 2023 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU General Public License as
+
+# published by the Free Software Foundation, either version 3 of the
+
+# License, or (at your option) any later version.
+
+# 
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU General Public License
+
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import random
+import threading
+import time
+
+import requests
+
+from . import types
+from .types import OrthancErrorCode
+from .metrics import metrics
+
+# Orthanc errors worth sending the request again
+TRANSIENT_ERRORS = {
+    OrthancErrorCode.ErrorCode_NotEnoughMemory,
+    OrthancErrorCode.ErrorCode_Timeout,
+    OrthancErrorCode.ErrorCode_DatabaseUnavailable,
+    OrthancErrorCode.ErrorCode_DatabaseCannotSerialize,
+}
+# HTTP statuses of an overloaded server or of a proxy in front of it
+TRANSIENT_STATUS = {429, 502, 503, 504}
+# the request has been refused before being processed, any method can be sent again
+REJECTED_ERRORS = {
+    OrthancErrorCode.ErrorCode_NotEnoughMemory,
+    OrthancErrorCode.ErrorCode_DatabaseUnavailable,
+    OrthancErrorCode.ErrorCode_DatabaseCannotSerialize,
+}
+REJECTED_STATUS = {429, 503}
+# may be sent again after a connection error, a timeout or a gateway error, the others might have been processed
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE"}
+
+MAX_ATTEMPTS = 5
+BASE_DELAY = 0.5
+MAX_DELAY = 30
+
+
+def error_code(response : requests.Response):
+    """OrthancErrorCode of an error answer, None if it isn't one of Orthanc"""
+    try:
+        return types.get_error_code(response.json().get("OrthancStatus"))
+    except ValueError:
+        return None
+
+def is_transient(error : Exception, method : str) -> bool:
+    """If the request may succeed when sent again without being done twice
+
+    A POST creates a new instance every time it is processed : it is only sent again when the server
+    has refused it, not after a 502, a 504 or a timeout where it may have been processed anyway.
+    """
+    if isinstance(error, requests.exceptions.HTTPError):
+        if error.response is None:
+            return False
+        code = error_code(error.response)
+        if method in IDEMPOTENT_METHODS:
+            return code in TRANSIENT_ERRORS or error.response.status_code in TRANSIENT_STATUS
+        return code in REJECTED_ERRORS or error.response.status_code in REJECTED_STATUS
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        # never reached the server
+        return True
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return method in IDEMPOTENT_METHODS
+    return False
+
+
+class RetryPolicy:
+    """How many times and when a request failing with a transient error is sent again
+
+    The delay before an attempt is drawn between 0 and base_delay * 2**attempt, capped at max_delay
+    (full jitter), so the workers failing together don't come back together.
+    """
+
+    def __init__(self, max_attempts : int = MAX_ATTEMPTS, base_delay : float = BASE_DELAY, max_delay : float = MAX_DELAY) -> None:
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt : int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class TokenBucket:
+    """At most rate requests per second on average, with bursts of up to burst requests"""
+
+    def __init__(self, rate : float, burst : int = None) -> None:
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.tokens = float(self.burst)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _take(self) -> float:
+        # 0 once a token has been taken, else the seconds to wait for the next one
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while (wait := self._take()) > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        while (wait := self._take()) > 0:
+            await asyncio.sleep(wait)
+
+
+class AdaptiveLimiter:
+    """Number of requests in flight, adapted to the load of the server
+
+    Additive increase on success, multiplicative decrease on a transient error: the limit grows by one
+    every limit successful requests up to max_limit and is halved when the server struggles.
+    Used as a context manager around a request, or as an async one from an event loop. Threads and
+    event loops can share it.
+    """
+
+    def __init__(self, max_limit : int, min_limit : int = 1) -> None:
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        # (event loop, future) of the tasks waiting for a request to end
+        self.waiters : list[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    def set_max_limit(self, max_limit : int):
+        with self.condition:
+            self.limit = min(max_limit, max(self.min_limit, self.limit + max_limit - self.max_limit))
+            self.max_limit = max_limit
+            self._notify_all()
+
+    def increase(self):
+        with self.condition:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._notify_all()
+
+    def _notify_all(self):
+        # with the condition held
+        self.condition.notify_all()
+        for loop, future in self.waiters:
+            loop.call_soon_threadsafe(_wake, future)
+        self.waiters.clear()
+
+    def decrease(self):
+        with self.condition:
+            self.limit = max(self.min_limit, self.limit / 2)
+            limit = int(self.limit)
+        metrics.event("overloaded", limit=limit)
+
+    def __enter__(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self.condition:
+            self.in_flight -= 1
+            if self.waiters:
+                self._notify_all()
+            else:
+                self.condition.notify()
+        return False
+
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.condition:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return self
+                future = loop.create_future()
+                self.waiters.append((loop, future))
+            await future
+
+    async def __aexit__(self, *exc_info):
+        return self.__exit__(*exc_info)
+
+
+def _wake(future : asyncio.Future):
+    if not future.done():
+        future.set_result(None)
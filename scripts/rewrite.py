@@ -0,0 +1,305 @@
+# Canathist Automizer Tags 2023
+
+# Copyright (C) 2023 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU General Public License as
+
+# published by the Free Software Foundation, either version 3 of the
+
+# License, or (at your option) any later version.
+
+# 
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU General Public License
+
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import os
+import shutil
+import struct
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import pydicom as dicom
+from pydicom.errors import InvalidDicomError
+from pydicom.tag import Tag
+from pydicom.uid import DeflatedExplicitVRLittleEndian
+
+from . import validation
+
+# Files rewritten at the same time, None for one per core
+MAX_PROCESSES = None
+# Files sent at once to a worker process
+CHUNK_SIZE = 16
+# Rewrite the header and copy the pixel data instead of reloading and rewriting the whole file
+HEADER_ONLY = True
+COPY_SIZE = 1 << 20
+
+PIXEL_DATA_GROUP = 0x7FE00000
+# Float Pixel Data, Double Float Pixel Data and Pixel Data, where stop_before_pixels stops
+PIXEL_DATA_TAGS = {0x7FE00008, 0x7FE00009, 0x7FE00010}
+
+
+class RewriteResult:
+    """Outcome of the rewrite of one file
+
+    Attributes:
+        label : label of the file in the CSV
+        file : path of the file, None if it has not been selected
+        status : "patched" (header only), "updated" (fully rewritten), "planned" (dry run), "not_selected" or "error"
+        errors : list of the tags that couldn't be added, or the reason of the failure
+        changes : {tag name: (current value, new value)} of the tags that would change, only for a dry run
+    """
+
+    def __init__(self, label : str, file : str | None, status : str, errors : list[str] = None, changes : dict = None) -> None:
+        self.label = label
+        self.file = file
+        self.status = status
+        self.errors = errors or []
+        self.changes = changes or {}
+
+    def to_dict(self) -> dict:
+        return {"label": self.label, "file": self.file, "status": self.status, "errors": self.errors, "changes": {tag:[old, new] for tag, (old, new) in self.changes.items()}}
+
+    def __repr__(self) -> str:
+        return f"<RewriteResult {self.label} {self.status} {self.errors}>"
+
+
+def _add_tags(ds : dicom.Dataset, row_tags : dict) -> list[str]:
+    errors = []
+    for col, val in row_tags.items():
+        info = validation.resolve(col)
+        if info is None:
+            # a private or unknown tag passes the column check but has no VR to be added with
+            errors.append(f"error for {Tag(col)} {col} - {val} : not in the DICOM dictionary")
+            continue
+        tag, vr, caster = info
+        try:
+            if caster is None:
+                raise NotImplementedError("cast for SQ not implemented")
+            ds.add(dicom.DataElement(tag, vr, caster(val)))
+        except Exception as error:
+            #continue even if a tag wasn't added
+            errors.append(f"error for {tag} {col} - {val} : {error}")
+    return errors
+
+def _pixel_data_offset(fp) -> int | None:
+    """Offset of the pixel data element once the file has been read with stop_before_pixels, None if it's not there"""
+    offset = fp.tell()
+    raw = fp.read(4)
+    if len(raw) == 0:
+        # no pixel data, the header is the whole file
+        return offset
+    if len(raw) < 4:
+        return None
+    for byte_order in ("<", ">"):
+        group, element = struct.unpack(f"{byte_order}HH", raw)
+        if (group << 16 | element) in PIXEL_DATA_TAGS:
+            return offset
+    return None
+
+def _copy_range(src, dst, offset : int):
+    # copy the end of src to dst without going through Python when possible
+    src.seek(0, os.SEEK_END)
+    count = src.tell() - offset
+    dst.flush()
+    try:
+        while count > 0:
+            sent = os.sendfile(dst.fileno(), src.fileno(), offset, count)
+            if sent == 0:
+                break
+            offset += sent
+            count -= sent
+        if count == 0:
+            return
+    except (AttributeError, OSError):
+        # no sendfile on this platform or for these files
+        pass
+    src.seek(offset)
+    shutil.copyfileobj(src, dst, COPY_SIZE)
+
+def _read_header(src) -> tuple[dicom.Dataset, int] | None:
+    """(header, offset of the pixel data) of an open file, None if the pixel data can't be copied as is"""
+    ds = dicom.dcmread(src, stop_before_pixels=True)
+    if "TransferSyntaxUID" in ds.file_meta and ds.file_meta.TransferSyntaxUID == DeflatedExplicitVRLittleEndian:
+        # the whole dataset is compressed
+        return None
+    offset = _pixel_data_offset(src)
+    if offset is None:
+        return None
+    return ds, offset
+
+def instance_header(path : str, row_tags : dict) -> tuple[bytes, int] | None:
+    """Header of a DICOM file with the tags added, nothing is written
+
+    The file with the tags is the header followed by the end of the file from offset, as is.
+
+    Returns:
+        tuple: (header, offset), None if a tag can't be added to the header only
+    """
+    for col in row_tags:
+        info = validation.resolve(col)
+        if info is None or info[0] >= PIXEL_DATA_GROUP:
+            return None
+    with open(path, "rb") as src:
+        try:
+            header = _read_header(src)
+        except (InvalidDicomError, OSError, ValueError):
+            return None
+        if header is None:
+            return None
+        ds, offset = header
+        with warnings.catch_warnings():
+            # a value not conform to its VR is refused
+            warnings.simplefilter("error")
+            if len(_add_tags(ds, row_tags)) > 0:
+                return None
+        if "SOPInstanceUID" in row_tags:
+            ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+        header = io.BytesIO()
+        ds.save_as(header)
+    return header.getvalue(), offset
+
+def patch_file(path : str, row_tags : dict) -> list[str] | None:
+    """Add the tags by rewriting only the header of the file, the pixel data is copied as is
+
+    Returns:
+        list[str]: the tags that couldn't be added, None if the file has to be fully rewritten
+    """
+    if any(Tag(col) >= PIXEL_DATA_GROUP for col in row_tags):
+        # would have to be written after the pixel data
+        return None
+    with open(path, "rb") as src:
+        header = _read_header(src)
+        if header is None:
+            return None
+        ds, offset = header
+
+        errors = _add_tags(ds, row_tags)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "wb") as dst:
+                ds.save_as(dst)
+                _copy_range(src, dst, offset)
+            shutil.copymode(path, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return errors
+
+def header_changes(path : str, row_tags : dict) -> dict | None:
+    """Tags whose value in the header of the file differs from row_tags, nothing is written
+
+    Returns:
+        dict: {tag name: (current value or None, new value)}, None if the file isn't a DICOM file
+    """
+    try:
+        ds = dicom.dcmread(path, stop_before_pixels=True)
+    except (InvalidDicomError, OSError):
+        return None
+    changes = dict()
+    for col, val in row_tags.items():
+        info = validation.resolve(col)
+        new_val = str(val)
+        if info is None or info[0] not in ds:
+            changes[col] = (None, new_val)
+            continue
+        old_val = ds[info[0]].value
+        old_val = None if old_val is None else str(old_val)
+        if old_val != new_val:
+            changes[col] = (old_val, new_val)
+    return changes
+
+def rewrite_file(job : tuple[str, str, dict, bool, bool]) -> RewriteResult:
+    """Add the tags to a DICOM file and save it in place, runs in a worker process
+
+    Args:
+        job (tuple): (label, path, {tag name: value}, try to only rewrite the header, only compute the changes)
+    """
+    label, path, row_tags, header_only, dry_run = job
+    errors = []
+    if dry_run:
+        changes = header_changes(path, row_tags)
+        if changes is None:
+            return RewriteResult(label, path, "error", ["not a DICOM file"])
+        return RewriteResult(label, path, "planned", changes=changes)
+    try:
+        with warnings.catch_warnings():
+            # a value not conform to its VR is refused
+            warnings.simplefilter("error")
+            if header_only:
+                errors = patch_file(path, row_tags)
+                if errors is not None:
+                    return RewriteResult(label, path, "patched", errors)
+            ds = dicom.dcmread(path)
+            errors = _add_tags(ds, row_tags)
+            ds.save_as(path)
+    except Exception as error:
+        return RewriteResult(label, path, "error", (errors or []) + [str(error)])
+    return RewriteResult(label, path, "updated", errors)
+
+def rewrite_files(jobs : list[tuple[str, str, dict, bool, bool]], max_workers : int | None = MAX_PROCESSES) -> list[RewriteResult]:
+    """Rewrite the files over a process pool, the results are in the order of the jobs"""
+    if max_workers == 1 or len(jobs) <= 1:
+        return [rewrite_file(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(rewrite_file, jobs, chunksize=CHUNK_SIZE))
+
+def check_columns(columns : list[str], label : str):
+    """Check that all the columns, except the label, are DICOM tags
+
+    A private or unknown tag is accepted as long as it can be parsed, the files then report it as an error.
+
+    Raises:
+        ValueError: a column isn't a tag
+    """
+    for col in columns:
+        if col == label:
+            continue
+        try:
+            Tag(col)
+        except (ValueError, TypeError, OverflowError):
+            raise ValueError(f"{col} is not a valid tag") from None
+
+def update_tags(files : dict[str, str], columns : list[str], rows : list[dict], label : str, max_workers : int | None = MAX_PROCESSES, header_only : bool = HEADER_ONLY, dry_run : bool = False) -> list[RewriteResult]:
+    """Add the tags of each row to the file of its label
+
+    Args:
+        files (dict): label -> path of the selected files
+        columns (list[str]): header of the CSV, checked even if there is no row
+        rows (list[dict]): one dict per file, with the label in the label column and a DICOM tag name for each other column
+        label (str): name of the label column
+        header_only (bool): only rewrite the header when the pixel data can be copied as is
+        dry_run (bool): don't write anything, only report the changes of each file
+
+    Raises:
+        ValueError: a column isn't a DICOM tag, see check_columns
+    """
+    check_columns(columns, label)
+
+    results = []
+    jobs = []
+    for row in rows:
+        image_label = row[label]
+        if not image_label in files:
+            results.append(RewriteResult(image_label, None, "not_selected"))
+            continue
+        jobs.append((image_label, os.fspath(files[image_label]), {col:val for col, val in row.items() if col != label}, header_only, dry_run))
+
+    return results + rewrite_files(jobs, max_workers)
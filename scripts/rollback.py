@@ -0,0 +1,130 @@
+# Canathist Automizer Tags 2023
+
+# Copyright (C) 2023 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU General Public License as
+
+# published by the Free Software Foundation, either version 3 of the
+
+# License, or (at your option) any later version.
+
+# 
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU General Public License
+
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from . import tags
+from .metrics import metrics
+
+# Number of DELETE requests sent at the same time
+MAX_DELETES = 8
+# Delete through /tools/bulk-delete when the server has it
+BULK_DELETE = True
+# Number of resources per bulk request
+BULK_SIZE = 1000
+
+DELETE = {
+    "studies": tags.delete_studies,
+    "series": tags.delete_series,
+    "instances": tags.delete_instance,
+}
+
+
+class RollbackReport:
+    """Result of a rollback
+
+    Attributes:
+        deleted : list of (level, id) removed from Orthanc, or already gone
+        failed : list of (level, id, error) that could not be removed
+    """
+
+    def __init__(self) -> None:
+        self.deleted : list[tuple[str, str]] = []
+        self.failed : list[tuple[str, str, str]] = []
+
+    def is_complete(self) -> bool:
+        return len(self.failed) == 0
+
+    def to_dict(self) -> dict:
+        return {
+            "deleted": [{"level": level, "id": id} for level, id in self.deleted],
+            "failed": [{"level": level, "id": id, "error": error} for level, id, error in self.failed],
+        }
+
+
+def _delete(resource : tuple[str, str]) -> str | None:
+    # error message, None once the resource doesn't exist anymore
+    level, id = resource
+    try:
+        DELETE[level](id)
+    except requests.exceptions.HTTPError as e:
+        if e.response is not None and e.response.status_code == 404:
+            return None
+        return str(e)
+    except Exception as e:
+        return str(e)
+    return None
+
+def _bulk_delete(resources : list[tuple[str, str]]) -> bool:
+    try:
+        tags.bulk_delete([id for _, id in resources])
+    except Exception as e:
+        # unknown route on older servers, or a resource the server refused
+        metrics.event("bulk_delete_failed", count=len(resources), error=str(e))
+        return False
+    return True
+
+def delete_resources(resources : list[tuple[str, str]], max_workers : int = MAX_DELETES, bulk : bool = BULK_DELETE) -> RollbackReport:
+    """Delete resources from Orthanc concurrently
+
+    Deleting a study or a series also deletes its children, so only the highest created level of a
+    resource needs to be given. Resources are sent BULK_SIZE at a time to /tools/bulk-delete if bulk,
+    the ones of a refused bulk request are deleted one by one with max_workers requests in flight.
+
+    Args:
+        resources (list): (level, id) with level one of "studies", "series", "instances"
+    """
+    report = RollbackReport()
+    remaining = []
+    if bulk:
+        for i in range(0, len(resources), BULK_SIZE):
+            chunk = resources[i:i + BULK_SIZE]
+            if _bulk_delete(chunk):
+                report.deleted.extend(chunk)
+            else:
+                remaining.extend(chunk)
+                # don't try again with the next chunks, the server is likely too old
+                remaining.extend(resources[i + BULK_SIZE:])
+                break
+    else:
+        remaining = list(resources)
+    if len(remaining) > 0:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for resource, error in zip(remaining, pool.map(_delete, remaining)):
+                if error is None:
+                    report.deleted.append(resource)
+                else:
+                    report.failed.append((*resource, error))
+    for level, id, error in report.failed:
+        metrics.event("delete_failed", level=level, id=id, error=error)
+    return report
@@ -0,0 +1,323 @@
+# Canathist Automizer Tags 2023
+
+# Copyright (C) 2023 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU General Public License as
+
+# published by the Free Software Foundation, either version 3 of the
+
+# License, or (at your option) any later version.
+
+# 
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU General Public License
+
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+
+from . import tags
+from .journal import Journal, fingerprint
+from .cache import DedupCache
+from .metrics import metrics
+from .rollback import RollbackReport, delete_resources, MAX_DELETES
+
+# Number of instances uploaded at the same time
+MAX_WORKERS = 8
+# Number of studies uploaded at the same time
+MAX_STUDIES = 2
+
+
+class InstanceJob:
+    """One file to upload
+
+    Attributes:
+        file : file given to tags.send_request
+        tags : dict of the tags not already set by a parent module
+        instance_number : int
+        conflicts : list of (tag, module value, new value)
+        item : whatever the caller wants to get back with the result
+    """
+
+    def __init__(self, file, tags : dict, instance_number : int, conflicts : list = None, item = None) -> None:
+        self.file = file
+        self.tags = tags
+        self.instance_number = instance_number
+        self.conflicts = conflicts or []
+        self.item = item
+        self.id = None
+        # found in the journal or in the cache, not uploaded again
+        self.resumed = False
+
+
+class SeriesJob:
+
+    def __init__(self, name : str, instances : list[InstanceJob], item = None) -> None:
+        self.name = name
+        self.instances = instances
+        self.item = item
+        self.id = None
+        # created by this run, not resumed
+        self.created = False
+
+
+class StudyJob:
+
+    def __init__(self, name : str, series : list[SeriesJob], item = None) -> None:
+        self.name = name
+        self.series = series
+        self.item = item
+        self.id = None
+        self.error : Exception = None
+        # created by this run, not resumed
+        self.created = False
+        # everything created by this run has been deleted
+        self.deleted = False
+
+    def instances(self):
+        for series in self.series:
+            yield from series.instances
+
+    def conflicts(self):
+        return [instance for instance in self.instances() if len(instance.conflicts) > 0]
+
+    def created_resources(self) -> list[tuple[str, str]]:
+        """(level, id) of the resources created by this run, without the children of a created resource"""
+        if self.created:
+            return [("studies", self.id)]
+        resources = []
+        for series in self.series:
+            if series.created:
+                resources.append(("series", series.id))
+                continue
+            resources.extend(("instances", instance.id) for instance in series.instances if instance.id and not instance.resumed)
+        return resources
+
+
+def plan_study(name : str, series : list[tuple[str, list[tuple]]], item = None) -> StudyJob:
+    """Resolve the tags of every instance of a study against its patient/study/series modules
+
+    The first instance that sets a module tag defines it, the next instances don't send it again
+    and a different value is reported as a conflict.
+
+    Args:
+        name (str): name of the study
+        series (list): (series name, [(file, tags, item)], series item) for each series
+    """
+    patient_module = dict()
+    study_module = dict()
+    series_jobs = []
+    for series_name, files, series_item in series:
+        series_module = dict()
+        instances = []
+        for instance_number, (file, file_tags, file_item) in enumerate(files):
+            conflicts = [(tag, val_module, file_tags[tag]) for module in (patient_module, study_module, series_module) for tag, val_module in module.items() if tag in file_tags and val_module != file_tags[tag]]
+            tags_dict = {tag:val for tag, val in file_tags.items() if tag not in patient_module and tag not in study_module and tag not in series_module}
+
+            patient_module.update({tag:val for tag, val in tags_dict.items() if tag in tags.TAG_PATIENT})
+            study_module.update({tag:val for tag, val in tags_dict.items() if tag in tags.TAG_STUDY})
+            series_module.update({tag:val for tag, val in tags_dict.items() if tag in tags.TAG_SERIES})
+            instances.append(InstanceJob(file, tags_dict, instance_number, conflicts, file_item))
+        series_jobs.append(SeriesJob(series_name, instances, series_item))
+    return StudyJob(name, series_jobs, item)
+
+
+class UploadScheduler:
+    """Upload studies with bounded concurrency
+
+    The first instance of a study creates the patient, the study and its series, the first instance of
+    each other series creates its series in that study. Once its parent exists, every other instance is
+    independent and is sent through a thread pool of max_workers. Up to max_studies studies run in parallel.
+
+    With a journal, the instances already uploaded by a previous run are not sent again, as long as their
+    parents are the ones recorded with them. The study and the series recorded by that run, if they still
+    exist, receive the instances sent again, a changed first file included, instead of new ones being created.
+    With a cache, an instance created from the same content and tags in the same parent, under any name,
+    is reused if it still exists.
+    """
+
+    def __init__(self, max_workers : int = MAX_WORKERS, max_studies : int = MAX_STUDIES, journal : Journal = None, cache : DedupCache = None) -> None:
+        self.max_workers = max_workers
+        self.max_studies = max_studies
+        self.journal = journal
+        self.cache = cache
+        self.callback = None
+
+    def run(self, studies : list[StudyJob], callback = None) -> list[StudyJob]:
+        """Upload the studies and return them with their ids and errors filled in
+
+        Args:
+            studies (list[StudyJob]): planned studies
+            callback: called with (study, series, instance) from the worker threads once an instance is uploaded
+        """
+        # one connection per request in flight
+        tags.client.set_pool_size(self.max_workers + self.max_studies)
+        self.callback = callback
+        self._prefetch(studies)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool, ThreadPoolExecutor(max_workers=self.max_studies) as study_pool:
+            futures = [study_pool.submit(self._run_study, study, pool) for study in studies]
+            wait(futures)
+        return studies
+
+    def rollback(self, studies : list[StudyJob], max_workers : int = MAX_DELETES) -> RollbackReport:
+        """Delete concurrently what has been created by the upload of the studies
+
+        What was resumed from the journal or the cache is kept. A study is marked as deleted once all
+        of its created resources are removed.
+        """
+        resources = {study.name:study.created_resources() for study in studies}
+        report = delete_resources([resource for study_resources in resources.values() for resource in study_resources], max_workers)
+        deleted_ids = [id for _, id in report.deleted]
+        if self.journal:
+            self.journal.forget_resources(deleted_ids)
+        if self.cache:
+            self.cache.forget_resources(deleted_ids)
+        failed = set(id for _, id, _ in report.failed)
+        for study in studies:
+            study.deleted = not any(id in failed for _, id in resources[study.name])
+        return report
+
+    def _resume(self, study : StudyJob, series : SeriesJob, instance : InstanceJob, parent : str, content : str) -> tuple[str, dict | None]:
+        # (fingerprint, response recorded in the journal if its parent is still the right one)
+        file = tags.to_path(instance.file)
+        hash = fingerprint(str(file), {**instance.tags, "InstanceNumber":f"{instance.instance_number}"}, content)
+        row = self.journal.lookup(study.name, series.name, file.name, hash)
+        if row is None:
+            return hash, None
+        instance_id, series_id, study_id = row
+        # recorded in the parent it is sent to, a series or the resumed study
+        if not parent or (series_id if parent == series.id else study_id) != parent:
+            return hash, None
+        return hash, {"ID": instance_id, "ParentSeries": series_id, "ParentStudy": study_id}
+
+    def _deduplicate(self, instance : InstanceJob, parent : str, content : str) -> tuple[str, dict | None]:
+        # (cache key, response of the same content and tags sent to the same parent if the instance still exists)
+        key = self.cache.key(content, {**instance.tags, "InstanceNumber":f"{instance.instance_number}"}, parent)
+        row = self.cache.lookup(key)
+        if row is None:
+            return key, None
+        if not tags.resource_exists("instances", row[0]):
+            self.cache.forget(key)
+            return key, None
+        return key, {"ID": row[0], "ParentSeries": row[1], "ParentStudy": row[2]}
+
+    def _prepare(self, study : StudyJob, series : SeriesJob, instance : InstanceJob, parent : str) -> tuple[dict | None, tuple]:
+        # (response found in the journal or the cache, what _finish needs to record a new one)
+        response = None
+        content, size = None, 0
+        hash = key = None
+        if self.cache:
+            with metrics.timer("hash"):
+                content, size = self.cache.content_hash(str(tags.to_path(instance.file)))
+        if self.journal:
+            hash, response = self._resume(study, series, instance, parent, content)
+        journaled = response is not None
+        if self.cache and response is None:
+            key, response = self._deduplicate(instance, parent, content)
+        instance.resumed = response is not None
+        return response, (journaled, hash, key, size)
+
+    def _finish(self, study : StudyJob, series : SeriesJob, instance : InstanceJob, parent : str, response : dict, state : tuple):
+        journaled, hash, key, size = state
+        if not instance.resumed:
+            if instance is series.instances[0]:
+                # no series or study was resumed, this instance has created them
+                if series.id is None:
+                    series.created = True
+                if study.id is None:
+                    study.created = True
+            if self.cache:
+                self.cache.record(key, size, response["ID"], response["ParentSeries"], response["ParentStudy"])
+        if self.journal and not journaled:
+            self.journal.record(study.name, series.name, tags.to_path(instance.file).name, hash, response["ID"], response["ParentSeries"], response["ParentStudy"])
+        metrics.add("instances_resumed" if instance.resumed else "instances_uploaded")
+        metrics.event("instance", study=study.name, series=series.name, file=tags.to_path(instance.file).name,
+                      id=response["ID"], series_id=response["ParentSeries"], study_id=response["ParentStudy"], resumed=instance.resumed)
+        instance.id = response["ID"]
+        if instance is series.instances[0]:
+            series.id = response["ParentSeries"]
+            study.id = response["ParentStudy"]
+        if self.callback:
+            self.callback(study, series, instance)
+
+    def _request_tags(self, series : SeriesJob, instance : InstanceJob, parent : str) -> dict:
+        # the first instance of a series sent to a resumed study or series : Orthanc refuses to override the
+        # values of the modules of its parent, the other instances don't have them anymore (see plan_study)
+        if instance is not series.instances[0] or not parent:
+            return instance.tags
+        modules = (tags.TAG_PATIENT, tags.TAG_STUDY, tags.TAG_SERIES) if parent == series.id else (tags.TAG_PATIENT, tags.TAG_STUDY)
+        return {tag:val for tag, val in instance.tags.items() if not any(tag in module for module in modules)}
+
+    def _send(self, study : StudyJob, series : SeriesJob, instance : InstanceJob, parent : str) -> dict:
+        response, state = self._prepare(study, series, instance, parent)
+        if response is None:
+            with metrics.timer("upload", study=study.name, series=series.name):
+                response = tags.send_request(instance.file, self._request_tags(series, instance, parent), parent, instance.instance_number,
+                                             in_series=parent == series.id)
+        self._finish(study, series, instance, parent, response, state)
+        return response
+
+    def _send_first(self, study : StudyJob, series : SeriesJob, parent : str):
+        self._send(study, series, series.instances[0], parent)
+
+    def _wait(self, futures : list):
+        done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in not_done:
+            future.cancel()
+        for future in done:
+            # raise the first error
+            future.result()
+
+    def _resume_study(self, study : StudyJob):
+        if self.journal:
+            # the study recorded by a previous run, if it still exists
+            study.id = self.journal.study_id(study.name)
+            if study.id and not tags.resource_exists("studies", study.id):
+                self.journal.forget_study(study.id)
+                study.id = None
+            if study.id:
+                # and its series, the first instance of a series goes to it even if it has changed
+                recorded = self.journal.series_ids(study.name, study.id)
+                for series in study.series:
+                    series_id = recorded.get(series.name)
+                    if series_id and tags.resource_exists("series", series_id):
+                        series.id = series_id
+
+    def _prefetch(self, studies : list[StudyJob]):
+        if self.journal:
+            # the studies to resume are checked before their upload, all at once
+            study_ids = [self.journal.study_id(study.name) for study in studies]
+            tags.prefetch([("studies", id) for id in study_ids if id], modules=False)
+
+    def _run_study(self, study : StudyJob, pool : ThreadPoolExecutor):
+        series_list = [series for series in study.series if len(series.instances) > 0]
+        if len(series_list) == 0:
+            return
+        metrics.event("study", study=study.name)
+        try:
+            self._resume_study(study)
+
+            # creates the patient and the study, unless they are resumed
+            first = series_list[0]
+            self._send_first(study, first, first.id or study.id or "")
+
+            # creates the other series inside the study
+            self._wait([pool.submit(self._send_first, study, series, series.id or study.id) for series in series_list[1:]])
+
+            self._wait([pool.submit(self._send, study, series, instance, series.id) for series in series_list for instance in series.instances[1:]])
+        except Exception as e:
+            study.error = e
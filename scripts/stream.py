@@ -0,0 +1,192 @@
+# Canathist Automizer Tags 2023
+
+# Copyright (C) 2023 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU General Public License as
+
+# published by the Free Software Foundation, either version 3 of the
+
+# License, or (at your option) any later version.
+
+# 
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU General Public License
+
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import binascii
+import json
+import mimetypes
+import mmap
+import os
+import time
+from contextlib import contextmanager
+
+from .metrics import metrics
+
+# Must be a multiple of 3 so that the base64 chunks can be concatenated without padding
+CHUNK_SIZE = 3 * 256 * 1024
+
+def guess_mime(path : str) -> str:
+    mime = mimetypes.guess_type(path)[0]
+    if mime == None:
+        mime = "application/octet-stream"
+    return mime
+
+def base64_size(size : int) -> int:
+    return 4 * ((size + 2) // 3)
+
+@contextmanager
+def map_file(path : str):
+    """Read-only memoryview of a file, mapped in memory instead of read into a copy"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # an empty file can't be mapped
+            yield memoryview(b"")
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, "madvise"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mapped)
+            try:
+                yield view
+            finally:
+                view.release()
+
+def encode(path : str) -> bytes:
+    """base64 of a whole file, without a copy of its content"""
+    with metrics.timer("encode", file=path), map_file(path) as view:
+        metrics.add("bytes_read", len(view))
+        return binascii.b2a_base64(view, newline=False)
+
+def iter_base64(path : str, chunk_size : int = CHUNK_SIZE):
+    """Yield the base64 encoding of a file chunk by chunk
+
+    The file is mapped in memory and each chunk is encoded straight from the mapping, the pages are
+    read by the OS while the chunk is encoded.
+
+    Args:
+        path (str): path of the file to encode
+        chunk_size (int): number of raw bytes encoded at once, must be a multiple of 3
+    """
+    if chunk_size % 3 != 0:
+        raise ValueError(f"chunk_size must be a multiple of 3, got {chunk_size}")
+    encode_time = 0.0
+    with map_file(path) as view:
+        size = len(view)
+        for offset in range(0, size, chunk_size):
+            start = time.perf_counter()
+            encoded = binascii.b2a_base64(view[offset:offset + chunk_size], newline=False)
+            encode_time += time.perf_counter() - start
+            yield encoded
+    metrics.observe("encode", encode_time, file=path, bytes=size)
+    metrics.add("bytes_read", size)
+
+def data_uri_prefix(path : str) -> bytes:
+    return f"data:{guess_mime(path)};base64,".encode('utf-8')
+
+def iter_data_uri(path : str, chunk_size : int = CHUNK_SIZE):
+    yield data_uri_prefix(path)
+    yield from iter_base64(path, chunk_size)
+
+def _json_parts(params : dict, content : str | list[str], data_uri : bool) -> list:
+    # JSON text as bytes, paths (str) where a file is encoded as a string
+    with metrics.timer("serialise"):
+        head = b'{' + "".join(f"{json.dumps(key)}: {json.dumps(val)}, " for key, val in params.items()).encode('utf-8')
+    parts = [head, b'"Content": ']
+    paths = content if isinstance(content, list) else [content]
+    if isinstance(content, list):
+        parts.append(b'[')
+    for i, path in enumerate(paths):
+        if i > 0:
+            parts.append(b', ')
+        # base64 only uses JSON-safe characters so the chunks don't need escaping
+        parts.extend((b'"', path, b'"'))
+    if isinstance(content, list):
+        parts.append(b']')
+    parts.append(b'}')
+    return parts
+
+def iter_json_body(params : dict, content : str | list[str], data_uri : bool = True, chunk_size : int = CHUNK_SIZE):
+    """Yield a JSON request body where "Content" is encoded while it is sent
+
+    Only one chunk of each file is held in memory at a time, whatever the size of the series.
+
+    Args:
+        params (dict): every JSON field except "Content"
+        content (str | list[str]): a path gives a single string, a list of paths gives a list of strings
+        data_uri (bool): encode as data URIs (tools/create-dicom) or as raw base64 (stl/create-nexus)
+    """
+    yield from _iter_parts(_json_parts(params, content, data_uri), data_uri, chunk_size)
+
+def _iter_parts(parts : list, data_uri : bool, chunk_size : int):
+    encode = iter_data_uri if data_uri else iter_base64
+    for part in parts:
+        if isinstance(part, str):
+            yield from encode(part, chunk_size)
+        else:
+            yield part
+
+def json_body(params : dict, content : str | list[str], data_uri : bool = True, chunk_size : int = CHUNK_SIZE) -> bytearray:
+    """Same body as iter_json_body, in one buffer of the exact size filled chunk by chunk
+
+    The body is the only full-size copy, instead of the content read, then encoded, then decoded to a
+    str, then dumped to JSON.
+    """
+    parts = _json_parts(params, content, data_uri)
+    size = 0
+    for part in parts:
+        if isinstance(part, str):
+            size += base64_size(os.path.getsize(part)) + (len(data_uri_prefix(part)) if data_uri else 0)
+        else:
+            size += len(part)
+    body = bytearray(size)
+    view = memoryview(body)
+    offset = 0
+    for chunk in _iter_parts(parts, data_uri, chunk_size):
+        view[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+    view.release()
+    if offset != size:
+        # a file changed size while it was encoded
+        raise ValueError(f"Body of {size} bytes expected, {offset} written")
+    return body
+
+def iter_file(path : str, head : bytes = b"", offset : int = 0, chunk_size : int = CHUNK_SIZE):
+    """Yield head then the file from offset, as is"""
+    yield head
+    size = 0
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while chunk := f.read(chunk_size):
+            size += len(chunk)
+            yield chunk
+    metrics.add("bytes_read", size)
+
+def file_body(path : str, head : bytes = b"", offset : int = 0) -> bytearray:
+    """Same body as iter_file, the file is read straight into a buffer of the exact size"""
+    size = os.path.getsize(path) - offset
+    body = bytearray(len(head) + size)
+    body[:len(head)] = head
+    with open(path, 'rb') as f, memoryview(body) as view:
+        f.seek(offset)
+        read = f.readinto(view[len(head):])
+    if read != size:
+        # the file changed size while it was read
+        raise ValueError(f"{size} bytes expected from {path}, {read} read")
+    metrics.add("bytes_read", size)
+    return body
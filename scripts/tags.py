@@ -28,31 +28,25 @@
 
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
-import base64
-import mimetypes
 
 from collections import defaultdict, deque
 
-import pandas as pd
-import json
-
-from PySide6.QtCore import (
-    QFileInfo
-)
-
-import warnings
-
-import pydicom as dicom
-from pydicom.datadict import dictionary_VR
-from pydicom.tag import Tag
-from pydicom.valuerep import VR, FLOAT_VR, INT_VR, STR_VR, BYTES_VR
+from pathlib import Path
 
 import requests
-from requests.auth import HTTPBasicAuth
+from pydicom.uid import generate_uid
 
 import glob
+from concurrent.futures import ThreadPoolExecutor
 
 from . import types
+from . import stream
+from . import validation
+from . import manifest
+from . import rewrite
+from .client import OrthancClient
+from .cache import LookupCache
+from .metrics import metrics
 
 
 TAG_PATIENT = {
@@ -133,234 +127,379 @@ class OrthancProcessError(OrthancRequestError):
         return f"The Request failed for {self.file} of {self.series} for the following reason : {self.message}\n{self.details}"
 
 
-FILE_NAME = "Label"
+FILE_NAME = manifest.FILE_NAME
 STATUS_OK = 200
 
-basic = HTTPBasicAuth('orthanc', 'orthanc')
-
-def encode_file(file : QFileInfo):
-    with open(file.absoluteFilePath(), 'rb') as file_to_convert:
-        return  base64.b64encode(file_to_convert.read())
+client = OrthancClient()
+
+def set_client(orthanc_client : OrthancClient):
+    """Replace the client used by every request of this module"""
+    global client
+    client = orthanc_client
+    lookups.clear()
+    inherited.clear()
+
+# Encode the files while the request is sent instead of building the whole JSON body in memory
+STREAM_UPLOAD = True
+
+# Send the files that are already DICOM to /instances with the tags added to their header, instead of their
+# base64 in a tools/create-dicom request. Off by default, enabled by --raw-dicom or the checkbox of the GUI
+RAW_DICOM = False
+
+# answers of the GET requests on modules and parents, invalidated by the requests of this module
+lookups = LookupCache()
+# tags the instances sent to /instances take from their parent, which adding an instance doesn't change :
+# only invalidated by the deletes
+inherited = LookupCache()
+
+def forget(*ids : str):
+    """Invalidate what is cached about deleted resources"""
+    lookups.invalidate(*ids)
+    inherited.invalidate(*ids)
+
+def to_path(file) -> Path:
+    """Absolute path of a QFileInfo or of any path-like, this module doesn't depend on Qt"""
+    if hasattr(file, "absoluteFilePath"):
+        return Path(file.absoluteFilePath())
+    return Path(file).absolute()
+
+def encode_file(file : Path) -> bytes:
+    return stream.encode(str(to_path(file)))
     
-def to_data_uri(file : QFileInfo):
+def to_data_uri(file : Path):
     encoded_string = encode_file(file)
     
-    mime = mimetypes.guess_type(file.absoluteFilePath())[0]
-    if mime == None:
-        mime = "application/octet-stream"    
-    # There's a mime type
+    mime = stream.guess_mime(str(to_path(file)))
     return f"data:{mime};base64,{encoded_string.decode('utf-8')}"
 
 def check_cast(vr, val):
-    if vr == VR.AT:
-        # if it's an Attribute
-        return Tag(val)
-    
-    if vr in STR_VR:
-        return str(val)
-    
-    if vr in INT_VR:
-        return int(val)
-    
-    if vr in FLOAT_VR:
-        return float(val)
-    
-    if vr in BYTES_VR:
-        return bytes(val)
-    
-    raise NotImplementedError("cast for SQ not implemented")
+    caster = validation.get_caster(vr)
+    if caster is None:
+        raise NotImplementedError("cast for SQ not implemented")
+    return caster(val)
 
-def check_tags(tags : QFileInfo):
-    with open(tags.absoluteFilePath(), "+r") as f:
-        tags_json : dict = json.load(f)
+def check_tags(tags : Path):
+    report = manifest.validate(to_path(tags))
     
     potential_bad_tags = defaultdict(lambda : defaultdict(lambda: defaultdict(lambda: set())))
-    dict_tags = dict()
-    
-    for study_name, study in tags_json.items():
-        study_tags = {}
-        for series_name, series in study.items():
-            series_tags = []
-            for file_name, file_info in series["files"].items():
-                dicom_tags = dict()
-                for tag_name, val in file_info["tags"].items():
-                    try:
-                        #Check that all the columns (except the name of the file) are DICOM Standard tags
-                        tag = Tag(tag_name)
-                        dicom_tags[tag_name] = check_cast(dictionary_VR(tag), val)
-                    except:
-                        # Error Column name not a valid Name but possibly a private tag
-                        potential_bad_tags[study_name][series_name][file_name].add(tag_name)    
-                        dicom_tags[tag_name] = val
-                series_tags.append((file_name, dicom_tags))
-            study_tags[series_name] = series_tags
-        dict_tags[study_name] = study_tags
+    for errors in (report.bad_tags, report.bad_values):
+        for study_name, series_dict in errors.items():
+            for series_name, files in series_dict.items():
+                for file_name, names in files.items():
+                    potential_bad_tags[study_name][series_name][file_name].update(names)
     
+    dict_tags = {study_name:{series_name:list(files.items()) for series_name, files in study.items()} for study_name, study in report.tags.items()}
     
     # dicts : Series -> file -> tag
     return dict_tags, potential_bad_tags
 
 def check_tag(tag_name : str, val):
-    try:
-        #Check that all the columns (except the name of the file) are DICOM Standard tags
-        tag = Tag(tag_name)
-        return True, check_cast(dictionary_VR(tag), val)
-    except:
-        # Error Column name not a valid Name but possibly a private tag
-        return False, val
-
-def send_request(file : QFileInfo, tags : dict, parent : str, instance_number : int = 1) -> dict:
+    casted, bad = validation.cast_column(tag_name, [val])
+    return len(bad) == 0, casted[0]
+
+def send_request(file : Path, tags : dict, parent : str, instance_number : int = 1, streamed : bool = None, in_series : bool = None) -> dict:
+    """Upload a file with the first handler that takes it
+
+    Args:
+        in_series (bool): parent is a series and not a study, asked to Orthanc when None
+    """
+    file = to_path(file)
+    # read when called so STREAM_UPLOAD can be changed at run time
+    streamed = STREAM_UPLOAD if streamed is None else streamed
     if(not file.exists()):
-        raise OrthancRequestError("Bad Request", {'HttpStatus': 400, 'Details': "File doesn't exists"},file.fileName())
+        raise OrthancRequestError("File doesn't exists", "Bad Request", {'HttpStatus': 400, 'Details': "File doesn't exists"}, file.name)
     try:
         tags["InstanceNumber"] = f"{instance_number}"
-        ext = file.suffix()
-        if ext in types.extension:
-            return create_nexus(file, tags, parent)
-        else:
-            return create_dicom(file, tags, parent)
+        # the first handler of the file that sends it, see types.register
+        for handler in types.get_handlers(str(file)):
+            with handler.limit():
+                response_json = handler.send(file, tags, parent, streamed, in_series)
+            if response_json is not None:
+                return response_json
+        return None
     except requests.exceptions.HTTPError as e:
-        print(e.response.reason)
-        print(e.response.json())
-        raise OrthancRequestError(e.response.json()["Details"], e.response.json()["Message"], e.response.json(), file.fileName())
+        raise request_error(e, file.name)
+
+def request_error(e : requests.exceptions.HTTPError, file_name : str) -> OrthancRequestError:
+    response = e.response
+    status = response.status_code if response is not None else None
+    try:
+        answer = response.json()
+    except (AttributeError, ValueError):
+        # no answer, or not one of Orthanc : a proxy error page for example
+        answer = None
+    if not isinstance(answer, dict):
+        reason = getattr(response, "reason", None) or getattr(response, "reason_phrase", None) or str(e)
+        answer = {"HttpStatus": status, "Message": reason, "Details": response.text[:1000] if response is not None else str(e)}
+    metrics.event("request_error", status=status, file=file_name, answer=answer)
+    return OrthancRequestError(answer.get("Details", ""), answer.get("Message", ""), answer, file_name)
     
+def _get_json(path : str):
+    return client.get(path).json()
+
+def get_json(path : str):
+    """Answer of a GET request, from the lookup cache if it has been fetched recently. Don't modify it"""
+    return lookups.get(path, _get_json)
+
 def get_patient_module(id : str):
-    r = requests.get(f'http://localhost:8042/patients/{id}/module', auth=basic)
-    r.raise_for_status()
-    set_tags = {info['Name']:info["Value"] for tag, info in r.json().items()}
+    set_tags = {info['Name']:info["Value"] for tag, info in get_json(f'patients/{id}/module').items()}
     return set_tags
 
 def get_study_module(id : str):
-    r = requests.get(f'http://localhost:8042/studies/{id}/module', auth=basic)
-    r.raise_for_status()
-    set_tags = {info['Name']:info["Value"] for tag, info in r.json().items()}
+    set_tags = {info['Name']:info["Value"] for tag, info in get_json(f'studies/{id}/module').items()}
     return set_tags
     
 def get_series_module(id : str):
-    r = requests.get(f'http://localhost:8042/series/{id}/module', auth=basic)
-    r.raise_for_status()
-    set_tags = {info['Name']:info["Value"] for tag, info in r.json().items()}
+    set_tags = {info['Name']:info["Value"] for tag, info in get_json(f'series/{id}/module').items()}
     return set_tags
 
-def delete_instance(id : str):
-    print(f"Delete Instance : {id}")
-    r = requests.delete(f'http://localhost:8042/instances/{id}', auth=basic)
+def resource_exists(level : str, id : str) -> bool:
+    try:
+        get_json(f'{level}/{id}')
+    except requests.exceptions.HTTPError as e:
+        if e.response.status_code == 404:
+            return False
+        raise
+    return True
+
+def prefetch(resources : list[tuple[str, str]], modules : bool = True, max_workers : int = None):
+    """Fill the lookup cache with the resources and their modules, in parallel
 
-    r.raise_for_status()
+    Args:
+        resources (list): (level, id) with level one of "patients", "studies", "series", "instances"
+    """
+    paths = [path for level, id in resources for path in ((f'{level}/{id}', f'{level}/{id}/module') if modules else (f'{level}/{id}',))]
+    def fetch(path):
+        try:
+            get_json(path)
+        except requests.exceptions.HTTPError:
+            # the resource doesn't exist anymore, checked again when needed
+            pass
+    with ThreadPoolExecutor(max_workers=max_workers or client.pool_size) as pool:
+        list(pool.map(fetch, paths))
+
+def delete_instance(id : str):
+    metrics.event("delete", level="instances", id=id)
+    r = client.delete(f'instances/{id}')
+    forget(id)
     return r.json()
 
 def delete_series(id : str):
-    print(f"Delete series : {id}")
-    r = requests.delete(f'http://localhost:8042/series/{id}', auth=basic)
-
-    r.raise_for_status()
+    metrics.event("delete", level="series", id=id)
+    r = client.delete(f'series/{id}')
+    forget(id)
     return r.json()
 
 def delete_studies(id : str):
-    print(f"Delete studies : {id}")
-    r = requests.delete(f'http://localhost:8042/studies/{id}', auth=basic)
+    metrics.event("delete", level="studies", id=id)
+    r = client.delete(f'studies/{id}')
+    forget(id)
+    return r.json()
 
-    r.raise_for_status()
+def bulk_delete(ids : list[str]):
+    # Orthanc >= 1.9.4, resources of any level
+    metrics.event("delete", level="bulk", count=len(ids))
+    r = client.post('tools/bulk-delete', json={"Resources": ids})
+    forget(*ids)
     return r.json()
     
-def create_nexus(file : QFileInfo, tags : dict, parent : str) -> dict:
+def _json_body(params : dict, content : str | list[str], streamed : bool, data_uri : bool = True):
+    if streamed:
+        # generator body : sent with chunked transfer encoding, created again if the request is retried
+        return lambda: stream.iter_json_body(params, content, data_uri=data_uri)
+    # the JSON is written straight into a buffer of its final size
+    return stream.json_body(params, content, data_uri=data_uri)
+
+def invalidate_added(cache : LookupCache, parent : str, response_json : dict):
+    """Invalidate the resources an instance has been added to"""
+    cache.invalidate(parent, response_json.get("ParentPatient"))
+
+def nexus_body(file : Path, tags : dict, parent : str, streamed : bool = STREAM_UPLOAD):
+    """Body of a stl/create-nexus request, a function returning a generator if streamed"""
     # Is file with .nxs and .nxz format
     params = {
-        'Content' : encode_file(file).decode('utf-8'),
         'Tags' : tags,
     }
     if parent:
         params["Parent"] = parent
+    return _json_body(params, str(to_path(file)), streamed, data_uri=False)
 
-    r = requests.post(f'http://localhost:8042/{types.FileAPI.NEXUS.value}', auth=basic, data=json.dumps(params))
-
-    r.raise_for_status()
-    return r.json()
+def create_nexus(file : Path, tags : dict, parent : str, streamed : bool = STREAM_UPLOAD, in_series : bool = None) -> dict:
+    r = client.post(types.FileAPI.NEXUS.value, data=nexus_body(file, tags, parent, streamed))
+    response_json = r.json()
+    invalidate_added(lookups, parent, response_json)
+    return response_json
     
-
-def create_dicom(file : QFileInfo, tags : dict, parent : str) -> dict:
+def dicom_body(file : Path, tags : dict, parent : str, streamed : bool = STREAM_UPLOAD):
+    """Body of a tools/create-dicom request, a function returning a generator if streamed, None if there is no content"""
+    file = to_path(file)
     content = None
-    if file.isFile():
-        content = to_data_uri(file)
+    if file.is_file():
+        content = str(file)
     else:
-        if file.isDir():
-            content = []
-            list_files = sorted(glob.glob(f"{file.absoluteFilePath()}/*"))
-            for f in list_files:
-                content.append(to_data_uri(QFileInfo(f)))
+        if file.is_dir():
+            content = sorted(glob.glob(f"{file}/*"))
     params = {
-        'Content' : content,
         'Tags' : tags,
         "PrivateCreator": "Sphaeroptica",
     }
     if parent:
         params["Parent"] = parent
-    if content:
-        r = requests.post(f'http://localhost:8042/{types.FileAPI.DICOM.value}', auth=basic, data=json.dumps(params))
-
-        r.raise_for_status()
-        response_json = r.json()
-        if file.isDir():
-            parent_study_json = get_parent_study(response_json["ID"])
-            response_json["ParentSeries"] = response_json["ID"]
-            response_json["ParentStudy"] = parent_study_json["ID"]
-            response_json["ParentPatient"] = parent_study_json["ParentPatient"]
-        return response_json
-    return None
+    if not content:
+        return None
+    return _json_body(params, content, streamed)
+
+def instance_tags(tags : dict, parent : str, modules : list[dict], in_series : bool) -> dict:
+    """Tags of a file sent to /instances : those tools/create-dicom would take from the parent modules, new UIDs
+    for the resources it would create, then the tags of the instance
+
+    Args:
+        modules (list[dict]): the patient, study and series modules of the parent
+        in_series (bool): parent is a series
+    """
+    instance = {"SOPInstanceUID": generate_uid()}
+    if not parent:
+        instance["StudyInstanceUID"] = generate_uid()
+    if not in_series:
+        instance["SeriesInstanceUID"] = generate_uid()
+    for module in modules:
+        instance.update({tag:val for tag, val in module.items() if val is not None})
+    instance.update(tags)
+    return instance
+
+def _parent_modules(parent : str, in_series : bool) -> dict:
+    study = get_json(f'series/{parent}')["ParentStudy"] if in_series else parent
+    patient = get_json(f'studies/{study}')["ParentPatient"]
+    modules = [get_patient_module(patient), get_study_module(study)]
+    if in_series:
+        modules.append(get_series_module(parent))
+    # with its parents, so that deleting any of them invalidates it
+    return {"ID": parent, "ParentStudy": study, "ParentPatient": patient, "Modules": modules, "InSeries": in_series}
+
+def parent_modules(parent : str, in_series : bool = None) -> tuple[list[dict], bool]:
+    """(patient, study and series modules of the parent, parent is a series)
+
+    Args:
+        in_series (bool): parent is a series and not a study, asked to Orthanc when None
+    """
+    if not parent:
+        return [], False
+    value = inherited.cached(parent)
+    if value is None:
+        if in_series is None:
+            in_series = resource_exists("series", parent)
+        value = _parent_modules(parent, in_series)
+        inherited.put(parent, value)
+    return value["Modules"], value["InSeries"]
+
+def instance_body(file : Path, tags : dict, streamed : bool = STREAM_UPLOAD):
+    """Body of a POST on /instances, the header of the file with the tags then the rest of the file as is
+
+    Returns None if a tag can't be added to the header only, a function returning a generator if streamed.
+    """
+    path = str(to_path(file))
+    with metrics.timer("serialise", file=path):
+        header = rewrite.instance_header(path, tags)
+    if header is None:
+        return None
+    header, offset = header
+    if streamed:
+        return lambda: stream.iter_file(path, header, offset)
+    return stream.file_body(path, header, offset)
+
+def wrong_parent(response_json : dict, parent : str, in_series : bool, file : Path) -> OrthancRequestError | None:
+    """Error to raise when Orthanc has stored the instance elsewhere than in its parent
+
+    Its header only has the modules of the parent known here, if they don't match the ones of Orthanc
+    the instance goes to another patient, study or series.
+    """
+    if not parent:
+        return None
+    stored_in = response_json.get("ParentSeries" if in_series else "ParentStudy")
+    if stored_in == parent:
+        return None
+    level = "series" if in_series else "study"
+    return OrthancRequestError(f"Stored in the {level} {stored_in} instead of {parent}, the {level} has changed on Orthanc",
+                               "Wrong parent", response_json, to_path(file).name)
+
+def inherit(response_json : dict, parent : str, tags : dict):
+    """The instance has created its series : the next instances inherit the tags it has been sent with"""
+    series = response_json.get("ParentSeries")
+    if not series or series == parent:
+        return
+    module = {tag:val for tag, val in tags.items() if tag in TAG_PATIENT or tag in TAG_STUDY or tag in TAG_SERIES}
+    inherited.put(series, {"ID": series, "ParentStudy": response_json.get("ParentStudy"), "ParentPatient": response_json.get("ParentPatient"),
+                           "Modules": [module], "InSeries": True})
+
+def store_instance(file : Path, tags : dict, parent : str, streamed : bool = STREAM_UPLOAD, in_series : bool = None) -> dict | None:
+    """Upload a DICOM file as it is with the tags added, None if they can't be added that way"""
+    modules, in_series = parent_modules(parent, in_series)
+    tags = instance_tags(tags, parent, modules, in_series)
+    data = instance_body(file, tags, streamed)
+    if data is None:
+        return None
+    r = client.post(types.FileAPI.INSTANCES.value, data=data, headers={"Content-Type": "application/dicom"})
+    response_json = r.json()
+    invalidate_added(lookups, parent, response_json)
+    error = wrong_parent(response_json, parent, in_series, file)
+    if error:
+        delete_instance(response_json["ID"])
+        raise error
+    inherit(response_json, parent, tags)
+    return response_json
+
+def set_parents(response_json : dict, parent_study_json : dict):
+    """A folder gives a series, fill in the parents like for an instance"""
+    response_json["ParentSeries"] = response_json["ID"]
+    response_json["ParentStudy"] = parent_study_json["ID"]
+    response_json["ParentPatient"] = parent_study_json["ParentPatient"]
+    lookups.invalidate(response_json["ParentPatient"])
+
+def create_dicom(file : Path, tags : dict, parent : str, streamed : bool = STREAM_UPLOAD, in_series : bool = None) -> dict:
+    data = dicom_body(file, tags, parent, streamed)
+    if data is None:
+        return None
+    r = client.post(types.FileAPI.DICOM.value, data=data)
+    response_json = r.json()
+    invalidate_added(lookups, parent, response_json)
+    if to_path(file).is_dir():
+        set_parents(response_json, get_parent_study(response_json["ID"]))
+    return response_json
         
 def get_parent_study(id : str):
-    r = requests.get(f'http://localhost:8042/series/{id}/study', auth=basic)
-    r.raise_for_status()
-    return r.json()
-    
+    return get_json(f'series/{id}/study')
 
-def update_tags_dicom(files : list[QFileInfo], tags : QFileInfo):
-    warnings.filterwarnings("error")
+types.register(types.FileHandler("nexus", types.FileAPI.NEXUS, create_nexus, extensions=("nxs", "nxz")))
+# a DICOM file whatever its name, create-dicom takes it if the tags can't be added to its header
+types.register(types.FileHandler("dicom", types.FileAPI.INSTANCES, store_instance, magic=((128, b"DICM"),), encoding="raw",
+                                 enabled=lambda: RAW_DICOM))
+types.register(types.FileHandler("create-dicom", types.FileAPI.DICOM, create_dicom, directory=True), default=True)
     
-    files = {file.baseName():file for file in files}
-    tags_df = pd.read_csv(tags.absoluteFilePath(), delimiter=';')      
+
+def update_tags_dicom(files : list[Path], tags : Path, max_workers : int | None = rewrite.MAX_PROCESSES, dry_run : bool = False):
+    # only needed here, keeps the import of this module light for the command line
+    import pandas as pd
     
-    #Check that all the columns (except the name of the file) are DICOM Standard tags
-    for series_name, _ in tags_df.items():
-        if series_name != FILE_NAME:
-            try:
-                tag = Tag(series_name)
-            except:
-                # Error Column name not valid
-                print(f"{series_name} is not a valid tag")
-                return -1
+    files = {to_path(file).name.split(".")[0]:to_path(file) for file in files}
+    tags_df = pd.read_csv(to_path(tags), delimiter=';')      
     
-    for index, row in tags_df.iterrows():
-        image_label = row[FILE_NAME]
-
-        if not image_label in files:
-            print(f"{image_label} has not been selected")
-            continue
-
-        dicom_file = files[image_label]
-        
-        ds = dicom.read_file(dicom_file.absoluteFilePath())
-
-        row_tags = row.drop(FILE_NAME)
-
-        for col, val in row_tags.items():
-
-            #already checked that the Tag exists
-            tag = Tag(col)
-            
-            try:
-                #print(f"{tag} {col} : {dictionary_VR(tag)} with {val} encoded by {type(val)}")
-                VR = dictionary_VR(tag)
-                ds.add(dicom.DataElement(tag, VR, check_cast(VR,val)))
-            except Exception as error:
-                print(f"{image_label} : error for {tag} {col} - {val} : {error}")
-                #continue even if a tag wasn't added
-        ds.save_as(dicom_file.absoluteFilePath())
+    try:
+        results = rewrite.update_tags(files, list(tags_df.columns), tags_df.to_dict("records"), FILE_NAME, max_workers, dry_run=dry_run)
+    except ValueError as e:
+        # Error Column name not valid
+        print(e)
+        return -1
     
-    warnings.resetwarnings()
+    for result in results:
+        if result.status == "not_selected":
+            print(f"{result.label} has not been selected")
+        for error in result.errors:
+            print(f"{result.label} : {error}")
+        for tag_name, (old_val, new_val) in result.changes.items():
+            print(f"{result.label} : {tag_name} {old_val} -> {new_val}")
     return 0
 
 if __name__ == '__main__':
     file = "../data/images/dicoms.txt"
 
-    dict_tags, potential_tags = check_tags(QFileInfo(file))
\ No newline at end of file
+    dict_tags, potential_tags = check_tags(file)
\ No newline at end of file
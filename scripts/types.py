@@ -1,3 +1,6 @@
+import contextlib
+import os
+import threading
 from enum import Enum
 
     
@@ -119,14 +122,108 @@ class OrthancErrorCode(Enum):
     ErrorCode_UnsupportedMediaType = 3000,    # Unsupported media type
     ErrorCode_START_PLUGINS = 1000000
 
+# OrthancStatus of an error answer -> OrthancErrorCode, most values above are 1-tuples
+error_codes = {(code.value[0] if isinstance(code.value, tuple) else code.value):code for code in OrthancErrorCode}
+
+def get_error_code(status : int):
+    return error_codes.get(status)
+
 class FileAPI(Enum):
     DICOM = "tools/create-dicom"
     NEXUS = "stl/create-nexus"
+    # DICOM files sent as they are
+    INSTANCES = "instances"
+
+class FileHandler:
+    """How the files of one format are uploaded, see register
+
+    Attributes:
+        name : key of the handler in the registry
+        api : FileAPI the files are sent to
+        send : function(file, tags, parent, streamed, in_series) -> answer of Orthanc, None to let the next handler send the file,
+            in_series tells if parent is a series or a study, None when the caller doesn't know
+        send_async : coroutine function with the same arguments for the asyncio upload, send is run in a thread without it
+        extensions : extensions of the files it handles, lower case without the dot
+        magic : (offset, bytes) at the start of the files it handles, whatever their extension
+        directory : sends a whole folder in one request, as one series
+        encoding : "base64" when the content is sent in a JSON body (it compresses well), "raw" when the file is sent as is
+        concurrency : max files it uploads at the same time, None for no limit other than the workers
+        enabled : function telling if it is used, for the settings that can change at run time
+    """
+
+    def __init__(self, name : str, api : FileAPI, send, send_async = None, extensions : tuple[str] = (), magic : tuple[tuple[int, bytes]] = (),
+                 directory : bool = False, encoding : str = "base64", concurrency : int = None, enabled = None) -> None:
+        self.name = name
+        self.api = api
+        self.send = send
+        self.send_async = send_async
+        self.extensions = tuple(ext.lower().lstrip(".") for ext in extensions)
+        self.magic = tuple(magic)
+        self.directory = directory
+        self.encoding = encoding
+        self.concurrency = concurrency
+        self.enabled = enabled
+        self.slots = threading.BoundedSemaphore(concurrency) if concurrency else None
+
+    def is_enabled(self) -> bool:
+        return self.enabled is None or self.enabled()
+
+    def sniffs(self, head : bytes) -> bool:
+        return any(head[offset:offset + len(magic)] == magic for offset, magic in self.magic)
+
+    def limit(self):
+        """Context manager holding one of the concurrency slots of the handler"""
+        return self.slots if self.slots else contextlib.nullcontext()
+
+    def __repr__(self) -> str:
+        return f"<FileHandler {self.name} {self.api.value}>"
+
+# name -> FileHandler, tried in this order
+handlers : dict[str, FileHandler] = {}
+# name of the handler of the files no other handler takes
+default_handler : str = None
+
+def register(handler : FileHandler, first : bool = False, default : bool = False):
+    """Add a handler, replacing the one with the same name
+
+    Handlers whose magic bytes are found in a file come first, then the ones of its extension, then the default one.
+
+    Args:
+        first (bool): tried before the handlers already registered for the same files
+        default (bool): sends the files no other handler takes
+    """
+    global handlers, default_handler
+    handlers.pop(handler.name, None)
+    handlers = {handler.name: handler, **handlers} if first else {**handlers, handler.name: handler}
+    if default:
+        default_handler = handler.name
+
+def unregister(name : str):
+    global default_handler
+    handlers.pop(name, None)
+    if default_handler == name:
+        default_handler = None
 
-extension = {
-    "nxs" : FileAPI.NEXUS,
-    "nxz" : FileAPI.NEXUS,
-}
+def sniff(path : str) -> bytes:
+    """Start of a file, long enough for the magic bytes of every handler"""
+    size = max((offset + len(magic) for handler in handlers.values() for offset, magic in handler.magic), default=0)
+    if size == 0:
+        return b""
+    try:
+        with open(path, "rb") as f:
+            return f.read(size)
+    except OSError:
+        return b""
 
-def get_type(ext : str):
-    return extension[ext] if ext in extension else FileAPI.DICOM
\ No newline at end of file
+def get_handlers(path : str) -> list[FileHandler]:
+    """Enabled handlers of a file or a folder, in the order they are tried"""
+    if os.path.isdir(path):
+        found = [handler for handler in handlers.values() if handler.directory]
+    else:
+        head = sniff(path)
+        ext = os.path.splitext(path)[1].lower().lstrip(".")
+        found = [handler for handler in handlers.values() if handler.sniffs(head)]
+        found += [handler for handler in handlers.values() if ext in handler.extensions and handler not in found]
+    if default_handler in handlers and handlers[default_handler] not in found:
+        found.append(handlers[default_handler])
+    return [handler for handler in found if handler.is_enabled()]
@@ -0,0 +1,169 @@
+# Canathist Automizer Tags 2023
+
+# Copyright (C) 2023 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU General Public License as
+
+# published by the Free Software Foundation, either version 3 of the
+
+# License, or (at your option) any later version.
+
+# 
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU General Public License
+
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+from collections import defaultdict
+from functools import lru_cache
+
+from pydicom.datadict import dictionary_VR
+from pydicom.tag import Tag, BaseTag
+from pydicom.valuerep import VR, FLOAT_VR, INT_VR, STR_VR, BYTES_VR
+
+from .metrics import metrics
+
+
+def get_caster(vr : str):
+    """Function casting a value to the type of a VR, None if not castable (SQ, ambiguous VR)"""
+    if vr == VR.AT:
+        # if it's an Attribute
+        return Tag
+    
+    if vr in STR_VR:
+        return str
+    
+    if vr in INT_VR:
+        return int
+    
+    if vr in FLOAT_VR:
+        return float
+    
+    if vr in BYTES_VR:
+        return bytes
+    
+    return None
+
+@lru_cache(maxsize=None)
+def resolve(tag_name : str) -> tuple[BaseTag, str, object] | None:
+    """(tag, VR, caster) of a keyword, None if it isn't a DICOM standard tag
+
+    Resolved once per keyword, a manifest only uses a few dozen of them.
+    """
+    try:
+        tag = Tag(tag_name)
+        vr = dictionary_VR(tag)
+    except (ValueError, KeyError, TypeError, OverflowError):
+        # not a valid name but possibly a private tag
+        return None
+    return tag, vr, get_caster(vr)
+
+def cast_column(tag_name : str, values : list) -> tuple[list, list[int]]:
+    """Cast every value of a tag
+
+    Returns:
+        list: the casted values, the original ones where they couldn't be casted
+        list[int]: indices of the values that couldn't be casted (all of them if the tag is unknown)
+    """
+    info = resolve(tag_name)
+    if info is None or info[2] is None:
+        return list(values), list(range(len(values)))
+    caster = info[2]
+    casted = []
+    bad = []
+    for i, val in enumerate(values):
+        try:
+            casted.append(caster(val))
+        except (ValueError, TypeError, OverflowError):
+            casted.append(val)
+            bad.append(i)
+    return casted, bad
+
+@metrics.timed("validation")
+def cast_series(files : dict[str, dict]) -> tuple[dict[str, dict], dict[str, list[str]]]:
+    """Cast the tags of all the files of a series, one column per tag
+
+    Args:
+        files (dict): file name -> {tag name: value}
+
+    Returns:
+        dict: file name -> casted tags
+        dict: file name -> names of the tags that aren't DICOM tags or whose value couldn't be casted
+    """
+    columns : dict[str, tuple[list, list]] = defaultdict(lambda: ([], []))
+    for file_name, file_tags in files.items():
+        for tag_name, val in file_tags.items():
+            column = columns[tag_name]
+            column[0].append(file_name)
+            column[1].append(val)
+
+    casted_files = {file_name:dict() for file_name in files}
+    bad_tags = defaultdict(list)
+    for tag_name, (file_names, values) in columns.items():
+        # the same few names are repeated for every file
+        tag_name = sys.intern(tag_name)
+        casted, bad = cast_column(tag_name, values)
+        for file_name, val in zip(file_names, casted):
+            casted_files[file_name][tag_name] = val
+        for i in bad:
+            bad_tags[file_names[i]].append(tag_name)
+    return casted_files, dict(bad_tags)
+
+
+class ValidationReport:
+    """Result of the validation of a manifest
+
+    Attributes:
+        tags : study -> series -> file -> casted tags
+        bad_tags : study -> series -> file -> names that aren't DICOM standard tags
+        bad_values : study -> series -> file -> {tag name: value that couldn't be casted}
+    """
+
+    def __init__(self) -> None:
+        self.tags = defaultdict(dict)
+        self.bad_tags = defaultdict(lambda : defaultdict(dict))
+        self.bad_values = defaultdict(lambda : defaultdict(dict))
+
+    def is_valid(self) -> bool:
+        return len(self.bad_tags) == 0 and len(self.bad_values) == 0
+
+    def to_dict(self) -> dict:
+        return {
+            "bad_tags": {study:{series:{file:sorted(names) for file, names in files.items()} for series, files in series_dict.items()} for study, series_dict in self.bad_tags.items()},
+            "bad_values": {study:{series:{file:{tag:str(val) for tag, val in values.items()} for file, values in files.items()} for series, files in series_dict.items()} for study, series_dict in self.bad_values.items()},
+        }
+
+    def names(self, study_name : str, series_name : str, file_name : str) -> list[str]:
+        """Names of the bad tags and of the tags with a bad value of a file"""
+        return [*self.bad_tags.get(study_name, {}).get(series_name, {}).get(file_name, ()),
+                *self.bad_values.get(study_name, {}).get(series_name, {}).get(file_name, ())]
+
+def record_errors(report : ValidationReport, study_name : str, series_name : str, files : dict[str, dict], bad : dict[str, list[str]]):
+    """Record in the report the tags cast_series couldn't cast"""
+    for file_name, names in bad.items():
+        for tag_name in names:
+            if resolve(tag_name) is None:
+                report.bad_tags[study_name][series_name].setdefault(file_name, set()).add(tag_name)
+            else:
+                report.bad_values[study_name][series_name].setdefault(file_name, dict())[tag_name] = files[file_name][tag_name]
+
+def validate_series(report : ValidationReport, study_name : str, series_name : str, files : dict[str, dict]):
+    """Cast the tags of a series (file name -> {tag name: value}) and record its errors in the report"""
+    casted_files, bad = cast_series(files)
+    report.tags[study_name][series_name] = casted_files
+    record_errors(report, study_name, series_name, files, bad)
@@ -0,0 +1,125 @@
+# Canathist Automizer Tags 2023
+
+# Copyright (C) 2023 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU General Public License as
+
+# published by the Free Software Foundation, either version 3 of the
+
+# License, or (at your option) any later version.
+
+# 
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU General Public License
+
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import csv
+import io
+import json
+
+import pytest
+
+from scripts import manifest
+
+
+MANIFEST = {
+    "Study_1": {
+        "_tags": {"PatientName": "Doe^John", "PatientID": "P-1", "nested": {"a": [1, 2.5, -3e-2, None, True, False]}},
+        "Serie_1": {
+            "tags": {"SeriesDescription": "café \"quoted\" \\ back\nslash", "SeriesNumber": 1},
+            "type": "DEFAULT",
+            "options": {},
+            "files": {
+                "a.jpg": {"tags": {"InstanceNumber": 1, "SliceThickness": -2.5e10}},
+                "b.jpg": {"tags": {}},
+                "c.jpg": {},
+            },
+        },
+        "Serie_2": {
+            "columns": {"Label": ["x.jpg", "y.jpg"], "InstanceNumber": [12345678901234, ""], "Rows": [None, 512]},
+        },
+    },
+    "Study_2": {
+        "_tags": {},
+        "Serie_3": {"tags": {"Modality": "OT"}, "options": {"deep": {"deeper": {"deepest": [[], {}, [{"k": "v"}]]}}}},
+    },
+    "Empty": {},
+}
+
+
+def _expected(document : dict, directory : str = "") -> list:
+    """What iter_series yields, built from the whole document read by json"""
+    expected = []
+    for study_name, study in document.items():
+        for series_name, series in study.items():
+            if series_name == manifest.STUDY_TAGS:
+                expected.append((study_name, None, {"tags": series}, {}))
+                continue
+            fields = {field:value for field, value in series.items() if field not in ("files", "columns", "csv")}
+            files = {file_name:file.get("tags", {}) for file_name, file in series.get("files", {}).items()}
+            if "columns" in series:
+                files.update(manifest._columns_to_files(series["columns"]))
+            if "csv" in series:
+                files.update(manifest._read_csv(f"{directory}/{series['csv']}"))
+            expected.append((study_name, series_name, fields, files))
+    return expected
+
+
+@pytest.mark.parametrize("indent", [None, 2])
+def test_iter_series_matches_json(tmp_path, indent):
+    path = tmp_path / "manifest.json"
+    text = json.dumps(MANIFEST, indent=indent, ensure_ascii=False)
+    path.write_text(text)
+    expected = _expected(json.loads(text))
+    # every read size cuts the keys, the strings and the numbers at a different place, down to a refill per character
+    for read_size in list(range(1, 40)) + [len(text) - 1, len(text), manifest.READ_SIZE]:
+        assert list(manifest.iter_series(str(path), read_size)) == expected, read_size
+
+
+def test_iter_series_csv(tmp_path):
+    with open(tmp_path / "files.csv", "w", newline="") as f:
+        writer = csv.writer(f, delimiter=";")
+        writer.writerow(["Label", "InstanceNumber", "Rows"])
+        writer.writerow(["a.jpg", "1", ""])
+        writer.writerow(["b.jpg", "2", "512"])
+    document = {"Study": {"_tags": {"PatientID": "P"}, "Serie": {"tags": {"Modality": "OT"}, "csv": "files.csv", "files": {"c.jpg": {"tags": {"Rows": 3}}}}}}
+    path = tmp_path / "manifest.json"
+    path.write_text(json.dumps(document))
+    expected = _expected(document, str(tmp_path))
+    assert expected[1][3] == {"c.jpg": {"Rows": 3}, "a.jpg": {"InstanceNumber": "1"}, "b.jpg": {"InstanceNumber": "2", "Rows": "512"}}
+    for read_size in (1, 7, manifest.READ_SIZE):
+        assert list(manifest.iter_series(str(path), read_size)) == expected
+
+
+@pytest.mark.parametrize("text", ["0", "-2.5e10", "12345678901234567890", "1E-7", '"a\\u00e9\\"b"', "[1, [2, {\"3\": 4.0}]]", "{ }", "true", "null"])
+def test_value_matches_json(text):
+    for read_size in range(1, len(text) + 2):
+        reader = manifest._Reader(io.StringIO(f" {text} "), read_size)
+        assert reader.value() == json.loads(text), read_size
+
+
+@pytest.mark.parametrize("text", ['{"a": 1', '{"a" 1}', '{"a": 1 "b": 2}', '{1: 2}', '{"a": tru}'])
+def test_iter_series_invalid(tmp_path, text):
+    path = tmp_path / "manifest.json"
+    path.write_text(text)
+    for read_size in (1, 3, manifest.READ_SIZE):
+        with open(path) as f, pytest.raises(json.JSONDecodeError):
+            reader = manifest._Reader(f, read_size)
+            for key in reader.keys():
+                reader.value()
@@ -0,0 +1,178 @@
+# Canathist Automizer Tags 2023
+
+# Copyright (C) 2023 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU General Public License as
+
+# published by the Free Software Foundation, either version 3 of the
+
+# License, or (at your option) any later version.
+
+# 
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU General Public License
+
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+import requests
+
+from scripts.client import OrthancClient
+from scripts.retry import RetryPolicy, is_transient
+
+
+# status of a server closing the connection without answering
+CLOSED = 0
+
+
+class _StatusServer:
+    """HTTP server answering every request with the same status, counting them"""
+
+    def __init__(self, status : int) -> None:
+        self.status = status
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _answer(self):
+                server.requests += 1
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if server.status == CLOSED:
+                    self.close_connection = True
+                    return
+                body = b'{"HttpStatus": %d, "Message": "error"}' % server.status
+                self.send_response(server.status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = _answer
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server(request):
+    server = _StatusServer(request.param)
+    yield server
+    server.close()
+
+def _client(server : _StatusServer) -> OrthancClient:
+    return OrthancClient(server.url, retry=RetryPolicy(3, base_delay=0))
+
+def _error(status : int) -> requests.exceptions.HTTPError:
+    response = requests.Response()
+    response.status_code = status
+    response._content = b"{}"
+    return requests.exceptions.HTTPError(response=response)
+
+@pytest.mark.parametrize("status", [502, 504])
+def test_gateway_error_retried_only_when_idempotent(status):
+    assert is_transient(_error(status), "GET")
+    assert not is_transient(_error(status), "POST")
+
+@pytest.mark.parametrize("status", [429, 503])
+def test_rejected_request_retried(status):
+    assert is_transient(_error(status), "POST")
+
+@pytest.mark.parametrize("server", [504], indirect=True)
+def test_post_not_retried_after_504(server):
+    with pytest.raises(requests.exceptions.HTTPError):
+        _client(server).post("tools/create-dicom", data=b"{}")
+    assert server.requests == 1
+
+@pytest.mark.parametrize("server", [504], indirect=True)
+def test_get_retried_after_504(server):
+    with pytest.raises(requests.exceptions.HTTPError):
+        _client(server).get("studies")
+    assert server.requests == 3
+
+@pytest.mark.parametrize("server", [503], indirect=True)
+def test_post_retried_after_503(server):
+    with pytest.raises(requests.exceptions.HTTPError):
+        _client(server).post("tools/create-dicom", data=b"{}")
+    assert server.requests == 3
+
+@pytest.mark.parametrize("server", [504], indirect=True)
+def test_async_post_not_retried_after_504(server):
+    pytest.importorskip("httpx")
+    from scripts.async_client import AsyncOrthancClient
+
+    async def post():
+        client = AsyncOrthancClient(_client(server))
+        try:
+            await client.post("tools/create-dicom", data=b"{}")
+        finally:
+            await client.aclose()
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        asyncio.run(post())
+    assert server.requests == 1
+
+@pytest.mark.parametrize("server", [CLOSED], indirect=True)
+@pytest.mark.parametrize("method, sent", [("GET", 3), ("POST", 1)])
+def test_connection_closed(server, method, sent):
+    with pytest.raises(requests.exceptions.ConnectionError):
+        _client(server).request(method, "studies", data=b"{}")
+    assert server.requests == sent
+
+@pytest.mark.parametrize("server", [CLOSED], indirect=True)
+@pytest.mark.parametrize("method, sent", [("GET", 3), ("POST", 1)])
+def test_async_connection_closed(server, method, sent):
+    # the httpx errors are raised and retried like the ones of requests
+    pytest.importorskip("httpx")
+    from scripts.async_client import AsyncOrthancClient
+
+    async def send():
+        client = AsyncOrthancClient(_client(server))
+        try:
+            await client.request(method, "studies", data=b"{}")
+        finally:
+            await client.aclose()
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        asyncio.run(send())
+    assert server.requests == sent
+
+def test_transport_error_mapping():
+    httpx = pytest.importorskip("httpx")
+    from scripts.async_client import _transport_error
+
+    assert isinstance(_transport_error(httpx.ConnectTimeout("")), requests.exceptions.ConnectTimeout)
+    assert isinstance(_transport_error(httpx.PoolTimeout("")), requests.exceptions.ConnectTimeout)
+    assert isinstance(_transport_error(httpx.ReadTimeout("")), requests.exceptions.ReadTimeout)
+    assert isinstance(_transport_error(httpx.WriteTimeout("")), requests.exceptions.Timeout)
+    assert isinstance(_transport_error(httpx.ConnectError("")), requests.exceptions.ConnectionError)
+    assert isinstance(_transport_error(httpx.RemoteProtocolError("")), requests.exceptions.ConnectionError)
+    assert is_transient(_transport_error(httpx.ConnectTimeout("")), "POST")
+    assert not is_transient(_transport_error(httpx.ReadTimeout("")), "POST")
+    assert is_transient(_transport_error(httpx.ReadTimeout("")), "GET")
@@ -0,0 +1,153 @@
+# Canathist Automizer Tags 2023
+
+# Copyright (C) 2023 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU General Public License as
+
+# published by the Free Software Foundation, either version 3 of the
+
+# License, or (at your option) any later version.
+
+# 
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU General Public License
+
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import shutil
+
+import pydicom as dicom
+import pytest
+from pydicom.dataset import FileMetaDataset
+from pydicom.encaps import encapsulate
+from pydicom.uid import (DeflatedExplicitVRLittleEndian, ExplicitVRLittleEndian, ImplicitVRLittleEndian,
+                         JPEGBaseline8Bit, SecondaryCaptureImageStorage, generate_uid)
+
+from scripts import rewrite
+
+TAGS = {"PatientName": "Doe^Jane", "SeriesDescription": "rewritten", "InstanceNumber": "7"}
+
+
+def _write(path, syntax : str, trailing : bool):
+    ds = dicom.Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = SecondaryCaptureImageStorage
+    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.file_meta.TransferSyntaxUID = syntax
+    ds.SOPClassUID = SecondaryCaptureImageStorage
+    ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+    ds.PatientName = "Doe^John"
+    ds.Modality = "OT"
+    ds.Rows = ds.Columns = 16
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = ds.BitsStored = 8
+    ds.HighBit = 7
+    ds.PixelRepresentation = 0
+    pixels = bytes(range(256))
+    if syntax == JPEGBaseline8Bit:
+        # not a valid JPEG, the fragments are copied as they are
+        ds.PixelData = encapsulate([pixels[:100], pixels[100:]])
+        ds["PixelData"].VR = "OB"
+    else:
+        ds.PixelData = pixels
+    if trailing:
+        ds.DataSetTrailingPadding = b"\0" * 8
+    ds.save_as(path, enforce_file_format=True)
+
+def _full_rewrite(path, row_tags : dict):
+    ds = dicom.dcmread(path)
+    assert rewrite._add_tags(ds, row_tags) == []
+    ds.save_as(path)
+
+
+@pytest.mark.parametrize("trailing", [False, True], ids=["pixels last", "elements after pixels"])
+@pytest.mark.parametrize("syntax", [ExplicitVRLittleEndian, ImplicitVRLittleEndian, JPEGBaseline8Bit], ids=["explicit", "implicit", "encapsulated"])
+def test_patch_matches_full_rewrite(tmp_path, syntax, trailing):
+    patched = tmp_path / "patched.dcm"
+    _write(patched, syntax, trailing)
+    expected = tmp_path / "expected.dcm"
+    shutil.copy(patched, expected)
+
+    assert rewrite.patch_file(str(patched), TAGS) == []
+    _full_rewrite(expected, TAGS)
+    assert patched.read_bytes() == expected.read_bytes()
+    ds = dicom.dcmread(patched)
+    assert ds.PatientName == "Doe^Jane" and ds.InstanceNumber == 7
+    assert ("DataSetTrailingPadding" in ds) == trailing
+
+def test_patch_without_pixel_data(tmp_path):
+    path = tmp_path / "file.dcm"
+    _write(path, ExplicitVRLittleEndian, False)
+    ds = dicom.dcmread(path)
+    del ds.PixelData
+    ds.save_as(path)
+    expected = tmp_path / "expected.dcm"
+    shutil.copy(path, expected)
+
+    assert rewrite.patch_file(str(path), TAGS) == []
+    _full_rewrite(expected, TAGS)
+    assert path.read_bytes() == expected.read_bytes()
+
+def test_pixel_data_offset(tmp_path):
+    path = tmp_path / "file.dcm"
+    _write(path, ExplicitVRLittleEndian, True)
+    with open(path, "rb") as src:
+        ds, offset = rewrite._read_header(src)
+    data = path.read_bytes()
+    # the group and element of Pixel Data, little endian
+    assert data[offset:offset + 4] == b"\xe0\x7f\x10\x00"
+    assert "PixelData" not in ds
+
+def test_copy_range(tmp_path):
+    src_path = tmp_path / "src"
+    src_path.write_bytes(bytes(range(256)) * 64)
+    with open(src_path, "rb") as src, open(tmp_path / "dst", "wb") as dst:
+        dst.write(b"header")
+        rewrite._copy_range(src, dst, 1000)
+    assert (tmp_path / "dst").read_bytes() == b"header" + src_path.read_bytes()[1000:]
+
+@pytest.mark.parametrize("syntax, row_tags", [(DeflatedExplicitVRLittleEndian, TAGS), (ExplicitVRLittleEndian, {"DataSetTrailingPadding": "00"})], ids=["deflated", "tag after pixels"])
+def test_fallback_to_full_rewrite(tmp_path, syntax, row_tags):
+    path = tmp_path / "file.dcm"
+    _write(path, syntax, False)
+    expected = tmp_path / "expected.dcm"
+    shutil.copy(path, expected)
+    assert rewrite.patch_file(str(path), row_tags) is None
+
+    result = rewrite.rewrite_file(("label", str(path), row_tags, True, False))
+    assert result.status == "updated", result.errors
+    ds = dicom.dcmread(expected)
+    rewrite._add_tags(ds, row_tags)
+    ds.save_as(expected)
+    assert path.read_bytes() == expected.read_bytes()
+
+def test_check_columns_without_rows(tmp_path):
+    # only the header of the CSV
+    with pytest.raises(ValueError, match="NotATag"):
+        rewrite.update_tags({}, ["Label", "PatientName", "NotATag"], [], "Label")
+    assert rewrite.update_tags({}, ["Label", "PatientName"], [], "Label") == []
+
+def test_private_tag_passed_through(tmp_path):
+    path = tmp_path / "file.dcm"
+    _write(path, ExplicitVRLittleEndian, False)
+    rows = [{"Label": "file", "PatientName": "Doe^Jane", "0x00091001": "private"}]
+    results = rewrite.update_tags({"file": str(path)}, list(rows[0]), rows, "Label", max_workers=1)
+    assert [result.status for result in results] == ["patched"]
+    assert len(results[0].errors) == 1 and "0x00091001" in results[0].errors[0]
+    assert dicom.dcmread(path).PatientName == "Doe^Jane"
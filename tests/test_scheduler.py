@@ -0,0 +1,119 @@
+# Canathist Automizer Tags 2023
+
+# Copyright (C) 2023 Yann Pollet, Royal Belgian Institute of Natural Sciences
+
+#
+
+# This program is free software: you can redistribute it and/or
+
+# modify it under the terms of the GNU General Public License as
+
+# published by the Free Software Foundation, either version 3 of the
+
+# License, or (at your option) any later version.
+
+# 
+
+# This program is distributed in the hope that it will be useful, but
+
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+
+# General Public License for more details.
+
+#
+
+# You should have received a copy of the GNU General Public License
+
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import itertools
+
+import pytest
+
+from scripts import scheduler, tags
+from scripts.journal import Journal
+
+
+class _FakeOrthanc:
+    """Answers of tags.send_request : an instance without parent creates a study, one in a study creates a series"""
+
+    def __init__(self) -> None:
+        self.ids = itertools.count()
+        # series -> study
+        self.series = {}
+        self.resources = set()
+        self.sent = []
+
+    def send_request(self, file, tags_dict, parent, instance_number = 1, streamed = None, in_series = None):
+        i = next(self.ids)
+        self.sent.append((file.name, parent, dict(tags_dict)))
+        if in_series:
+            series = parent
+        else:
+            series = f"series{i}"
+            self.series[series] = parent or f"study{i}"
+        response = {"ID": f"instance{i}", "ParentSeries": series, "ParentStudy": self.series[series]}
+        self.resources.update(response.values())
+        return response
+
+    def resource_exists(self, level, id):
+        return id in self.resources
+
+
+@pytest.fixture
+def orthanc(monkeypatch):
+    orthanc = _FakeOrthanc()
+    monkeypatch.setattr(tags, "send_request", orthanc.send_request)
+    monkeypatch.setattr(tags, "resource_exists", orthanc.resource_exists)
+    monkeypatch.setattr(tags, "prefetch", lambda *args, **kwargs: None)
+    return orthanc
+
+def _plan(directory) -> scheduler.StudyJob:
+    series = [(name, [(directory / name / f"{i}.jpg", {"SeriesDescription": name}, None) for i in range(3)], None) for name in ("a", "b")]
+    return scheduler.plan_study("study", series)
+
+def _dataset(directory):
+    for name in ("a", "b"):
+        (directory / name).mkdir()
+        for i in range(3):
+            (directory / name / f"{i}.jpg").write_bytes(f"{name}{i}".encode())
+
+def test_resume_with_changed_first_file(tmp_path, orthanc):
+    _dataset(tmp_path)
+    journal = Journal(str(tmp_path / "journal.sqlite"))
+    upload = scheduler.UploadScheduler(2, 1, journal)
+
+    first = upload.run([_plan(tmp_path)])[0]
+    assert first.error is None and first.created
+    assert len(orthanc.sent) == 6
+
+    # the first file of the study changes between the runs
+    (tmp_path / "a" / "0.jpg").write_bytes(b"changed")
+    orthanc.sent.clear()
+    second = upload.run([_plan(tmp_path)])[0]
+
+    assert second.error is None
+    # sent again into the resumed series, without the tags of its modules Orthanc would refuse to override
+    assert [(name, parent) for name, parent, _ in orthanc.sent] == [("0.jpg", first.series[0].id)]
+    assert "SeriesDescription" not in orthanc.sent[0][2]
+    assert second.id == first.id and [series.id for series in second.series] == [series.id for series in first.series]
+    assert not second.created and not any(series.created for series in second.series)
+    assert all(instance.resumed for instance in second.instances() if instance is not second.series[0].instances[0])
+    # only the new instance would be rolled back, never the resumed study or series
+    assert second.created_resources() == [("instances", second.series[0].instances[0].id)]
+    journal.close()
+
+def test_resume_unchanged(tmp_path, orthanc):
+    _dataset(tmp_path)
+    journal = Journal(str(tmp_path / "journal.sqlite"))
+    upload = scheduler.UploadScheduler(2, 1, journal)
+    first = upload.run([_plan(tmp_path)])[0]
+    orthanc.sent.clear()
+    second = upload.run([_plan(tmp_path)])[0]
+    assert orthanc.sent == []
+    assert second.id == first.id and all(instance.resumed for instance in second.instances())
+    assert second.created_resources() == []
+    journal.close()